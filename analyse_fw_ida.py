@@ -25,14 +25,19 @@
 import argparse
 import json
 import os
+import shutil
 import sys
+import time
+from functools import partial
 from glob import glob
 
 import click
 import uefi_firmware
 
-from tools import md_to_json, utils
-from tools.get_efi_images import get_efi_images
+from tools import (md_to_json, metrics, profiler, protocol_names, scheduler,
+                   utils)
+from tools.get_efi_images import dump_volume, get_efi_images
+from tools.result_db import ResultDB
 from tools.update_edk2_guids import update
 '''
 reads configuration data
@@ -44,47 +49,114 @@ dump_dir = config['DUMP_DIR']
 pe_dir = config['PE_DIR']
 ida_path = '"{}"'.format(config['IDA_PATH'])
 ida64_path = '"{}"'.format(config['IDA64_PATH'])
+INVENTORY_FILE = os.path.join('log', 'ida_modules.json')
+COSTS_FILE = os.path.join('log', 'ida_costs.json')
+# IDA scripts write module logs to this directory (see ida_plugin utils)
+LOG_PARTS_ENV = 'UEFI_RETOOL_LOG_PARTS_DIR'
 
 
 def show_item(item):
     return 'current module: {}'.format(item)
 
 
-def analyse_all(scr_name):
+def show_job(job):
+    if job is None:
+        return None
+    return show_item(job[0])
+
+
+def get_table_line(guid, module, service, address):
+    return '| {} | {} | {} | {} |'.format(guid, module, service, address)
+
+
+def run_ida(scr_name, record):
+    '''
+    analyse module with IDA script, IDA exit status is returned
+    '''
+    ida_exe = ida64_path
+    if record['machine'] == utils.IMAGE_FILE_MACHINE_I386:
+        ida_exe = ida_path
+    cmd_line = ' '.join([
+        ida_exe, '-c -A -S' + os.path.join('plugins', 'uefi_analyser', scr_name),
+        record['path']
+    ])
+    return os.system(cmd_line)
+
+
+def join_log_parts(log_path, parts_dir, modules):
+    '''
+    append module logs written by IDA scripts to the log
+    in the order of modules
+    '''
+    with open(log_path, 'a') as log:
+        for record in modules:
+            part_path = os.path.join(parts_dir,
+                                     os.path.basename(record['path']) + '.md')
+            if os.path.isfile(part_path):
+                with open(part_path, 'r') as part:
+                    log.write(part.read())
+    shutil.rmtree(parts_dir, ignore_errors=True)
+
+
+def analyse_all(scr_name, fw_path=None, db_path=None, jobs=None):
     log_path = os.path.join('log',
                             'ida_{}'.format(scr_name.replace('.py', '.md')))
     if os.path.isfile(log_path):
         os.remove(log_path)
-    files = os.listdir(pe_dir)
+    if scr_name == 'log_pp_guids.py':
+        # the table header is written before IDA instances are started
+        with open(log_path, 'w') as log:
+            log.write(
+                get_table_line('Guid', 'Module', 'Service', 'Address') + '\n')
+            log.write(get_table_line('---', '---', '---', '---') + '\n')
+    # appends of parallel IDA instances to one file are not atomic
+    # on every platform, so each module log is written to its own file
+    parts_dir = log_path.replace('.md', '_parts')
+    shutil.rmtree(parts_dir, ignore_errors=True)
+    os.makedirs(parts_dir)
+    os.environ[LOG_PARTS_ENV] = os.path.abspath(parts_dir)
+    # the headers are checked before any IDA process is started
+    inventory = utils.get_inventory(pe_dir)
+    utils.save_inventory(inventory, INVENTORY_FILE)
+    modules, dropped = utils.triage(inventory, 'ida')
+    if len(dropped):
+        print('[*] {} unsupported modules were skipped (see {})'.format(
+            len(dropped), INVENTORY_FILE))
+    history = scheduler.CostHistory(COSTS_FILE)
+    jobs_iter = scheduler.run_jobs(modules, partial(run_ida, scr_name), jobs,
+                                   history)
     bar_template = click.style('%(label)s  %(bar)s | %(info)s', fg='cyan')
     label = 'Modules analysis'
-    with click.progressbar(files,
-                           length=len(files),
-                           bar_template=bar_template,
-                           label=label,
-                           item_show_func=show_item) as bar:
-        for module in bar:
-            if module[-4:] in ['.idb', '.i64', '.id1', '.id2', '.nam', '.til']:
-                continue
-            module_path = os.path.join(pe_dir, module)
-            machine_type = utils.get_machine_type(module_path)
-            ida_exe = ida64_path
-            if machine_type == utils.IMAGE_FILE_MACHINE_I386:
-                ida_exe = ida_path
-            cmd_line = ' '.join([
-                ida_exe, '-c -A -S' +
-                os.path.join('plugins', 'uefi_analyser', scr_name), module_path
-            ])
-            if not os.system(cmd_line):
+    start = time.time()
+    with profiler.phase('analyse'), click.progressbar(
+            jobs_iter,
+            length=len(modules),
+            bar_template=bar_template,
+            label=label,
+            item_show_func=show_job) as bar:
+        for module, status in bar:
+            # the scripts exit with 1 after the log is written
+            metrics.MODULES.inc(status='ok' if status else 'error')
+            if not status:
                 msg = '[-] Error during {module} module processing\n\t{hint}'.format(
-                    module=module_path,
+                    module=os.path.join(pe_dir, module),
                     hint=
                     'check your config.json file or move ida_plugin/uefi_analyser directory to IDA plugins directory'
                 )
                 exit(msg)
-    if scr_name == 'log_all.py':
-        md_name = os.path.join('log', 'ida_log_all.md')
-        md_to_json.get_json(md_name)
+    metrics.PHASE_SECONDS.observe(time.time() - start, phase='analyse')
+    join_log_parts(log_path, parts_dir, modules)
+    with metrics.PHASE_SECONDS.time(phase='report'), profiler.phase('report'):
+        # protocol names are taken from current GUIDs, not from the plugin copy
+        protocol_names.render(log_path)
+        if scr_name == 'log_all.py':
+            md_name = os.path.join('log', 'ida_log_all.md')
+            md_to_json.get_json(md_name)
+            if db_path is not None:
+                db = ResultDB(db_path)
+                db.import_json(md_name.replace('.md', '.json'), fw_path,
+                               pe_dir)
+                db.close()
 
 
 def clear(dirname):
@@ -129,20 +201,61 @@ def main():
 		(images are stored in .{sep}modules directory, 
 		example: python analyse_fw_ida.py --get_efi_images <firmware_path>)'''.
                         format(sep=os.sep))
+    parser.add_argument('--db',
+                        type=str,
+                        metavar='DB_PATH',
+                        help='''also store the results of --all analysis
+		in SQLite database (example: python analyse_fw_ida.py --all
+		--db results.db <firmware_path>)''')
+    parser.add_argument('--jobs',
+                        type=int,
+                        help='''number of IDA instances started in parallel
+		(default: number of CPUs)''')
+    parser.add_argument('--metrics_file',
+                        type=str,
+                        metavar='PATH',
+                        help='''rewrite Prometheus metrics of the run
+		to file periodically (for node_exporter textfile collector)''')
+    parser.add_argument('--metrics_port',
+                        type=int,
+                        metavar='PORT',
+                        help='''serve Prometheus/OpenMetrics metrics
+		on http://localhost:PORT/metrics''')
+    parser.add_argument('--profile',
+                        type=str,
+                        metavar='DIR',
+                        help='''save cProfile stats and collapsed stacks
+		of analysis phases, of each module and of IDA scripts to DIR
+		and print time spent in Python code and in IDA''')
 
     args = parser.parse_args()
 
+    if args.profile:
+        profiler.enable(args.profile)
+    # forkserver keeps the first preload list, so modules of volume and
+    # analysis workers are set before the first pool is created
+    scheduler.preload([dump_volume, run_ida])
+    exporter = metrics.Exporter(args.metrics_file, args.metrics_port)
+    try:
+        run(args)
+    finally:
+        exporter.close()
+        if args.profile:
+            profiler.print_breakdown(args.profile)
+
+
+def run(args):
     if (args.all and os.path.isfile(args.firmware_path)):
         clear_all()
         get_efi_images(args.firmware_path)
-        analyse_all('log_all.py')
+        analyse_all('log_all.py', args.firmware_path, args.db, args.jobs)
         print('Check .{sep}log{sep}ida_log_all.md file'.format(sep=os.sep))
         clear_all()
 
     if (args.pp_guids and os.path.isfile(args.firmware_path)):
         clear_all()
         get_efi_images(args.firmware_path)
-        analyse_all('log_pp_guids.py')
+        analyse_all('log_pp_guids.py', jobs=args.jobs)
         print('Check .{sep}log{sep}ida_pp_guids.md file'.format(sep=os.sep))
         clear_all()
 
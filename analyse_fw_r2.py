@@ -23,20 +23,30 @@
 # SOFTWARE.
 
 import argparse
+import ipaddress
 import json
 import os
+import signal
+import socket
+import socketserver
+import sys
 import time
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
 
 import click
 import r2pipe
 
 from r2_uefi_re.analyser import Analyser
-from tools import utils
-from tools.get_efi_images import get_efi_images
+from tools import metrics, profiler, protocol_names, scheduler, utils
+from tools.get_efi_images import dump_volume, get_efi_images
+from tools.result_db import ResultDB, get_sha256
 from tools.update_edk2_guids import update
 
 LOG_FILE_ALL = os.path.join('log', 'r2_log_all.md')
 LOG_FILE_PP_GUIDS = os.path.join('log', 'r2_log_pp_guids.md')
+INVENTORY_FILE = os.path.join('log', 'r2_modules.json')
+COSTS_FILE = os.path.join('log', 'r2_costs.json')
 '''
 reads configuration data
 '''
@@ -50,137 +60,224 @@ def show_item(item):
     return 'current module: {}'.format(item)
 
 
-def analyse_all():
-    log = open(LOG_FILE_ALL, 'a')
-    if not os.path.isdir(pe_dir):
-        return False
-    files = os.listdir(pe_dir)
+def get_modules():
+    '''
+    get modules supported by radare2 backend (the headers are checked
+    before any r2 process is started)
+    '''
+    inventory = utils.get_inventory(pe_dir)
+    utils.save_inventory(inventory, INVENTORY_FILE)
+    supported, dropped = utils.triage(inventory, 'r2')
+    if len(dropped):
+        print('[*] {} unsupported modules were skipped (see {})'.format(
+            len(dropped), INVENTORY_FILE))
+    return supported
+
+
+def get_module_json(module, analyser):
+    '''
+    get module analysis results in md_to_json format (protocol names
+    are not set, they are applied from current GUIDs at report time)
+    '''
+    module_json = {'module_name': module, 'boot_services': [], 'protocols': []}
+    for service in analyser.gBServices:
+        for address in analyser.gBServices[service]:
+            module_json['boot_services'].append({
+                'address': '{addr:#x}'.format(addr=address),
+                'bs_name': 'EFI_BOOT_SERVICES->{}'.format(service)
+            })
+    for element in analyser.Protocols['all']:
+        module_json['protocols'].append({
+            'address': '{addr:#x}'.format(addr=element['address']),
+            'service': element['service'],
+            'guid': analyser.get_guid_str(element['guid'])
+        })
+    return module_json
+
+
+def analyse_module(record, shards=1, reachable_only=False):
+    '''
+    analyse module in worker process, (module_json, error) is returned
+    '''
+    try:
+        with Analyser(record['path'],
+                      shards=shards,
+                      reachable_only=reachable_only) as analyser:
+            analyser.get_boot_services()
+            analyser.get_protocols()
+            module_json = get_module_json(record['module'], analyser)
+            # statistics are removed before results are reported
+            module_json['stats'] = {
+                'funcs_scanned': analyser.funcs_scanned,
+                'funcs_total': analyser.funcs_total,
+                'fingerprints_hits': analyser.fingerprints.hits,
+                'fingerprints_lookups': analyser.fingerprints.lookups,
+                'project_loaded': analyser.project_loaded
+            }
+            return module_json, None
+    except Exception as e:
+        return None, str(e)
+
+
+def show_job(job):
+    if job is None:
+        return None
+    return show_item(job[0])
+
+
+def analyse_modules(jobs=None,
+                    shards=1,
+                    reachable_only=False,
+                    guid_index=None,
+                    executor=None):
+    '''
+    analyse modules in a process pool, the longest ones are started first
+    (functions of large modules are split between `shards` r2 sessions,
+    with `reachable_only` only functions reachable from the entry point
+    are scanned, `executor` is a pool kept between runs)
+    '''
+    records = get_modules()
+    history = scheduler.CostHistory(COSTS_FILE)
+    if guid_index is None:
+        guid_index = protocol_names.get_guid_index()
     bar_template = click.style('%(label)s  %(bar)s | %(info)s', fg='cyan')
     label = 'Modules analysis'
-    with click.progressbar(files,
-                           length=len(files),
-                           bar_template=bar_template,
-                           label=label,
-                           item_show_func=show_item) as bar:
-        for module in bar:
-            if module[-4:] in ['.idb', '.i64', '.id1', '.id2', '.nam', '.til']:
-                continue
-            module_path = os.path.join(pe_dir, module)
-            # x64 only
-            machine_type = utils.get_machine_type(module_path)
-            if machine_type == utils.IMAGE_FILE_MACHINE_IA64:
-                try:
-                    log.write('## Module: {module}\n'.format(module=module))
-                    analyser = Analyser(module_path)
-                    analyser.get_boot_services()
-                    # list boot services
-                    log.write('### Boot services:\n')
-                    empty = False
-                    for service in analyser.gBServices:
-                        for address in analyser.gBServices[service]:
-                            empty = True
-                            log.write(
-                                '* [{0}] EFI_BOOT_SERVICES->{1}\n'.format(
-                                    '{addr:#x}'.format(addr=address), service))
-                    if not empty:
-                        log.write('* empty\n')
-                    # list protocols information
-                    analyser.get_protocols()
-                    analyser.get_prot_names()
-                    data = analyser.Protocols['all']
-                    log.write('### Protocols:\n')
-                    if not len(data):
-                        log.write('* empty\n')
-                    for element in data:
-                        guid_str = '[guid] {}'.format(
-                            analyser.get_guid_str(element['guid']))
-                        log.write('* [{0}]\n'.format(
-                            '{addr:#x}'.format(addr=element['address'])))
-                        log.write('\t - [service] {}\n'.format(
-                            element['service']))
-                        log.write('\t - [protocol_name] {}\n'.format(
-                            element['protocol_name']))
-                        log.write('\t - [protocol_place] {}\n'.format(
-                            element['protocol_place']))
-                        log.write('\t - {}\n'.format(guid_str))
-                except Exception as e:
-                    log.write('### ERROR: {err}\n'.format(err=e))
-                    continue
+    jobs_iter = scheduler.run_jobs(records,
+                                   partial(analyse_module,
+                                           shards=shards,
+                                           reachable_only=reachable_only),
+                                   jobs,
+                                   history,
+                                   executor=executor)
+    stats = {
+        'funcs_scanned': 0,
+        'funcs_total': 0,
+        'fingerprints_hits': 0,
+        'fingerprints_lookups': 0
+    }
+    start = time.time()
+    with profiler.phase('analyse'), click.progressbar(
+            jobs_iter,
+            length=len(records),
+            bar_template=bar_template,
+            label=label,
+            item_show_func=show_job) as bar:
+        for module, (module_json, error) in bar:
+            metrics.MODULES.inc(status='ok' if error is None else 'error')
+            if module_json is not None:
+                module_stats = module_json.pop('stats')
+                for key in stats:
+                    stats[key] += module_stats[key]
+                metrics.count_lookups('fingerprints',
+                                      module_stats['fingerprints_hits'],
+                                      module_stats['fingerprints_lookups'])
+                metrics.count_lookups('r2_projects',
+                                      int(module_stats['project_loaded']), 1)
+                protocol_names.name_protocols(module_json['protocols'],
+                                              guid_index)
+            yield module, (module_json, error)
+    metrics.PHASE_SECONDS.observe(time.time() - start, phase='analyse')
+    print('[*] {} of {} functions were scanned'.format(
+        stats['funcs_scanned'], stats['funcs_total']))
+    print('[*] Results of {} of {} functions were taken from '
+          'fingerprints'.format(stats['fingerprints_hits'],
+                                stats['fingerprints_lookups']))
+
+
+def write_module(log, module, module_json, error):
+    log.write('## Module: {module}\n'.format(module=module))
+    if error is not None:
+        log.write('### ERROR: {err}\n'.format(err=error))
+        return
+    # list boot services
+    log.write('### Boot services:\n')
+    if not len(module_json['boot_services']):
+        log.write('* empty\n')
+    for service in module_json['boot_services']:
+        log.write('* [{0}] {1}\n'.format(service['address'],
+                                         service['bs_name']))
+    # list protocols information
+    log.write('### Protocols:\n')
+    if not len(module_json['protocols']):
+        log.write('* empty\n')
+    for element in module_json['protocols']:
+        log.write('* [{0}]\n'.format(element['address']))
+        log.write('\t - [service] {}\n'.format(element['service']))
+        log.write('\t - [protocol_name] {}\n'.format(
+            element['protocol_name']))
+        log.write('\t - [protocol_place] {}\n'.format(
+            element['protocol_place']))
+        log.write('\t - [guid] {}\n'.format(element['guid']))
+
+
+def analyse_all(db=None,
+                firmware_id=None,
+                jobs=None,
+                shards=1,
+                reachable_only=False):
+    if not os.path.isdir(pe_dir):
+        return False
+    log = open(LOG_FILE_ALL, 'a')
+    for module, (module_json, error) in analyse_modules(
+            jobs, shards, reachable_only):
+        write_module(log, module, module_json, error)
+        if db is not None and error is None:
+            db.add_module(firmware_id, module_json,
+                          get_sha256(os.path.join(pe_dir, module)))
     log.close()
+    if db is not None:
+        db.add_dependencies(firmware_id)
 
 
 def get_table_line(guid, module, service, address):
     return '| {} | {} | {} | {} |'.format(guid, module, service, address)
 
 
-def get_pp_guids():
+def open_pp_guids_log():
     log = open(LOG_FILE_PP_GUIDS, 'a')
     if os.path.getsize(LOG_FILE_PP_GUIDS) == 0:
         log.write(
             get_table_line('Guid', 'Module', 'Service', 'Address') + '\n')
         log.write(get_table_line('---', '---', '---', '---') + '\n')
+    return log
+
+
+def write_pp_guids(log, module, module_json):
+    for protocol_record in module_json['protocols']:
+        if (protocol_record['protocol_name'] == 'ProprietaryProtocol'):
+            guid = protocol_record['guid']
+            guid = guid.replace('L', '').replace("'", '')
+            service = protocol_record['service']
+            address = protocol_record['address']
+            log.write(get_table_line(guid, module, service, address) + '\n')
 
+
+def get_pp_guids(jobs=None, shards=1, reachable_only=False):
+    log = open_pp_guids_log()
     if not os.path.isdir(pe_dir):
         return False
-    files = os.listdir(pe_dir)
-    bar_template = click.style('%(label)s  %(bar)s | %(info)s', fg='cyan')
-    label = 'Modules analysis'
-    with click.progressbar(files,
-                           length=len(files),
-                           bar_template=bar_template,
-                           label=label,
-                           item_show_func=show_item) as bar:
-        for module in bar:
-            if module[-4:] in ['.idb', '.i64', '.id1', '.id2', '.nam', '.til']:
-                continue
-            module_path = os.path.join(pe_dir, module)
-            try:
-                analyser = Analyser(module_path)
-                analyser.get_boot_services()
-                analyser.get_protocols()
-                analyser.get_prot_names()
-                for protocol_record in analyser.Protocols['all']:
-                    if (protocol_record['protocol_name'] ==
-                            'ProprietaryProtocol'):
-                        guid = analyser.get_guid_str(protocol_record['guid'])
-                        guid = guid.replace('L', '').replace("'", '')
-                        service = protocol_record['service']
-                        address = '{addr:#x}'.format(
-                            addr=protocol_record['address'])
-                        log.write(
-                            get_table_line(guid, module, service, address) +
-                            '\n')
-            except:
-                continue
+    for module, (module_json, error) in analyse_modules(
+            jobs, shards, reachable_only):
+        if error is not None:
+            continue
+        write_pp_guids(log, module, module_json)
     log.close()
 
 
-def get_pp_guids_num():
+def get_pp_guids_num(jobs=None, shards=1, reachable_only=False):
     full_guids_num = 0
     pp_guids_num = 0
     if os.path.isdir(pe_dir) == 0:
         return False
-    files = os.listdir(pe_dir)
-    bar_template = click.style('%(label)s  %(bar)s | %(info)s', fg='cyan')
-    label = 'Modules analysis'
-    with click.progressbar(files,
-                           length=len(files),
-                           bar_template=bar_template,
-                           label=label,
-                           item_show_func=show_item) as bar:
-        for module in bar:
-            if module[-4:] in ['.idb', '.i64', '.id1', '.id2', '.nam', '.til']:
-                continue
-            module_path = pe_dir + os.sep + module
-            try:
-                analyser = Analyser(module_path)
-                analyser.get_boot_services()
-                analyser.get_protocols()
-                analyser.get_prot_names()
-                full_guids_num += len(analyser.Protocols['all'])
-                pp_guids_num += len(analyser.Protocols['prop_guids'])
-            except:
-                continue
+    for module, (module_json, error) in analyse_modules(
+            jobs, shards, reachable_only):
+        if error is not None:
+            continue
+        full_guids_num += len(module_json['protocols'])
+        pp_guids_num += len([
+            protocol_record for protocol_record in module_json['protocols']
+            if protocol_record['protocol_name'] == 'ProprietaryProtocol'
+        ])
     print('\t [number of proprietary protocols] {0}'.format(pp_guids_num))
     print('\t [full number of protocols] {0}'.format(full_guids_num))
 
@@ -201,6 +298,171 @@ def clear_all():
         print('Error while cleaning directories: {desc}'.format(desc=e))
 
 
+def get_tcp_address(address):
+    '''
+    get (host, port) of daemon TCP address (None for Unix socket path),
+    only loopback hosts are accepted, because clients choose the files
+    the daemon reads and writes
+    '''
+    host, _, port = address.rpartition(':')
+    if not port.isdigit() and hasattr(socket, 'AF_UNIX'):
+        return None
+    if not port.isdigit():
+        raise ValueError('port is required: {}'.format(address))
+    host = host.strip('[]') or 'localhost'
+    if host != 'localhost':
+        try:
+            loopback = ipaddress.ip_address(host).is_loopback
+        except ValueError:
+            loopback = False
+        if not loopback:
+            raise ValueError('only localhost can be served: {}'.format(host))
+    return host, int(port)
+
+
+class AnalysisHandler(socketserver.StreamRequestHandler):
+    '''
+    read JSON requests line by line and stream JSON results back
+    '''
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line.decode())
+                firmware_path = request['firmware_path']
+            except (ValueError, KeyError, TypeError) as e:
+                self.send({'error': 'invalid request: {}'.format(e)})
+                continue
+            self.server.run_job(firmware_path, request.get('reports', ['all']),
+                                request.get('db'), self.send)
+
+    def send(self, message):
+        self.wfile.write((json.dumps(message) + '\n').encode())
+        self.wfile.flush()
+
+
+class AnalysisServer():
+    '''
+    analysis daemon, the GUID index and the pool of preloaded worker
+    processes are kept between jobs, jobs are run one by one (they share
+    the modules directory)
+    '''
+
+    def __init__(self, address, jobs=None, shards=1, reachable_only=False):
+        self.jobs = jobs
+        self.shards = shards
+        self.reachable_only = reachable_only
+        self.guid_index = protocol_names.get_guid_index()
+        self.executor = self.get_executor()
+        tcp_address = get_tcp_address(address)
+        if tcp_address is not None:
+            self.server = socketserver.TCPServer(tcp_address, AnalysisHandler)
+        else:
+            if os.path.exists(address):
+                os.remove(address)
+            self.server = socketserver.UnixStreamServer(
+                address, AnalysisHandler)
+        self.server.run_job = self.run_job
+
+    def get_executor(self):
+        worker = partial(analyse_module,
+                         shards=self.shards,
+                         reachable_only=self.reachable_only)
+        return scheduler.get_executor(worker, self.jobs or os.cpu_count())
+
+    def run_job(self, firmware_path, reports, db_path, send):
+        '''
+        analyse firmware and send each module result as it is completed,
+        `reports` are the logs written as in --all and --pp_guids modes,
+        job failures are sent to the client as errors, the last message
+        is sent after the modules directory is cleared
+        '''
+        try:
+            message = self.analyse(firmware_path, reports, db_path, send)
+        except BrokenProcessPool as e:
+            # the pool is unusable after a worker crash, so it is replaced
+            self.executor.shutdown()
+            self.executor = self.get_executor()
+            message = {'error': 'worker crashed: {}'.format(e)}
+        except Exception as e:
+            message = {'error': 'job failed: {}'.format(repr(e))}
+        finally:
+            clear_all()
+        send(message)
+
+    def analyse(self, firmware_path, reports, db_path, send):
+        '''
+        send module results, the last message is returned
+        '''
+        if not os.path.isfile(firmware_path):
+            return {'error': 'no such file: {}'.format(firmware_path)}
+        clear_all()
+        try:
+            get_efi_images(firmware_path)
+        except SystemExit:
+            return {'error': 'unsupported firmware: {}'.format(firmware_path)}
+        log_all, log_pp_guids, db, firmware_id = None, None, None, None
+        full_guids_num, pp_guids_num, errors_num = 0, 0, 0
+        try:
+            if db_path:
+                db = ResultDB(db_path)
+                firmware_id = db.add_firmware(firmware_path)
+            if 'all' in reports:
+                log_all = open(LOG_FILE_ALL, 'a')
+            if 'pp_guids' in reports:
+                log_pp_guids = open_pp_guids_log()
+            for module, (module_json, error) in analyse_modules(
+                    self.jobs, self.shards, self.reachable_only,
+                    self.guid_index, self.executor):
+                send({'module': module, 'error': error, 'result': module_json})
+                if log_all is not None:
+                    write_module(log_all, module, module_json, error)
+                if error is not None:
+                    errors_num += 1
+                    continue
+                if log_pp_guids is not None:
+                    write_pp_guids(log_pp_guids, module, module_json)
+                if db is not None:
+                    db.add_module(firmware_id, module_json,
+                                  get_sha256(os.path.join(pe_dir, module)))
+                full_guids_num += len(module_json['protocols'])
+                pp_guids_num += len([
+                    protocol_record
+                    for protocol_record in module_json['protocols'] if
+                    protocol_record['protocol_name'] == 'ProprietaryProtocol'
+                ])
+        finally:
+            for log in [log_all, log_pp_guids]:
+                if log is not None:
+                    log.close()
+            if db is not None:
+                if firmware_id is not None:
+                    db.add_dependencies(firmware_id)
+                db.close()
+        return {
+            'done': firmware_path,
+            'pp_guids_num': pp_guids_num,
+            'full_guids_num': full_guids_num,
+            'errors_num': errors_num
+        }
+
+    def serve_forever(self):
+        print('[*] Waiting for jobs on {}'.format(self.server.server_address))
+        # socket is removed on `kill` too
+        signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+        try:
+            self.server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.executor.shutdown()
+            self.server.server_close()
+            if isinstance(self.server, socketserver.UnixStreamServer):
+                os.remove(self.server.server_address)
+
+
 def main():
     click.echo(click.style('UEFI_RETool', fg='cyan'))
     click.echo(
@@ -210,6 +472,7 @@ def main():
     parser = argparse.ArgumentParser(prog=program)
     parser.add_argument('firmware_path',
                         type=str,
+                        nargs='?',
                         help='path to UEFI firmware for analysis')
     parser.add_argument('--all',
                         action='store_true',
@@ -236,14 +499,92 @@ def main():
 		(images are stored in .{sep}modules directory, 
 		example: python analyse_fw_r2.py --get_efi_images <firmware_path>)'''.format(
                             sep=os.sep))
+    parser.add_argument('--db',
+                        type=str,
+                        metavar='DB_PATH',
+                        help='''also store the results of --all analysis
+		in SQLite database (example: python analyse_fw_r2.py --all
+		--db results.db <firmware_path>)''')
+    parser.add_argument('--jobs',
+                        type=int,
+                        help='''number of modules analysed in parallel
+		(default: number of CPUs)''')
+    parser.add_argument('--shards',
+                        type=int,
+                        default=1,
+                        help='''number of r2 sessions analysing functions
+		of one large module in parallel, used with r2 projects
+		(default: 1)''')
+    parser.add_argument('--reachable_only',
+                        action='store_true',
+                        help='''scan only functions reachable from
+		the module entry point and from registered callbacks''')
+    parser.add_argument('--serve',
+                        type=str,
+                        metavar='ADDRESS',
+                        help='''run analysis daemon on Unix socket path
+		or localhost port (example: python analyse_fw_r2.py
+		--serve /tmp/uefi_retool.sock, jobs are sent with
+		python -m tools.analysis_client)''')
+    parser.add_argument('--metrics_file',
+                        type=str,
+                        metavar='PATH',
+                        help='''rewrite Prometheus metrics of the run
+		to file periodically (for node_exporter textfile collector)''')
+    parser.add_argument('--metrics_port',
+                        type=int,
+                        metavar='PORT',
+                        help='''serve Prometheus/OpenMetrics metrics
+		on http://localhost:PORT/metrics''')
+    parser.add_argument('--profile',
+                        type=str,
+                        metavar='DIR',
+                        help='''save cProfile stats and collapsed stacks
+		of analysis phases and of each module to DIR and print time
+		spent in Python code and in r2''')
 
     args = parser.parse_args()
 
+    if args.serve is None and args.firmware_path is None:
+        parser.error('firmware_path is required')
+    if args.serve is not None:
+        try:
+            get_tcp_address(args.serve)
+        except ValueError as e:
+            parser.error(str(e))
+    if args.profile:
+        profiler.enable(args.profile)
+    # forkserver keeps the first preload list, so modules of volume and
+    # analysis workers are set before the first pool is created
+    scheduler.preload([dump_volume, analyse_module])
+    exporter = metrics.Exporter(args.metrics_file, args.metrics_port)
+    try:
+        run(args)
+    finally:
+        exporter.close()
+        if args.profile:
+            profiler.print_breakdown(args.profile)
+
+
+def run(args):
+    if args.serve:
+        AnalysisServer(args.serve, args.jobs, args.shards,
+                       args.reachable_only).serve_forever()
+        return
+
     if (args.all and os.path.isfile(args.firmware_path)):
         clear_all()
         get_efi_images(args.firmware_path)
         # log all information
-        analyse_all()
+        if args.db:
+            db = ResultDB(args.db)
+            analyse_all(db, db.add_firmware(args.firmware_path), args.jobs,
+                        args.shards, args.reachable_only)
+            db.close()
+        else:
+            analyse_all(jobs=args.jobs,
+                        shards=args.shards,
+                        reachable_only=args.reachable_only)
         time.sleep(2)
         clear_all()
 
@@ -251,7 +592,7 @@ def main():
         clear_all()
         get_efi_images(args.firmware_path)
         # log proprietary protocols list
-        get_pp_guids()
+        get_pp_guids(args.jobs, args.shards, args.reachable_only)
         time.sleep(2)
         clear_all()
 
@@ -259,7 +600,7 @@ def main():
         clear_all()
         get_efi_images(args.firmware_path)
         # print number of proprietary protocols
-        get_pp_guids_num()
+        get_pp_guids_num(args.jobs, args.shards, args.reachable_only)
         time.sleep(2)
         clear_all()
 
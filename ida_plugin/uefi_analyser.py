@@ -75,7 +75,7 @@ class UefiAnalyserPlugin(idaapi.plugin_t):
         try:
             filename, _ = file_dialog.getOpenFileName(
                 file_dialog, 'Select the {} log file'.format(NAME),
-                self._last_directory, 'Results files (*.json)')
+                self._last_directory, 'Results files (*.json *.db *.sqlite)')
         except Exception as e:
             print('[{} error] {}'.format(NAME, str(e)))
         if filename:
@@ -21,6 +21,7 @@
 # SOFTWARE.
 
 import json
+import re
 
 # pylint: disable=import-error
 import ida_bytes
@@ -31,10 +32,14 @@ import idc
 
 from .guids import (ami_guids, asrock_guids, dell_guids, edk2_guids, edk_guids,
                     lenovo_guids)
-from .tables import BOOT_SERVICES_OFFSET_x64, BOOT_SERVICES_OFFSET_x86
+from .tables import (ARG_REGS_x64, BOOT_SERVICES_OFFSET_x64,
+                     BOOT_SERVICES_OFFSET_x86, GUID_ARG, VOLATILE_REGS_x64)
 from .utils import (Table, check_guid, check_subsystem, get_guid, get_guid_str,
                     get_header_file, get_header_idb, get_machine_type)
 
+# maximal number of wrappers between GUID and boot service call
+WRAPPER_DEPTH = 3
+
 
 class Analyser():
     def __init__(self):
@@ -86,6 +91,9 @@ class Analyser():
         self.Protocols['prop_guids'] = []
         self.Protocols['data'] = []
 
+        # function start -> [(argument index, service)]
+        self.summaries = {}
+
     def _find_est(self, gvar, start, end):
         RAX = 0
         BS_OFFSET = 0x60
@@ -122,10 +130,28 @@ class Analyser():
                         self.gBServices[service_name].append(ea)
             ea = idc.next_head(ea)
 
+    def get_guid_records(self, ea, service_name):
+        '''
+        get protocol records from GUIDs referenced by instruction
+        '''
+        records = []
+        for xref in idautils.DataRefsFrom(ea):
+            if idc.print_insn_mnem(xref):
+                continue
+            if not check_guid(xref):
+                continue
+            records.append({
+                'address': xref,
+                'service': service_name,
+                'guid': get_guid(xref),
+            })
+        return records
+
     def get_protocols(self):
         '''
         found UEFI protocols information in idb
         '''
+        unresolved = []
         for service_name in self.gBServices:
             for address in self.gBServices[service_name]:
                 ea, found = address, False
@@ -143,21 +169,111 @@ class Analyser():
                                 and idc.print_insn_mnem(ea) == 'lea'):
                             found = True
                             break
-                if not found:
-                    continue
-                for xref in idautils.DataRefsFrom(ea):
-                    if idc.print_insn_mnem(xref):
-                        continue
-                    if not check_guid(xref):
-                        continue
-                    cur_guid = get_guid(xref)
-                    record = {
-                        'address': xref,
-                        'service': service_name,
-                        'guid': cur_guid,
-                    }
+                records = []
+                if found:
+                    records = self.get_guid_records(ea, service_name)
+                if not len(records):
+                    unresolved.append((service_name, address))
+                for record in records:
                     if not self.Protocols['all'].count(record):
                         self.Protocols['all'].append(record)
+        if self.arch != 'x64':
+            return
+        for record in self.get_wrapper_protocols(unresolved):
+            if not self.Protocols['all'].count(record):
+                self.Protocols['all'].append(record)
+
+    @staticmethod
+    def get_reg(operand):
+        '''
+        get 64-bit register name from operand (None if operand is not
+        a general purpose register)
+        '''
+        operand = operand.strip()
+        if re.match(r'^r(8|9|1[0-5])[dwb]?$', operand):
+            return re.sub(r'[dwb]$', '', operand)
+        match = re.match(r'^[re]?([abcd])[xlh]$', operand)
+        if match:
+            return 'r{}x'.format(match.group(1))
+        match = re.match(r'^[re]?(si|di|bp|sp)l?$', operand)
+        if match:
+            return 'r{}'.format(match.group(1))
+        return None
+
+    def trace_arg(self, ea, reg):
+        '''
+        follow register moves back from instruction to the function start,
+        ('ptr', lea address) is returned for lea of GUID,
+        ('arg', argument index) for function argument and (None, None)
+        if the value is unknown
+        '''
+        start = idc.get_func_attr(ea, idc.FUNCATTR_START)
+        if start == idaapi.BADADDR:
+            return None, None
+        while True:
+            ea = idc.prev_head(ea, start)
+            if ea == idaapi.BADADDR:
+                break
+            mnem = idc.print_insn_mnem(ea)
+            if mnem == 'call' and reg in VOLATILE_REGS_x64:
+                return None, None
+            if (mnem in ['cmp', 'test', 'push']
+                    or idc.get_operand_type(ea, 0) != idc.o_reg
+                    or self.get_reg(idc.print_operand(ea, 0)) != reg):
+                continue
+            if mnem == 'lea':
+                return 'ptr', ea
+            if mnem == 'mov' and idc.get_operand_type(ea, 1) == idc.o_reg:
+                reg = self.get_reg(idc.print_operand(ea, 1))
+                continue
+            return None, None
+        if reg in ARG_REGS_x64:
+            return 'arg', ARG_REGS_x64.index(reg)
+        return None, None
+
+    def get_wrapper_protocols(self, unresolved):
+        '''
+        find protocols with GUIDs passed through wrappers of boot services,
+        summaries like "argument N flows to GUID parameter of service S"
+        are computed once for each wrapper and applied to its call sites
+        '''
+        records = []
+        queue = []
+        for service_name, address in unresolved:
+            if not service_name in GUID_ARG:
+                continue
+            func = idc.get_func_attr(address, idc.FUNCATTR_START)
+            if func == idaapi.BADADDR:
+                continue
+            kind, value = self.trace_arg(
+                address, ARG_REGS_x64[GUID_ARG[service_name]])
+            if kind != 'arg':
+                continue
+            summary = self.summaries.setdefault(func, [])
+            if not (value, service_name) in summary:
+                summary.append((value, service_name))
+                queue.append((func, 0))
+        while queue:
+            func, depth = queue.pop(0)
+            for xref in idautils.CodeRefsTo(func, 0):
+                if idc.print_insn_mnem(xref) != 'call':
+                    continue
+                caller = idc.get_func_attr(xref, idc.FUNCATTR_START)
+                if caller == idaapi.BADADDR:
+                    continue
+                for arg, service_name in list(self.summaries[func]):
+                    kind, value = self.trace_arg(xref, ARG_REGS_x64[arg])
+                    if kind == 'ptr':
+                        for record in self.get_guid_records(
+                                value, service_name):
+                            if not records.count(record):
+                                records.append(record)
+                    if kind == 'arg' and depth + 1 < WRAPPER_DEPTH:
+                        summary = self.summaries.setdefault(caller, [])
+                        if not (value, service_name) in summary:
+                            summary.append((value, service_name))
+                            queue.append((caller, depth + 1))
+        return records
 
     def get_prot_names(self):
         '''
@@ -29,7 +29,8 @@ import idautils
 import idc
 from idaapi import Choose
 
-from .utils import get_dep_json
+from .results import get_dep_index
+from .utils import get_dep_json, load_res_json
 
 NAME = 'UEFI_RETool'
 
@@ -54,7 +55,7 @@ class ProtsWindow(Choose):
     '''
     class to display protocols information output window
     '''
-    def __init__(self, title, dep_json, nb=5):
+    def __init__(self, title, dep_json, dep_index, nb=5):
         sizes = self._get_sizes(dep_json)
         # yapf: disable
         Choose.__init__(
@@ -77,6 +78,7 @@ class ProtsWindow(Choose):
         self.modal = False
         self.popup_names = []
         self.dep_json = dep_json
+        self.dep_index = dep_index
 
     def _get_sizes(self, data):
         '''
@@ -104,6 +106,7 @@ class ProtsWindow(Choose):
         to fill line in the table
         '''
         lines = []
+        added = set()
         for elem in dep_json:
             item = [
                 elem['guid'],
@@ -111,7 +114,8 @@ class ProtsWindow(Choose):
                 elem['module_name'],
                 elem['service']
             ]
-            if not lines.count(item):
+            if tuple(item) not in added:
+                added.add(tuple(item))
                 lines.append(item)
         return lines
 
@@ -153,10 +157,11 @@ class ProtsWindow(Choose):
         self.selcount += 1
         guid = self.items[n][0]
         print('[{}] {} protocol information'.format(NAME, self.items[n][1]))
-        for protocol in self.dep_json:
-            if protocol['guid'] == guid:
-                print(json.dumps(protocol, indent=4))
-                break
+        if guid in self.dep_index['installers']:
+            protocol = dict(self.dep_index['installers'][guid][0])
+            protocol['used_by'] = list(self.dep_index['consumers'].get(
+                guid, []))
+            print(json.dumps(protocol, indent=4))
         return n
 
     def OnDeleteLine(self, n):
@@ -177,15 +182,20 @@ class ProtsWindow(Choose):
 
 
 def handle_json(res_json):
-    dep_json = get_dep_json(res_json)
-    wind = ProtsWindow('{} dependency browser'.format(NAME), dep_json, nb=10)
+    dep_index = get_dep_index(res_json)
+    dep_json = get_dep_json(res_json, dep_index)
+    wind = ProtsWindow('{} dependency browser'.format(NAME),
+                       dep_json,
+                       dep_index,
+                       nb=10)
     wind.show()
 
 
 def run(log_file):
     try:
-        with open(log_file, 'rb') as f:
-            res_json = json.load(f)
+        res_json = load_res_json(log_file)
+        if res_json is None:
+            return False
         handle_json(res_json)
     except Exception as e:
         print('[{} error] {}'.format(NAME, repr(e)))
@@ -20,8 +20,8 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-import json
 import os
+import threading
 
 # pylint: disable=import-error
 import ida_funcs
@@ -31,11 +31,16 @@ import ida_kernwin
 import ida_ua
 import idautils
 
-from .utils import get_dep_json
+from .utils import ask_firmware, get_dep_json, load_res_json
 
 NAME = 'UEFI_RETool'
 DEP_GRAPH = None
 
+# logs with more modules are displayed in focused mode
+FOCUS_THRESHOLD = 150
+FOCUS_HOPS = 1
+PROGRESS_STEP = 500
+
 DEBUG = True
 
 
@@ -79,12 +84,71 @@ class SelectionPrinter(_base_graph_action_handler_t):
         return 1
 
 
+class GraphData():
+    '''
+    indexes to build dependency graph
+    '''
+    def __init__(self):
+        # unique (installer, consumer) pairs
+        self.pairs = []
+        # installer -> consumers
+        self.successors = {}
+        # module -> adjacent modules (in both directions)
+        self.neighbours = {}
+        # GUID -> installers and consumers
+        self.guid_modules = {}
+
+
+def get_graph_data(dep_json, progress=None):
+    '''
+    get dependency graph indexes from dependency json
+    '''
+    data = GraphData()
+    added = set()
+    for index, mod in enumerate(dep_json):
+        if progress is not None and not index % PROGRESS_STEP:
+            progress(index, len(dep_json))
+        guid_modules = data.guid_modules.setdefault(mod['guid'], set())
+        guid_modules.add(mod['module_name'])
+        for ub_mod in mod['used_by']:
+            guid_modules.add(ub_mod)
+            pair = (mod['module_name'], ub_mod)
+            if pair in added:
+                continue
+            added.add(pair)
+            data.pairs.append(pair)
+            data.successors.setdefault(pair[0], []).append(pair[1])
+            data.neighbours.setdefault(pair[0], set()).add(pair[1])
+            data.neighbours.setdefault(pair[1], set()).add(pair[0])
+    return data
+
+
+def get_neighbourhood(data, seeds, hops):
+    '''
+    get modules located no further than hops edges from seeds
+    '''
+    visible = set(seeds)
+    frontier = set(seeds)
+    for _ in range(hops):
+        next_frontier = set()
+        for module in frontier:
+            next_frontier |= data.neighbours.get(module, set())
+        frontier = next_frontier - visible
+        visible |= frontier
+    return visible
+
+
 class DependencyGraph(ida_graph.GraphViewer):
-    def __init__(self, dep_json):
+    '''
+    if visible set is specified, only the neighbourhood of the selected
+    modules is displayed, double-click on a node adds its neighbours
+    '''
+    def __init__(self, graph_data, visible=None):
         self.title = '{} dependency graph'.format(NAME)
         ida_graph.GraphViewer.__init__(self, self.title)
-        self.dep_json = dep_json
-        self.pairs = self._get_all_pairs()
+        self.graph_data = graph_data
+        self.visible = visible
+        self.nodes = {}
         self.color = 0x555555
 
         class my_view_hooks_t(ida_kernwin.View_Hooks):
@@ -105,29 +169,44 @@ class DependencyGraph(ida_graph.GraphViewer):
 
         self.my_view_hooks = my_view_hooks_t(self)
 
+    def _get_node(self, module):
+        if module not in self.nodes:
+            self.nodes[module] = self.AddNode((module, self.color))
+        return self.nodes[module]
+
     def OnRefresh(self):
         self.Clear()
-        saved_nodes = []
-        for pair in self.pairs:
-            output_node = None
-            input_node = None
-            for saved_node in saved_nodes:
-                if pair[0] == saved_node[0]:
-                    output_node = saved_node[1]
-                if pair[1] == saved_node[0]:
-                    input_node = saved_node[1]
-            if output_node is None:
-                output_node = self.AddNode((pair[0], self.color))
-                saved_nodes.append((pair[0], output_node))
-            if pair[0] == pair[1]:
-                # Handle the reflexive case, e.g. (x, x)
-                input_node = output_node
-            if input_node is None:
-                input_node = self.AddNode((pair[1], self.color))
-                saved_nodes.append((pair[1], input_node))
+        self.nodes = {}
+        if self.visible is None:
+            pairs = self.graph_data.pairs
+        else:
+            pairs = []
+            for module in sorted(self.visible):
+                self._get_node(module)
+                for ub_mod in self.graph_data.successors.get(module, []):
+                    if ub_mod in self.visible:
+                        pairs.append((module, ub_mod))
+        for pair in pairs:
+            # the reflexive case, e.g. (x, x), gets the same node
+            output_node = self._get_node(pair[0])
+            input_node = self._get_node(pair[1])
             self.AddEdge(output_node, input_node)
         return True
 
+    def OnDblClick(self, node_id):
+        if self.visible is None:
+            return True
+        module = self[node_id][0]
+        new_modules = self.graph_data.neighbours.get(module,
+                                                     set()) - self.visible
+        if DEBUG:
+            print('[{}] {} expanded with {} modules'.format(
+                NAME, module, len(new_modules)))
+        if len(new_modules):
+            self.visible |= new_modules
+            self.Refresh()
+        return True
+
     def OnGetText(self, node_id):
         return self[node_id]
 
@@ -150,37 +229,88 @@ class DependencyGraph(ida_graph.GraphViewer):
             actname, 'Print selection: {}'.format(self.title), SelectionPrinter(self))
         ida_kernwin.attach_dynamic_action_to_popup(form, popup_handle, desc)
 
-    def _get_all_pairs(self):
-        pairs = []
-        for mod in self.dep_json:
-            for ub_mod in mod['used_by']:
-                pairs.append((mod['module_name'], ub_mod))
-        return pairs
 
-
-def run(json_file):
+def _show(graph_data, visible):
     global DEP_GRAPH
-    if DEP_GRAPH:
-        DEP_GRAPH.Close()
+    g = DependencyGraph(graph_data, visible)
+    DEP_GRAPH = g
+    if g.Show() and DEBUG:
+        print('[{}] graph created and displayed'.format(NAME))
+    # do not repeat the request
+    return False
+
+
+def _call_sync(func, *args):
+    '''
+    call function from background thread in the main thread and get
+    its result (IDA API, output window included, is not thread-safe)
+    '''
+    result = []
+
+    def request():
+        result.append(func(*args))
+        return 0
+
+    ida_kernwin.execute_sync(request, ida_kernwin.MFF_FAST)
+    return result[0]
+
+
+def _print_sync(message):
+    _call_sync(print, message)
+
+
+def _build(json_file, focus):
+    '''
+    load results and build graph indexes outside the UI thread,
+    for large logs only the neighbourhood of the module (or GUID)
+    is displayed
+    '''
+    def progress(index, total):
+        _print_sync('[{}] building dependency graph: {}/{} protocols'.format(
+            NAME, index, total))
+
+    def select_firmware(firmwares):
+        return _call_sync(ask_firmware, firmwares)
+
     try:
-        with open(json_file, 'r') as f:
-            res_json = json.load(f)
+        res_json = load_res_json(json_file, select_firmware)
+        if res_json is None:
+            return
+        if focus is None and len(res_json) > FOCUS_THRESHOLD:
+            focus = _call_sync(
+                ida_kernwin.ask_str, '', 0,
+                'Module name or GUID to display (empty for full graph)')
         dep_json = get_dep_json(res_json)
-        g = DependencyGraph(dep_json)
-        DEP_GRAPH = g
-        if g.Show():
-            return g
+        graph_data = get_graph_data(dep_json, progress)
+        visible = None
+        if focus:
+            seeds = graph_data.guid_modules.get(focus.upper())
+            if seeds is None:
+                seeds = [focus]
+            visible = get_neighbourhood(graph_data, seeds, FOCUS_HOPS)
+        ida_kernwin.execute_ui_requests([lambda: _show(graph_data, visible)])
     except Exception as e:
-        print('[{} error] {}'.format(NAME, repr(e)))
-    return False
+        _print_sync('[{} error] {}'.format(NAME, repr(e)))
+
+
+def run(json_file, focus=None):
+    '''
+    display dependency graph, the results are loaded in background thread
+    '''
+    global DEP_GRAPH
+    if DEP_GRAPH:
+        DEP_GRAPH.Close()
+        DEP_GRAPH = None
+    thread = threading.Thread(target=_build, args=(json_file, focus))
+    thread.daemon = True
+    thread.start()
+    return True
 
 
 def test():
     json_file = os.path.join(idautils.GetIdbDir().replace(
         'modules', 'log'), 'examples', 'ida_log_all_tpt480s.json')
-    g = run(json_file)
-    if g and DEBUG:
-        print('[{}] graph created and displayed'.format(NAME))
+    run(json_file)
 
 
 if __name__ == '__main__':
@@ -26,14 +26,19 @@ import os
 import idaapi
 import idc
 from uefi_analyser.analyser import Analyser
-from uefi_analyser.utils import get_guid_str
+from uefi_analyser.utils import get_guid_str, run_script, write_log
 
 LOG_FILE = os.path.join('..', 'log', 'ida_log_all.md')
+# module results are written at once (see write_log)
+log_lines = []
 
 
 def print_log(data):
-    with open(LOG_FILE, 'a') as log:
-        log.write(data + '\n')
+    log_lines.append(data + '\n')
+
+
+def flush_log():
+    write_log(LOG_FILE, log_lines)
 
 
 def list_boot_services(analyser):
@@ -51,7 +56,7 @@ def log_all():
     idc.auto_wait()
     analyser = Analyser()
     if not analyser.valid:
-        idc.qexit(-1)
+        return -1
     analyser.get_boot_services()
     print_log('## Module: ' + idaapi.get_root_filename())
     print_log('### Boot services:')
@@ -70,8 +75,10 @@ def log_all():
         print_log('\t - [protocol_name] ' + element['protocol_name'])
         print_log('\t - [protocol_place] ' + element['protocol_place'])
         print_log('\t - ' + guid_str)
-    idc.qexit(1)
+    flush_log()
+    return 1
 
 
 if __name__ == '__main__':
-    log_all()
+    # the profile is saved before IDA exits
+    idc.qexit(run_script(log_all))
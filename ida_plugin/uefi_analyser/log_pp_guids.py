@@ -27,14 +27,19 @@ import sys
 import idaapi
 import idc
 from uefi_analyser.analyser import Analyser
-from uefi_analyser.utils import get_guid_str
+from uefi_analyser.utils import get_guid_str, run_script, write_log
 
 LOG_FILE = os.path.join('..', 'log', 'ida_log_pp_guids.md')
+# module results are written at once (see write_log)
+log_lines = []
 
 
 def print_log(data):
-    with open(LOG_FILE, 'a') as log:
-        log.write(data + '\n')
+    log_lines.append(data + '\n')
+
+
+def flush_log():
+    write_log(LOG_FILE, log_lines)
 
 
 def get_table_line(guid, module, service, address):
@@ -48,7 +53,7 @@ def log_pp_guids():
     idc.auto_wait()
     analyser = Analyser()
     if not analyser.valid:
-        idc.qexit(-1)
+        return -1
     analyser.get_boot_services()
     analyser.get_protocols()
     analyser.get_prot_names()
@@ -59,8 +64,10 @@ def log_pp_guids():
             service = protocol_record['service']
             address = '{addr:#x}'.format(addr=protocol_record['address'])
             print_log(get_table_line(guid, module, service, address))
-    idc.qexit(1)
+    flush_log()
+    return 1
 
 
 if __name__ == '__main__':
-    log_pp_guids()
+    # the profile is saved before IDA exits
+    idc.qexit(run_script(log_pp_guids))
@@ -0,0 +1,103 @@
+# MIT License
+#
+# Copyright (c) 2018-2019 yeggor
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''
+analysis results processing without IDA API, shared by the plugin
+and by tools (see tools/utils.py and tools/result_db.py)
+'''
+
+INSTALL_PROTOCOL_SERVICES = ('InstallProtocolInterface',
+                             'InstallMultipleProtocolInterfaces')
+CLIENT_PROTOCOL_SERVICES = ('LocateProtocol', 'OpenProtocol', 'HandleProtocol')
+
+
+def get_res_json(conn, firmware_id=None):
+    '''
+    get analysis results in md_to_json format from SQLite database
+    connection (see tools/result_db.py), all firmwares by default
+    '''
+    modules = {}
+    firmware_filter, module_filter = '', ''
+    args = ()
+    if firmware_id is not None:
+        firmware_filter = ' WHERE firmware_id = ?'
+        module_filter = (' WHERE module_id IN '
+                         '(SELECT id FROM modules WHERE firmware_id = ?)')
+        args = (firmware_id, )
+    for module_id, name in conn.execute(
+            'SELECT id, name FROM modules{} ORDER BY id'.format(
+                firmware_filter), args):
+        modules[module_id] = {
+            'module_name': name,
+            'boot_services': [],
+            'protocols': []
+        }
+    for module_id, address, service in conn.execute(
+            'SELECT module_id, address, service FROM boot_services'
+            '{} ORDER BY rowid'.format(module_filter), args):
+        modules[module_id]['boot_services'].append({
+            'address': address,
+            'bs_name': service
+        })
+    for row in conn.execute(
+            'SELECT module_id, address, service, guid, protocol_name, '
+            'protocol_place FROM protocols{} ORDER BY rowid'.format(
+                module_filter), args):
+        modules[row[0]]['protocols'].append({
+            'address': row[1],
+            'service': row[2],
+            'protocol_name': row[4],
+            'protocol_place': row[5],
+            'guid': row[3]
+        })
+    return list(modules.values())
+
+
+def get_dep_index(res_json):
+    '''
+    get inverted indexes for dependency browser and dependency graph:
+    GUID -> installed protocols records and GUID -> consumer modules
+    '''
+    installed = []
+    installers = {}
+    consumers = {}
+    for module_info in res_json:
+        module_name = module_info['module_name']
+        for protocol in module_info['protocols']:
+            guid = protocol['guid']
+            if protocol['service'] in INSTALL_PROTOCOL_SERVICES:
+                record = {
+                    'module_name': module_name,
+                    'protocol_name': protocol['protocol_name'],
+                    'guid': guid,
+                    'service': protocol['service']
+                }
+                installed.append(record)
+                installers.setdefault(guid, []).append(record)
+            if protocol['service'] in CLIENT_PROTOCOL_SERVICES:
+                # dict is used as ordered set of module names
+                consumers.setdefault(guid, dict())[module_name] = None
+    return {
+        'installed': installed,
+        'installers': installers,
+        'consumers': consumers
+    }
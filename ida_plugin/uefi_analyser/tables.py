@@ -67,3 +67,21 @@ SMM_SERVICES_OFFSET_x86 = {
     'SmmRegisterProtocolNotify': 0x6C,
     'SmmLocateProtocol': 0x74
 }
+
+# index of GUID parameter of boot services
+GUID_ARG = {
+    'InstallProtocolInterface': 1,
+    'ReinstallProtocolInterface': 1,
+    'UninstallProtocolInterface': 1,
+    'HandleProtocol': 1,
+    'RegisterProtocolNotify': 0,
+    'OpenProtocol': 1,
+    'CloseProtocol': 1,
+    'OpenProtocolInformation': 1,
+    'LocateHandleBuffer': 1,
+    'LocateProtocol': 0
+}
+
+# x64 calling convention
+ARG_REGS_x64 = ['rcx', 'rdx', 'r8', 'r9']
+VOLATILE_REGS_x64 = ARG_REGS_x64 + ['rax', 'r10', 'r11']
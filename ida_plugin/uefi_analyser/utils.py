@@ -20,13 +20,18 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import cProfile
+import json
 import os
+import sqlite3
 
 # pylint: disable=import-error
 import ida_bytes
 import idaapi
 import idautils
 import idc
+
+from .results import get_dep_index, get_res_json
 '''
 definitions from PE file structure
 '''
@@ -36,6 +41,16 @@ PE_OFFSET = 0x3c
 IMAGE_SUBSYSTEM_EFI_APPLICATION = 0xa
 IMAGE_SUBSYSTEM_EFI_BOOT_SERVICE_DRIVER = 0xb
 IMAGE_SUBSYSTEM_EFI_RUNTIME_DRIVER = 0xc
+'''
+batch scripts are profiled to this directory (see --profile option
+of analyse_fw_ida.py)
+'''
+PROFILE_ENV = 'UEFI_RETOOL_PROFILE_DIR'
+'''
+parallel batch scripts write module logs to this directory, the logs
+are joined by analyse_fw_ida.py
+'''
+LOG_PARTS_ENV = 'UEFI_RETOOL_LOG_PARTS_DIR'
 
 
 class Table():
@@ -80,6 +95,38 @@ class Table():
         return table
 
 
+def run_script(func):
+    '''
+    run batch script function and get its exit status, the function
+    is profiled if profile directory is set in environment
+    '''
+    profile_dir = os.environ.get(PROFILE_ENV)
+    if not profile_dir:
+        return func()
+    profile = cProfile.Profile()
+    try:
+        return profile.runcall(func)
+    finally:
+        # parallel IDA instances create the directory at once
+        os.makedirs(profile_dir, exist_ok=True)
+        profile.dump_stats(
+            os.path.join(profile_dir,
+                         idaapi.get_root_filename() + '.prof'))
+
+
+def write_log(log_file, lines):
+    '''
+    write log lines of the module to its own file in parts directory
+    if it is set in environment, otherwise append them to log file
+    '''
+    parts_dir = os.environ.get(LOG_PARTS_ENV)
+    if parts_dir:
+        log_file = os.path.join(parts_dir,
+                                idaapi.get_root_filename() + '.md')
+    with open(log_file, 'a') as log:
+        log.write(''.join(lines))
+
+
 def set_hexrays_comment(address, text):
     '''
     set comment in decompiled code
@@ -200,30 +247,69 @@ def get_header_file():
     return bytearray(buf)
 
 
-def get_dep_json(res_json):
+def ask_firmware(firmwares):
     '''
-    get json for dependency browser and dependency graph
+    ask user for firmware ID or SHA256 from (id, name, sha256) rows,
+    the last analysed firmware is offered by default
     '''
-    CLIENT_PROTOCOL_SERVICES = ('LocateProtocol', 'OpenProtocol')
+    for row in firmwares:
+        print('[{}] {} ({})'.format(*row))
+    return idaapi.ask_str(str(firmwares[0][0]), 0, 'Firmware ID or SHA256')
+
 
+def get_res_json_db(db_path, select_firmware=ask_firmware):
+    '''
+    get analysis results from SQLite database (see tools/result_db.py),
+    the last analysed firmware is used by default, None is returned
+    if firmware selection is cancelled
+    '''
+    conn = sqlite3.connect(db_path)
+    try:
+        firmwares = conn.execute(
+            'SELECT id, name, sha256 FROM firmwares ORDER BY id DESC'
+        ).fetchall()
+        if not len(firmwares):
+            return []
+        firmware_id = firmwares[0][0]
+        if len(firmwares) > 1:
+            answer = select_firmware(firmwares)
+            if answer is None:
+                return None
+            answer = answer.strip().lower()
+            ids = [
+                row[0] for row in firmwares
+                if str(row[0]) == answer or row[2] == answer
+            ]
+            if not len(ids):
+                print('[error] no such firmware: {}'.format(answer))
+                return None
+            firmware_id = ids[0]
+        return get_res_json(conn, firmware_id)
+    finally:
+        conn.close()
+
+
+def load_res_json(log_file, select_firmware=ask_firmware):
+    '''
+    load analysis results from JSON log or from SQLite database
+    (None if firmware selection is cancelled)
+    '''
+    if os.path.splitext(log_file)[1] in ('.db', '.sqlite'):
+        return get_res_json_db(log_file, select_firmware)
+    with open(log_file, 'rb') as f:
+        return json.load(f)
+
+
+def get_dep_json(res_json, dep_index=None):
+    '''
+    get json for dependency browser and dependency graph
+    '''
+    if dep_index is None:
+        dep_index = get_dep_index(res_json)
     dep_json = []
-    for module_info in res_json:
-        for protocol in module_info['protocols']:
-            if (protocol['service'] == 'InstallProtocolInterface' or
-                protocol['service'] == 'InstallMultipleProtocolInterfaces'
-                ):
-                dep_json_item = {
-                    'module_name': module_info['module_name'],
-                    'protocol_name': protocol['protocol_name'],
-                    'guid': protocol['guid'],
-                    'service': protocol['service']
-                }
-                dep_json_item['used_by'] = []
-                for module_info in res_json:
-                    for protocol in module_info['protocols']:
-                        if (protocol['service'] in CLIENT_PROTOCOL_SERVICES
-                                and protocol['guid'] == dep_json_item['guid']):
-                            dep_json_item['used_by'].append(
-                                module_info['module_name'])
-                dep_json.append(dep_json_item)
+    for record in dep_index['installed']:
+        dep_json_item = dict(record)
+        dep_json_item['used_by'] = list(dep_index['consumers'].get(
+            record['guid'], []))
+        dep_json.append(dep_json_item)
     return dep_json
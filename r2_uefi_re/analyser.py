@@ -21,19 +21,33 @@
 # SOFTWARE.
 
 import argparse
+import bisect
+import hashlib
 import json
 import os
+import re
+import shutil
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
 import click
 import r2pipe
 from terminaltables import SingleTable
 
-from .guids import (ami_guids, asrock_guids, dell_guids, edk2_guids, edk_guids,
-                    lenovo_guids)
+from .fingerprints import (FINGERPRINTS_DB, FingerprintIndex, get_fingerprint,
+                           get_rip_target)
 
 MIN_SET_LEN = 5
 
+# modules with fewer functions are not split between r2 sessions
+SHARD_MIN_FUNCS = 1000
+
+# r2 projects with analysis results, keyed by module hash
+PROJECTS_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'uefi_retool',
+                            'r2_projects')
+# file in project directory, projects without it are not loaded
+PROJECT_MARK = 'uefi_retool.complete'
+
 OFFSET_x64 = {
     'InstallProtocolInterface': 0x80,
     'ReinstallProtocolInterface': 0x88,
@@ -63,13 +77,85 @@ LEA_NUM = {
     'LocateProtocol': 1
 }
 
+# index of GUID parameter of boot services
+GUID_ARG = {
+    'InstallProtocolInterface': 1,
+    'ReinstallProtocolInterface': 1,
+    'UninstallProtocolInterface': 1,
+    'HandleProtocol': 1,
+    'RegisterProtocolNotify': 0,
+    'OpenProtocol': 1,
+    'CloseProtocol': 1,
+    'OpenProtocolInformation': 1,
+    'LocateHandleBuffer': 1,
+    'LocateProtocol': 0
+}
+
+# x64 calling convention
+ARG_REGS = ['rcx', 'rdx', 'r8', 'r9']
+VOLATILE_REGS = ARG_REGS + ['rax', 'r10', 'r11']
+
+# maximal number of wrappers between GUID and boot service call
+WRAPPER_DEPTH = 3
+
+
+def get_guid_places():
+    '''
+    get known GUID tables, they are imported on first use only, so
+    analysis workers (protocols are named by the caller) do not load them
+    '''
+    from .guids import (ami_guids, asrock_guids, dell_guids, edk2_guids,
+                        edk_guids, lenovo_guids)
+    return [
+        ('ami_guids', ami_guids.ami_guids),
+        ('asrock_guids', asrock_guids.asrock_guids),
+        ('dell_guids', dell_guids.dell_guids),
+        ('edk_guids', edk_guids.edk_guids),
+        ('edk2_guids', edk2_guids.edk2_guids),
+        ('lenovo_guids', lenovo_guids.lenovo_guids),
+    ]
+
 
 class Analyser():
-    def __init__(self, module_path):
+    def __init__(self,
+                 module_path,
+                 projects_dir=PROJECTS_DIR,
+                 shards=1,
+                 reachable_only=False,
+                 fingerprints_db=FINGERPRINTS_DB,
+                 r2_open=None):
         self.module_path = module_path
+        # r2 sessions are opened with r2pipe.open or with its stand-in
+        # (see transport.py)
+        self.r2_open = r2_open or r2pipe.open
+        self.projects_dir = projects_dir
+        self.shards = shards
+        self.call_protocols = None
+        # function offset -> [(argument index, service)]
+        self.summaries = {}
+        self.reachable_only = reachable_only
+        self.funcs_total = 0
+        self.funcs_scanned = 0
+        # function offset -> aflj record
+        self.func_infos = {}
         # '-2' for disabling warnings
-        self.r2 = r2pipe.open(module_path, ['-2'])
-        self.r2.cmd('aaa')
+        self.r2 = self.r2_open(module_path, ['-2'])
+        self.project = None
+        self.project_loaded = False
+        self.fingerprints = None
+        try:
+            self.version = self.get_r2_version()
+            if fingerprints_db:
+                self.fingerprints = FingerprintIndex(fingerprints_db)
+            if projects_dir:
+                self.project = self.get_project_name()
+                self.load_project(projects_dir)
+            else:
+                self.r2.cmd('aaa')
+            self.info = self.get_info()
+        except Exception:
+            self.close()
+            raise
 
         self.gBServices = {}
         self.gBServices['InstallProtocolInterface'] = []
@@ -87,15 +173,84 @@ class Analyser():
         self.gBServices['UninstallMultipleProtocolInterfaces'] = []
 
         self.Protocols = {}
-        self.Protocols['ami_guids'] = ami_guids.ami_guids
-        self.Protocols['asrock_guids'] = asrock_guids.asrock_guids
-        self.Protocols['dell_guids'] = dell_guids.dell_guids
-        self.Protocols['edk_guids'] = edk_guids.edk_guids
-        self.Protocols['edk2_guids'] = edk2_guids.edk2_guids
-        self.Protocols['lenovo_guids'] = lenovo_guids.lenovo_guids
         self.Protocols['all'] = []
         self.Protocols['prop_guids'] = []
-        self.info = self.get_info()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        '''
+        close r2 session and save new fingerprints
+        '''
+        if self.fingerprints is not None:
+            self.fingerprints.close()
+            self.fingerprints = None
+        if self.r2 is None:
+            return
+        try:
+            self.r2.quit()
+        except Exception:
+            # r2 process is already terminated
+            pass
+        self.r2 = None
+
+    def get_r2_version(self):
+        version = (self.r2.cmd('?V') or 'unknown').split()[0]
+        return re.sub(r'[^0-9A-Za-z]', '_', version)
+
+    def get_project_name(self):
+        '''
+        get r2 project name from module hash and r2 version
+        (projects of other r2 versions are not loaded)
+        '''
+        sha256 = hashlib.sha256()
+        with open(self.module_path, 'rb') as module:
+            sha256.update(module.read())
+        return 'uefi_{}_{}'.format(sha256.hexdigest(), self.version)
+
+    def load_project(self, projects_dir):
+        '''
+        load analysis results from r2 project,
+        analyse module and save the project if there is no one
+        '''
+        # workers create the directory at once
+        os.makedirs(projects_dir, exist_ok=True)
+        self.r2.cmd('e dir.projects={}'.format(projects_dir))
+        if os.path.isfile(
+                os.path.join(projects_dir, self.project, PROJECT_MARK)):
+            self.r2.cmd('Po {}'.format(self.project))
+            if len(json.loads(self.r2.cmd('aflj') or '[]')):
+                self.project_loaded = True
+                return
+        self.r2.cmd('aaa')
+        self.save_project(projects_dir)
+
+    def save_project(self, projects_dir):
+        '''
+        save r2 project under temporary name and move it into place
+        with completion mark, so workers analysing identical modules
+        do not write one project and partial projects are not loaded
+        '''
+        tmp_name = '{}_tmp{}'.format(self.project, os.getpid())
+        tmp_dir = os.path.join(projects_dir, tmp_name)
+        project_dir = os.path.join(projects_dir, self.project)
+        self.r2.cmd('Ps {}'.format(tmp_name))
+        try:
+            with open(os.path.join(tmp_dir, PROJECT_MARK), 'w'):
+                pass
+            if (os.path.isdir(project_dir) and not os.path.isfile(
+                    os.path.join(project_dir, PROJECT_MARK))):
+                # projects are moved into place with the mark, so this one
+                # is saved by older version
+                shutil.rmtree(project_dir, ignore_errors=True)
+            os.rename(tmp_dir, project_dir)
+        except OSError:
+            # the project is not saved or it is saved by another worker
+            shutil.rmtree(tmp_dir, ignore_errors=True)
 
     @staticmethod
     def _get_word(bytes):
@@ -146,41 +301,276 @@ class Analyser():
             return {}
         for func_info in json_funcs:
             funcs[func_info['name']] = func_info['offset']
+            self.func_infos[func_info['offset']] = func_info
         return funcs
 
+    @staticmethod
+    def _get_ref_addrs(refs):
+        '''
+        get addresses from aflj references (dicts or plain addresses)
+        '''
+        addrs = []
+        for ref in refs or []:
+            if isinstance(ref, dict):
+                ref = ref.get('addr')
+            if isinstance(ref, int):
+                addrs.append(ref)
+        return addrs
+
+    def get_entry_points(self):
+        entries = json.loads(self.r2.cmd('iej') or '[]')
+        return [entry['vaddr'] for entry in entries if 'vaddr' in entry]
+
+    def get_reachable_funcs(self):
+        '''
+        get offsets of functions reachable from the entry point,
+        functions with address taken outside of the code (protocol
+        interfaces in data) and callbacks with address taken in reachable
+        functions (events, notify functions) are reachable too,
+        None is returned if the entry point is unknown
+        '''
+        json_funcs = json.loads(self.r2.cmd('aflj') or '[]')
+        entries = self.get_entry_points()
+        if not len(json_funcs) or not len(entries):
+            return None
+        json_funcs.sort(key=lambda func_info: func_info['offset'])
+        starts = [func_info['offset'] for func_info in json_funcs]
+        ends = [
+            func_info['offset'] + func_info.get('size', 0)
+            for func_info in json_funcs
+        ]
+
+        def get_func(addr):
+            i = bisect.bisect_right(starts, addr) - 1
+            if i >= 0 and (addr == starts[i] or addr < ends[i]):
+                return starts[i]
+            return None
+
+        edges = {}
+        roots = set()
+        for func_info in json_funcs:
+            targets = self._get_ref_addrs(func_info.get('callrefs'))
+            targets += self._get_ref_addrs(func_info.get('datarefs'))
+            edges[func_info['offset']] = [
+                target for target in targets if get_func(target) == target
+            ]
+            for xref in self._get_ref_addrs(func_info.get('dataxrefs')):
+                if get_func(xref) is None:
+                    roots.add(func_info['offset'])
+        for entry in entries:
+            func = get_func(entry)
+            if func is not None:
+                roots.add(func)
+        reachable = set()
+        stack = list(roots)
+        while stack:
+            func = stack.pop()
+            if func in reachable:
+                continue
+            reachable.add(func)
+            stack.extend(edges.get(func, []))
+        return reachable
+
+    @staticmethod
+    def get_func_ops(offset, r2):
+        func_info = json.loads(
+            r2.cmd('pdfj @ {offset}'.format(offset=offset)) or '{}')
+        return func_info.get('ops', [])
+
+    def find_boot_services(self, offset, r2, ops=None):
+        '''
+        get (service, address) pairs of boot services calls in function
+        '''
+        calls = []
+        if ops is None:
+            ops = self.get_func_ops(offset, r2)
+        for line in ops:
+            if ('ptr' in line and 'type' in line and 'offset' in line
+                    and 'disasm' in line):
+                if (line['type'].find('call') > -1
+                        and line['disasm'].find('call qword [') > -1):
+                    for service_name in OFFSET_x64:
+                        if line['ptr'] == OFFSET_x64[service_name]:
+                            calls.append((service_name, line['offset']))
+        return calls
+
     def get_boot_services(self):
         '''
         find boot services from OFFSET_x64
         '''
-        funcs = self.get_funcs()
-        pdfs = []
-        for name in funcs:
-            func_info = self.r2.cmd('pdfj @ {name}'.format(name=funcs[name]))
-            pdfs.append(json.loads(func_info))
-        for func_info in pdfs:
-            if ('ops' in func_info):
-                fcode = func_info['ops']
-                for line in fcode:
-                    if ('ptr' in line and 'type' in line and 'offset' in line
-                            and 'disasm' in line):
-                        if (line['type'].find('call') > -1
-                                and line['disasm'].find('call qword [') > -1):
-                            for service_name in OFFSET_x64:
-                                ea = line['offset']
-                                if (line['ptr'] == OFFSET_x64[service_name]
-                                        and not self.gBServices[service_name].
-                                        count(ea)):
-                                    self.gBServices[service_name].append(ea)
+        offsets = list(self.get_funcs().values())
+        self.funcs_total = len(offsets)
+        if self.reachable_only:
+            reachable = self.get_reachable_funcs()
+            if reachable is not None:
+                offsets = [offset for offset in offsets if offset in reachable]
+        self.funcs_scanned = len(offsets)
+        # shards load the project of the main session, so their analysis
+        # results are the same as in the sequential scan
+        if (self.shards > 1 and self.project is not None
+                and len(offsets) >= SHARD_MIN_FUNCS):
+            calls = self.scan_shards(offsets)
+        elif self.fingerprints is not None:
+            calls = self.scan_funcs(offsets)
+        else:
+            calls = []
+            for offset in offsets:
+                calls += self.find_boot_services(offset, self.r2)
+        for service_name, ea in calls:
+            if not self.gBServices[service_name].count(ea):
+                self.gBServices[service_name].append(ea)
         return True
 
-    def prev_head(self, ea):
+    def get_func_bytes(self, offset, r2):
+        '''
+        get function bytes and fingerprint, addresses of aflj references
+        are masked (None, None if function size is unknown)
+        '''
+        func_info = self.func_infos.get(offset, {})
+        if not func_info.get('size'):
+            return None, None
+        data = bytes.fromhex(
+            r2.cmd('p8 {size} @ {offset}'.format(size=func_info['size'],
+                                                 offset=offset)).strip())
+        targets = self._get_ref_addrs(func_info.get('callrefs'))
+        targets += self._get_ref_addrs(func_info.get('datarefs'))
+        return data, get_fingerprint(data, offset, targets, self.version)
+
+    def scan_cached_func(self, offset, data, cached, baddr, r2):
+        '''
+        get results of known function from the fingerprints index,
+        GUID addresses are taken from lea instructions in function bytes
+        '''
+        results = []
+        for service_name, call_offset, lea in cached:
+            record = None
+            if lea is not None:
+                guid_addr = get_rip_target(data, offset, lea[0], lea[1])
+                record = self.get_protocol_record(service_name, guid_addr,
+                                                  baddr, r2)
+            results.append((service_name, offset + call_offset, record))
+        return results
+
+    def scan_func(self, offset, baddr, r2):
+        '''
+        find boot services calls and protocols in function, results of
+        known functions are taken from the fingerprints index without
+        disassembling them, (service, address, protocol record) tuples
+        are returned
+        '''
+        data, fingerprint = None, None
+        if self.fingerprints is not None:
+            data, fingerprint = self.get_func_bytes(offset, r2)
+        if fingerprint is not None:
+            cached = self.fingerprints.get(fingerprint)
+            if cached is not None:
+                return self.scan_cached_func(offset, data, cached, baddr, r2)
+        ops = self.get_func_ops(offset, r2)
+        # the function is cached only if all its code is fingerprinted
+        if data is None or not all([
+                0 <= line.get('offset', -1) - offset < len(data)
+                for line in ops
+        ]):
+            fingerprint = None
+        results = []
+        cached = []
+        for service_name, ea in self.find_boot_services(offset, r2, ops):
+            record, lea = None, None
+            if service_name in LEA_NUM:
+                instr = self.find_guid_arg(service_name, ea, r2)
+                if instr is not None and instr.get('ptr') is not None:
+                    record = self.get_protocol_record(service_name,
+                                                      instr['ptr'], baddr, r2)
+                    lea = [instr['offset'] - offset, instr.get('size', 0)]
+                    # GUID address must be restored from the bytes
+                    if get_rip_target(data or b'', offset, lea[0],
+                                      lea[1]) != instr['ptr']:
+                        fingerprint = None
+            results.append((service_name, ea, record))
+            cached.append([service_name, ea - offset, lea])
+        if fingerprint is not None:
+            self.fingerprints.put(fingerprint, cached)
+        return results
+
+    def scan_funcs(self, offsets):
+        '''
+        find boot services calls and protocols in the main r2 session
+        '''
+        baddr = self.get_baddr()
+        self.call_protocols = {}
+        calls = []
+        for offset in offsets:
+            for service_name, ea, record in self.scan_func(
+                    offset, baddr, self.r2):
+                calls.append((service_name, ea))
+                self.call_protocols[(service_name, ea)] = record
+        return calls
+
+    def open_shard(self, r2):
+        '''
+        load analysis results of the main session to additional r2 session
+        for the part of module functions
+        '''
+        r2.cmd('e dir.projects={}'.format(self.projects_dir))
+        r2.cmd('Po {}'.format(self.project))
+        if not len(json.loads(r2.cmd('aflj') or '[]')):
+            # the project is not saved, analyse module as the main session
+            r2.cmd('aaa')
+
+    def scan_shard(self, shard):
+        '''
+        find boot services calls and protocols in the part of module functions,
+        (function index, service, address, protocol record) tuples are returned
+        '''
+        index, part = shard
+        baddr = self.get_baddr()
+        results = []
+        # the first part is analysed in the main session
+        r2 = self.r2
+        try:
+            if index:
+                r2 = self.r2_open(self.module_path, ['-2'])
+                self.open_shard(r2)
+            for func_index, offset in part:
+                for service_name, ea, record in self.scan_func(
+                        offset, baddr, r2):
+                    results.append((func_index, service_name, ea, record))
+        finally:
+            if r2 is not self.r2:
+                r2.quit()
+        return results
+
+    def scan_shards(self, offsets):
+        '''
+        split module functions between r2 sessions and merge the results
+        in the order of sequential scan
+        '''
+        funcs = list(enumerate(offsets))
+        shards = [(index, funcs[index::self.shards])
+                  for index in range(self.shards)]
+        with ThreadPoolExecutor(max_workers=self.shards) as executor:
+            results = []
+            for shard_results in executor.map(self.scan_shard, shards):
+                results += shard_results
+        # sort is stable, so calls in one function keep their order
+        results.sort(key=lambda result: result[0])
+        self.call_protocols = {}
+        calls = []
+        for _, service_name, ea, record in results:
+            calls.append((service_name, ea))
+            self.call_protocols[(service_name, ea)] = record
+        return calls
+
+    def prev_head(self, ea, r2=None):
         '''
         return 0 if ea is start of block
         '''
+        if r2 is None:
+            r2 = self.r2
         addresses = []
         i = 0
-        self.r2.cmd('s {addr:#x}'.format(addr=ea))
-        block = json.loads(self.r2.cmd('pdfj'))
+        r2.cmd('s {addr:#x}'.format(addr=ea))
+        block = json.loads(r2.cmd('pdfj'))
         for instr in block['ops']:
             addresses.append(instr['offset'])
         i = addresses.index(ea)
@@ -189,12 +579,14 @@ class Analyser():
         else:
             return 0
 
-    def get_guid(self, address):
+    def get_guid(self, address, r2=None):
         '''
         get GUID structure from data by address
         '''
-        self.r2.cmd('s {addr:#x}'.format(addr=address))
-        guid_bytes = json.loads(self.r2.cmd('pcj 16'))
+        if r2 is None:
+            r2 = self.r2
+        r2.cmd('s {addr:#x}'.format(addr=address))
+        guid_bytes = json.loads(r2.cmd('pcj 16'))
         current_guid = []
         current_guid.append(self._get_dword(bytearray(guid_bytes[:4:])))
         current_guid.append(self._get_word(bytearray(guid_bytes[4:6:])))
@@ -202,56 +594,204 @@ class Analyser():
         current_guid += guid_bytes[8:16:]
         return current_guid
 
+    def get_baddr(self):
+        baddr = 0
+        if 'baddr' in self.info['bin']:
+            baddr = self.info['bin']['baddr']
+        return baddr
+
+    def find_guid_arg(self, service_name, address, r2):
+        '''
+        get lea instruction with GUID argument of boot service call
+        (None if instruction is not found)
+        '''
+        ea = address
+        lea_counter = 0
+        while (True):
+            ea = self.prev_head(ea, r2)
+            if not ea:
+                break
+            instr = json.loads(r2.cmd('pdj 1 @ {addr}'.format(addr=ea)))[0]
+            if (instr['type'] == 'lea'):
+                lea_counter += 1
+                if (lea_counter == LEA_NUM[service_name]):
+                    break
+        if not ea:
+            return None
+        return instr
+
+    def get_protocol_record(self, service_name, guid_addr, baddr, r2):
+        '''
+        get protocol record from GUID address (None if there is no GUID)
+        '''
+        if (guid_addr is None) or guid_addr <= baddr:
+            return None
+        current_guid = self.get_guid(guid_addr, r2)
+        if len(set(current_guid)) < MIN_SET_LEN:
+            return None
+        protocol_record = {}
+        protocol_record['address'] = guid_addr
+        protocol_record['service'] = service_name
+        protocol_record['guid'] = current_guid
+        return protocol_record
+
+    def find_protocol(self, service_name, address, baddr, r2):
+        '''
+        get protocol record from GUID argument of boot service call
+        (None if GUID is not found)
+        '''
+        instr = self.find_guid_arg(service_name, address, r2)
+        if instr is None:
+            return None
+        return self.get_protocol_record(service_name, instr.get('ptr'), baddr,
+                                        r2)
+
     def get_protocols(self):
         '''
         find protocols
         '''
-        baddr = 0
-        if 'baddr' in self.info['bin']:
-            baddr = self.get_info()['bin']['baddr']
+        baddr = self.get_baddr()
         for service_name in self.gBServices:
             if not (service_name in LEA_NUM.keys()):
                 continue
             for address in self.gBServices[service_name]:
-                ea = address
-                lea_counter = 0
-                while (True):
-                    ea = self.prev_head(ea)
-                    if not ea:
-                        break
-                    instr = json.loads(
-                        self.r2.cmd('pdj 1 @ {addr}'.format(addr=ea)))[0]
-                    if (instr['type'] == 'lea'):
-                        lea_counter += 1
-                        if (lea_counter == LEA_NUM[service_name]):
-                            break
-                if not ea:
+                if self.call_protocols is not None:
+                    protocol_record = self.call_protocols.get(
+                        (service_name, address))
+                else:
+                    protocol_record = self.find_protocol(
+                        service_name, address, baddr, self.r2)
+                if protocol_record is None:
+                    continue
+                if not self.Protocols['all'].count(protocol_record):
+                    self.Protocols['all'].append(protocol_record)
+        for protocol_record in self.get_wrapper_protocols(baddr):
+            if not self.Protocols['all'].count(protocol_record):
+                self.Protocols['all'].append(protocol_record)
+
+    @staticmethod
+    def get_reg(operand):
+        '''
+        get 64-bit register name from operand (None if operand is not
+        a general purpose register)
+        '''
+        operand = operand.strip()
+        if re.match(r'^r(8|9|1[0-5])[dwb]?$', operand):
+            return re.sub(r'[dwb]$', '', operand)
+        match = re.match(r'^[re]?([abcd])[xlh]$', operand)
+        if match:
+            return 'r{}x'.format(match.group(1))
+        match = re.match(r'^[re]?(si|di|bp|sp)l?$', operand)
+        if match:
+            return 'r{}'.format(match.group(1))
+        return None
+
+    def trace_arg(self, ops, index, reg):
+        '''
+        follow register moves back from instruction with index in function,
+        ('ptr', address) is returned for lea of address,
+        ('arg', argument index) for function argument and (None, None)
+        if the value is unknown
+        '''
+        for line in reversed(ops[:index]):
+            if (line.get('type', '').find('call') > -1
+                    and reg in VOLATILE_REGS):
+                return None, None
+            instr = line.get('opcode', line.get('disasm', ''))
+            mnem, _, operands = instr.partition(' ')
+            operands = operands.split(',')
+            if mnem in ['cmp', 'test', 'push'] or self.get_reg(
+                    operands[0]) != reg:
+                continue
+            if mnem == 'lea' and len(operands) == 2:
+                return 'ptr', line.get('ptr')
+            if mnem == 'mov' and len(operands) == 2 and self.get_reg(
+                    operands[1]):
+                reg = self.get_reg(operands[1])
+                continue
+            return None, None
+        if reg in ARG_REGS:
+            return 'arg', ARG_REGS.index(reg)
+        return None, None
+
+    def get_wrapper_protocols(self, baddr):
+        '''
+        find protocols with GUIDs passed through wrappers of boot services,
+        summaries like "argument N flows to GUID parameter of service S"
+        are computed once for each wrapper and applied to its call sites
+        '''
+        records = []
+
+        def get_ops(address):
+            ops = self.get_func_ops(address, self.r2)
+            if len(ops) and 'offset' in ops[0]:
+                return ops[0]['offset'], ops
+            return None, ops
+
+        def get_index(ops, address):
+            for index, line in enumerate(ops):
+                if line.get('offset') == address:
+                    return index
+            return None
+
+        # direct calls with GUID in function argument
+        queue = []
+        for service_name in self.gBServices:
+            if not service_name in GUID_ARG:
+                continue
+            for address in self.gBServices[service_name]:
+                if self.call_protocols is not None and self.call_protocols.get(
+                    (service_name, address)) is not None:
+                    continue
+                func, ops = get_ops(address)
+                index = get_index(ops, address)
+                if func is None or index is None:
+                    continue
+                kind, value = self.trace_arg(ops, index,
+                                             ARG_REGS[GUID_ARG[service_name]])
+                if kind != 'arg':
+                    continue
+                summary = self.summaries.setdefault(func, [])
+                if not (value, service_name) in summary:
+                    summary.append((value, service_name))
+                    queue.append((func, 0))
+        # call sites of wrappers
+        while queue:
+            func, depth = queue.pop(0)
+            xrefs = json.loads(
+                self.r2.cmd('axtj @ {addr:#x}'.format(addr=func)) or '[]')
+            for xref in xrefs:
+                if xref.get('type', '').upper() != 'CALL' or not 'from' in xref:
                     continue
-                guid_addr = instr.get('ptr')
-                if (guid_addr is None) or guid_addr <= baddr:
+                caller, ops = get_ops(xref['from'])
+                index = get_index(ops, xref['from'])
+                if caller is None or index is None:
                     continue
-                current_guid = self.get_guid(guid_addr)
-                if len(set(current_guid)) >= MIN_SET_LEN:
-                    protocol_record = {}
-                    protocol_record['address'] = guid_addr
-                    protocol_record['service'] = service_name
-                    protocol_record['guid'] = current_guid
-                    if not self.Protocols['all'].count(protocol_record):
-                        self.Protocols['all'].append(protocol_record)
+                for arg, service_name in list(self.summaries[func]):
+                    kind, value = self.trace_arg(ops, index, ARG_REGS[arg])
+                    if kind == 'ptr':
+                        record = self.get_protocol_record(
+                            service_name, value, baddr, self.r2)
+                        if record is not None and not records.count(record):
+                            records.append(record)
+                    if kind == 'arg' and depth + 1 < WRAPPER_DEPTH:
+                        summary = self.summaries.setdefault(caller, [])
+                        if not (value, service_name) in summary:
+                            summary.append((value, service_name))
+                            queue.append((caller, depth + 1))
+        return records
 
     def get_prot_names(self):
         '''
         identify known protocols
         '''
+        guid_places = get_guid_places()
         for index in range(len(self.Protocols['all'])):
             fin = False
-            for guid_place in [
-                    'ami_guids', 'asrock_guids', 'dell_guids', 'edk_guids',
-                    'edk2_guids', 'lenovo_guids'
-            ]:
-                for prot_name in self.Protocols[guid_place].keys():
+            for guid_place, guids in guid_places:
+                for prot_name in guids.keys():
                     guid_r2 = self.Protocols['all'][index]['guid']
-                    guid_conf = self.Protocols[guid_place][prot_name]
+                    guid_conf = guids[prot_name]
                     if (guid_r2 == guid_conf):
                         self.Protocols['all'][index][
                             'protocol_name'] = prot_name
@@ -329,7 +869,7 @@ if __name__ == '__main__':
     parser.add_argument('module', type=str, help='path to UEFI module')
     args = parser.parse_args()
     if os.path.isfile(args.module):
-        analyser = Analyser(args.module)
-        analyser.print_all()
+        with Analyser(args.module) as analyser:
+            analyser.print_all()
     else:
         print('Invalid argument')
@@ -0,0 +1,162 @@
+# MIT License
+#
+# Copyright (c) 2018-2019 yeggor
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import hashlib
+import json
+import os
+import sqlite3
+import struct
+import threading
+
+# index of normalized function bytes, shared by all modules and runs
+FINGERPRINTS_DB = os.path.join(os.path.expanduser('~'), '.cache',
+                               'uefi_retool', 'fingerprints.db')
+
+# bumped when the fingerprinted data or the cached results change
+FINGERPRINT_FORMAT = 2
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS fingerprints (
+    fingerprint TEXT PRIMARY KEY,
+    result TEXT NOT NULL
+);
+'''
+
+
+def get_masked_bytes(data, offset, targets):
+    '''
+    get function bytes without addresses that depend on the module layout:
+    rel32 displacements (call/jmp and rip-relative operands at the end
+    of instruction) and absolute pointers to the referenced addresses
+    outside of the function (other displacements are kept, so they only
+    make the fingerprint more specific)
+    '''
+    end = offset + len(data)
+    targets = set([
+        target for target in targets if not offset <= target < end
+    ])
+    if not len(targets):
+        return data
+    masked = bytearray(data)
+    for index in range(len(data) - 3):
+        rel32 = struct.unpack_from('<i', data, index)[0]
+        if offset + index + 4 + rel32 in targets:
+            masked[index:index + 4] = b'\0' * 4
+    for target in targets:
+        for fmt in ('<I', '<Q'):
+            try:
+                packed = struct.pack(fmt, target)
+            except struct.error:
+                continue
+            index = data.find(packed)
+            while index >= 0:
+                masked[index:index + len(packed)] = b'\0' * len(packed)
+                index = data.find(packed, index + 1)
+    return bytes(masked)
+
+
+def get_fingerprint(data, offset, targets, salt=''):
+    '''
+    get fingerprint of function from its bytes and from the addresses
+    it references
+    '''
+    sha256 = hashlib.sha256('{}:{}:'.format(salt,
+                                            FINGERPRINT_FORMAT).encode())
+    sha256.update('{:x}:'.format(len(data)).encode())
+    sha256.update(get_masked_bytes(data, offset, targets))
+    return sha256.hexdigest()
+
+
+def get_rip_target(data, offset, index, size):
+    '''
+    get target of rip-relative operand at the end of instruction
+    (None if instruction is not in function bytes)
+    '''
+    end = index + size
+    if index < 0 or size < 5 or end > len(data):
+        return None
+    return offset + end + struct.unpack_from('<i', data, end - 4)[0]
+
+
+class FingerprintIndex():
+    '''
+    persistent index of function fingerprints and their analysis results,
+    new results are written on close, so concurrent workers hold
+    the database lock only for a moment
+    '''
+
+    def __init__(self, db_path=FINGERPRINTS_DB):
+        db_dir = os.path.dirname(os.path.abspath(db_path))
+        # workers create the index at once
+        os.makedirs(db_dir, exist_ok=True)
+        self.conn = sqlite3.connect(db_path,
+                                    timeout=60,
+                                    check_same_thread=False)
+        self.conn.executescript(SCHEMA)
+        self.lock = threading.Lock()
+        self.new = {}
+        self.hits = 0
+        self.lookups = 0
+
+    def get(self, fingerprint):
+        '''
+        get cached result of function (None if function is unknown)
+        '''
+        with self.lock:
+            self.lookups += 1
+            if fingerprint in self.new:
+                self.hits += 1
+                return self.new[fingerprint]
+            row = self.conn.execute(
+                'SELECT result FROM fingerprints WHERE fingerprint = ?',
+                (fingerprint, )).fetchone()
+            if row is None:
+                return None
+            self.hits += 1
+            return json.loads(row[0])
+
+    def put(self, fingerprint, result):
+        with self.lock:
+            self.new[fingerprint] = result
+
+    def save(self):
+        '''
+        write new results, the index is only a cache,
+        so results are dropped if the database stays locked
+        '''
+        with self.lock:
+            if not len(self.new):
+                return
+            try:
+                with self.conn:
+                    self.conn.executemany(
+                        'INSERT OR IGNORE INTO fingerprints VALUES (?, ?)',
+                        [(fingerprint, json.dumps(result))
+                         for fingerprint, result in self.new.items()])
+            except sqlite3.OperationalError as e:
+                print('[ERROR] fingerprints were not saved: {}'.format(e))
+            self.new = {}
+
+    def close(self):
+        self.save()
+        self.conn.close()
@@ -0,0 +1,274 @@
+# MIT License
+#
+# Copyright (c) 2018-2019 yeggor
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+
+import r2pipe
+
+from .analyser import Analyser
+
+# recordings of other formats are not replayed
+RECORDING_VERSION = 1
+
+
+class ReplayError(Exception):
+    pass
+
+
+class RecordingSession():
+    '''
+    r2pipe session that passes commands to r2 and records the responses
+    '''
+    def __init__(self, recorder, r2):
+        self.recorder = recorder
+        self.r2 = r2
+
+    def cmd(self, command):
+        start = time.perf_counter()
+        output = self.r2.cmd(command)
+        self.recorder.add(command, output, time.perf_counter() - start)
+        return output
+
+    def quit(self):
+        self.r2.quit()
+
+
+class Recorder():
+    '''
+    open r2 sessions and record command/response pairs of all of them
+    (pass it to Analyser as `r2_open`)
+    '''
+    def __init__(self, r2_open=None):
+        self.r2_open = r2_open or r2pipe.open
+        self.commands = []
+        self.r2_seconds = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, module_path, flags=None):
+        return RecordingSession(self, self.r2_open(module_path, flags or []))
+
+    def add(self, command, output, elapsed):
+        with self.lock:
+            self.commands.append([command, output])
+            self.r2_seconds += elapsed
+
+    def save(self, path, recording):
+        recording['version'] = RECORDING_VERSION
+        recording['commands'] = self.commands
+        recording['r2_seconds'] = self.r2_seconds
+        with gzip.open(path, 'wt') as recording_file:
+            json.dump(recording, recording_file)
+
+
+class ReplaySession():
+    '''
+    r2pipe session that serves recorded responses
+    '''
+    def __init__(self, replayer):
+        self.replayer = replayer
+
+    def cmd(self, command):
+        return self.replayer.get(command)
+
+    def quit(self):
+        pass
+
+
+class Replayer():
+    '''
+    open replay sessions that answer commands from recording without r2,
+    repeated commands get their responses in the recorded order (the last
+    response is repeated), unknown commands raise ReplayError
+    '''
+    def __init__(self, recording):
+        if recording.get('version') != RECORDING_VERSION:
+            raise ReplayError('unsupported recording version: {}'.format(
+                recording.get('version')))
+        self.responses = {}
+        for command, output in recording['commands']:
+            self.responses.setdefault(command, []).append(output)
+        self.positions = {}
+        self.round_trips = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, module_path, flags=None):
+        return ReplaySession(self)
+
+    def get(self, command):
+        with self.lock:
+            outputs = self.responses.get(command)
+            if outputs is None:
+                raise ReplayError(
+                    'command is not recorded: {}'.format(command))
+            position = self.positions.get(command, 0)
+            self.positions[command] = position + 1
+            self.round_trips += 1
+            return outputs[min(position, len(outputs) - 1)]
+
+
+def load_recording(path):
+    with gzip.open(path, 'rt') as recording_file:
+        return json.load(recording_file)
+
+
+def get_results(analyser):
+    '''
+    analyse module and get results that are compared between runs
+    '''
+    analyser.get_boot_services()
+    analyser.get_protocols()
+    analyser.get_prot_names()
+    return {
+        'boot_services': analyser.gBServices,
+        'protocols': [{
+            'address': '{addr:#x}'.format(addr=element['address']),
+            'service': element['service'],
+            'guid': analyser.get_guid_str(element['guid']),
+            'protocol_name': element['protocol_name']
+        } for element in analyser.Protocols['all']]
+    }
+
+
+def record(module_path, recording_path, shards=1, reachable_only=False):
+    '''
+    analyse module with r2 and save all r2 responses with the results,
+    r2 projects and fingerprints are not used, so the recording does not
+    depend on the cache state
+    '''
+    recorder = Recorder()
+    start = time.perf_counter()
+    with Analyser(module_path,
+                  projects_dir=None,
+                  shards=shards,
+                  reachable_only=reachable_only,
+                  fingerprints_db=None,
+                  r2_open=recorder) as analyser:
+        results = get_results(analyser)
+    wall_seconds = time.perf_counter() - start
+    with open(module_path, 'rb') as module:
+        sha256 = hashlib.sha256(module.read()).hexdigest()
+    recorder.save(
+        recording_path, {
+            'module': os.path.basename(module_path),
+            'sha256': sha256,
+            'options': {
+                'shards': shards,
+                'reachable_only': reachable_only
+            },
+            'wall_seconds': wall_seconds,
+            'results': results
+        })
+    return recording_path
+
+
+def replay(recording):
+    '''
+    analyse module with recorded r2 responses,
+    (results, round trips, seconds) are returned
+    '''
+    replayer = Replayer(recording)
+    start = time.perf_counter()
+    with Analyser(recording['module'],
+                  projects_dir=None,
+                  fingerprints_db=None,
+                  r2_open=replayer,
+                  **recording['options']) as analyser:
+        results = get_results(analyser)
+    return results, replayer.round_trips, time.perf_counter() - start
+
+
+def main():
+    program = 'python -m r2_uefi_re.transport'
+    parser = argparse.ArgumentParser(
+        prog=program,
+        description='record r2 responses of module analysis and replay '
+        'them without r2 (for benchmarks and regression tests)')
+    subparsers = parser.add_subparsers(dest='mode')
+    subparsers.required = True
+    record_parser = subparsers.add_parser('record',
+                                          help='analyse module with r2')
+    record_parser.add_argument('module', type=str, help='path to UEFI module')
+    record_parser.add_argument('recording',
+                               type=str,
+                               help='recording path (.json.gz)')
+    record_parser.add_argument('--shards',
+                               type=int,
+                               default=1,
+                               help='number of r2 sessions (default: 1)')
+    record_parser.add_argument('--reachable_only',
+                               action='store_true',
+                               help='scan only reachable functions')
+    replay_parser = subparsers.add_parser(
+        'replay', help='analyse modules with recorded responses')
+    replay_parser.add_argument('recordings',
+                               type=str,
+                               nargs='+',
+                               help='recording paths')
+    replay_parser.add_argument('--repeat',
+                               type=int,
+                               default=1,
+                               help='number of runs of each recording')
+    args = parser.parse_args()
+
+    if args.mode == 'record':
+        record(args.module, args.recording, args.shards, args.reachable_only)
+        recording = load_recording(args.recording)
+        print('[*] {} commands, {:.2f}s in r2 of {:.2f}s'.format(
+            len(recording['commands']), recording['r2_seconds'],
+            recording['wall_seconds']))
+        return
+
+    failed = 0
+    for path in args.recordings:
+        recording = load_recording(path)
+        times = []
+        for _ in range(args.repeat):
+            try:
+                results, round_trips, seconds = replay(recording)
+            except ReplayError as e:
+                print('[-] {}: {}'.format(recording['module'], e))
+                failed += 1
+                break
+            times.append(seconds)
+            if results != recording['results']:
+                print('[-] {}: results differ from recording'.format(
+                    recording['module']))
+                failed += 1
+                break
+        else:
+            print('[+] {}: {} round trips, {:.4f}s (min of {} runs, '
+                  '{:.2f}s in r2 when recorded)'.format(
+                      recording['module'], round_trips, min(times),
+                      len(times), recording['r2_seconds']))
+    if failed:
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+# MIT License
+#
+# Copyright (c) 2018-2019 yeggor
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import argparse
+import json
+import os
+import socket
+import sys
+
+# only the standard library is imported, so the client starts fast
+
+
+def connect(address):
+    '''
+    connect to analysis daemon on Unix socket path or localhost port
+    '''
+    host, _, port = address.rpartition(':')
+    if port.isdigit() or not hasattr(socket, 'AF_UNIX'):
+        return socket.create_connection((host or 'localhost', int(port)))
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(address)
+    return sock
+
+
+def submit(address, firmware_path, reports, db_path=None):
+    '''
+    send analysis job and yield messages as modules are analysed,
+    the last message has the `done` key
+    '''
+    request = {
+        'firmware_path': os.path.abspath(firmware_path),
+        'reports': reports
+    }
+    if db_path:
+        request['db'] = os.path.abspath(db_path)
+    with connect(address) as sock:
+        sock.sendall((json.dumps(request) + '\n').encode())
+        with sock.makefile('rb') as stream:
+            for line in stream:
+                message = json.loads(line.decode())
+                yield message
+                if 'done' in message or not 'module' in message:
+                    return
+
+
+def main():
+    program = 'python -m tools.analysis_client'
+    parser = argparse.ArgumentParser(
+        prog=program,
+        description='send firmware to analysis daemon '
+        '(python analyse_fw_r2.py --serve ADDRESS)')
+    parser.add_argument('address',
+                        type=str,
+                        help='Unix socket path or localhost port of daemon')
+    parser.add_argument('firmware_path',
+                        type=str,
+                        help='path to UEFI firmware for analysis')
+    parser.add_argument('--reports',
+                        type=str,
+                        default='all',
+                        help='''comma-separated logs written by daemon:
+		all, pp_guids or none (default: all)''')
+    parser.add_argument('--db',
+                        type=str,
+                        metavar='DB_PATH',
+                        help='also store the results in SQLite database')
+    parser.add_argument('--json',
+                        action='store_true',
+                        help='print daemon messages as JSON lines')
+    args = parser.parse_args()
+
+    reports = [report for report in args.reports.split(',') if report]
+    failed, done = False, False
+    for message in submit(args.address, args.firmware_path, reports,
+                          args.db):
+        done = done or 'done' in message
+        failed = failed or 'error' in message and not 'module' in message
+        if args.json:
+            print(json.dumps(message))
+            continue
+        if 'module' in message:
+            if message['error'] is not None:
+                print('[-] {}: {}'.format(message['module'], message['error']))
+            else:
+                print('[+] {}: {} protocols'.format(
+                    message['module'], len(message['result']['protocols'])))
+        elif 'done' in message:
+            print('\t [number of proprietary protocols] {}'.format(
+                message['pp_guids_num']))
+            print('\t [full number of protocols] {}'.format(
+                message['full_guids_num']))
+        else:
+            print('[ERROR] {}'.format(message['error']))
+    if not done and not failed:
+        # the daemon closed the connection without the result of the job
+        print('[ERROR] job was not completed')
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
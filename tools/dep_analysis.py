@@ -0,0 +1,326 @@
+# MIT License
+#
+# Copyright (c) 2018-2019 yeggor
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import argparse
+import json
+import os
+
+from .result_db import ResultDB
+from .utils import get_dep_index
+
+
+def get_bits_list(bits):
+    '''
+    get indexes of set bits
+    '''
+    indexes = []
+    while bits:
+        low_bit = bits & -bits
+        indexes.append(low_bit.bit_length() - 1)
+        bits ^= low_bit
+    return indexes
+
+
+class DepGraph():
+    '''
+    integer-indexed graph of protocol dependencies between modules,
+    the edge installer -> consumer means that consumer depends on installer
+    '''
+    def __init__(self, res_json):
+        self.names = []
+        self.ids = {}
+        for module_info in res_json:
+            self._get_id(module_info['module_name'])
+        dep_index = get_dep_index(res_json)
+        self.guid_installers = {}
+        self.guid_consumers = {}
+        for guid in dep_index['installers']:
+            self.guid_installers[guid] = sorted(
+                set([
+                    self.ids[record['module_name']]
+                    for record in dep_index['installers'][guid]
+                ]))
+        for guid in dep_index['consumers']:
+            self.guid_consumers[guid] = [
+                self.ids[name] for name in dep_index['consumers'][guid]
+            ]
+        self.succ = [set() for _ in self.names]
+        self.pred = [set() for _ in self.names]
+        for guid in self.guid_installers:
+            for installer in self.guid_installers[guid]:
+                for consumer in self.guid_consumers.get(guid, []):
+                    if installer == consumer:
+                        continue
+                    self.succ[installer].add(consumer)
+                    self.pred[consumer].add(installer)
+        self.sccs, self.scc_of = self._get_sccs()
+        self.scc_order = self._get_scc_order()
+        # memoized closures (bitset for each SCC)
+        self._requires = None
+        self._dependents = None
+
+    def _get_id(self, name):
+        if name not in self.ids:
+            self.ids[name] = len(self.names)
+            self.names.append(name)
+        return self.ids[name]
+
+    def _get_sccs(self):
+        '''
+        Tarjan's algorithm (iterative version)
+        '''
+        index = [None] * len(self.names)
+        lowlink = [0] * len(self.names)
+        on_stack = [False] * len(self.names)
+        stack = []
+        sccs = []
+        scc_of = [None] * len(self.names)
+        counter = 0
+        for root in range(len(self.names)):
+            if index[root] is not None:
+                continue
+            work = [(root, iter(sorted(self.succ[root])))]
+            index[root] = lowlink[root] = counter
+            counter += 1
+            stack.append(root)
+            on_stack[root] = True
+            while work:
+                node, successors = work[-1]
+                pushed = False
+                for succ in successors:
+                    if index[succ] is None:
+                        index[succ] = lowlink[succ] = counter
+                        counter += 1
+                        stack.append(succ)
+                        on_stack[succ] = True
+                        work.append((succ, iter(sorted(self.succ[succ]))))
+                        pushed = True
+                        break
+                    if on_stack[succ]:
+                        lowlink[node] = min(lowlink[node], index[succ])
+                if pushed:
+                    continue
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index[node]:
+                    scc = []
+                    while True:
+                        member = stack.pop()
+                        on_stack[member] = False
+                        scc_of[member] = len(sccs)
+                        scc.append(member)
+                        if member == node:
+                            break
+                    sccs.append(sorted(scc))
+        return sccs, scc_of
+
+    def _get_scc_order(self):
+        '''
+        topological order of condensation graph (Kahn's algorithm),
+        SCCs without dependencies between them keep the order of modules
+        '''
+        in_degree = [0] * len(self.sccs)
+        scc_succ = [set() for _ in self.sccs]
+        for node in range(len(self.names)):
+            for succ in self.succ[node]:
+                if self.scc_of[node] != self.scc_of[succ]:
+                    scc_succ[self.scc_of[node]].add(self.scc_of[succ])
+        for scc in range(len(self.sccs)):
+            for succ in scc_succ[scc]:
+                in_degree[succ] += 1
+        self.scc_succ = scc_succ
+        ready = sorted(
+            [scc for scc in range(len(self.sccs)) if not in_degree[scc]],
+            key=lambda scc: self.sccs[scc][0],
+            reverse=True)
+        order = []
+        while ready:
+            scc = ready.pop()
+            order.append(scc)
+            for succ in scc_succ[scc]:
+                in_degree[succ] -= 1
+                if not in_degree[succ]:
+                    ready.append(succ)
+            ready.sort(key=lambda scc: self.sccs[scc][0], reverse=True)
+        return order
+
+    def _get_closures(self, order, neighbours):
+        closures = [0] * len(self.sccs)
+        for scc in order:
+            bits = 0
+            for member in self.sccs[scc]:
+                bits |= 1 << member
+            for neighbour in neighbours[scc]:
+                bits |= closures[neighbour]
+            closures[scc] = bits
+        return closures
+
+    def _get_requires(self):
+        if self._requires is None:
+            scc_pred = [set() for _ in self.sccs]
+            for scc in range(len(self.sccs)):
+                for succ in self.scc_succ[scc]:
+                    scc_pred[succ].add(scc)
+            self._requires = self._get_closures(self.scc_order, scc_pred)
+        return self._requires
+
+    def _get_dependents(self):
+        if self._dependents is None:
+            self._dependents = self._get_closures(reversed(self.scc_order),
+                                                  self.scc_succ)
+        return self._dependents
+
+    def _get_names(self, bits):
+        return [self.names[index] for index in get_bits_list(bits)]
+
+    def requires(self, module):
+        '''
+        get all modules that must be dispatched before module
+        '''
+        module_id = self.ids[module]
+        bits = self._get_requires()[self.scc_of[module_id]]
+        return self._get_names(bits & ~(1 << module_id))
+
+    def dependents(self, module):
+        '''
+        get all modules that depend on module
+        '''
+        module_id = self.ids[module]
+        bits = self._get_dependents()[self.scc_of[module_id]]
+        return self._get_names(bits & ~(1 << module_id))
+
+    def affected_by(self, guid):
+        '''
+        get all modules affected if protocol disappears
+        '''
+        dependents = self._get_dependents()
+        bits = 0
+        for consumer in self.guid_consumers.get(guid.upper(), []):
+            bits |= dependents[self.scc_of[consumer]]
+        return self._get_names(bits)
+
+    def cycles(self):
+        '''
+        get groups of modules that depend on each other
+        '''
+        return [[self.names[member] for member in scc] for scc in self.sccs
+                if len(scc) > 1]
+
+    def dispatch_order(self):
+        '''
+        get plausible dispatch order of modules, modules from the same
+        dependency cycle are placed in one group
+        '''
+        return [[self.names[member] for member in self.sccs[scc]]
+                for scc in self.scc_order]
+
+
+def load_res_json(log_path, firmware=None):
+    '''
+    load analysis results from JSON log or from SQLite database
+    (the last imported firmware is used by default)
+    '''
+    if os.path.splitext(log_path)[1] in ('.db', '.sqlite'):
+        db = ResultDB(log_path)
+        if firmware is None:
+            row = db.conn.execute('SELECT MAX(id) FROM firmwares').fetchone()
+            firmware_id = row[0]
+        else:
+            firmware_id = db.get_firmware_id(firmware)
+        res_json = []
+        if firmware_id is not None:
+            res_json = db.get_res_json(firmware_id)
+        db.close()
+        return res_json
+    with open(log_path, 'r') as f:
+        return json.load(f)
+
+
+def print_list(title, names):
+    print('{} ({}):'.format(title, len(names)))
+    for name in names:
+        print('\t{}'.format(name))
+
+
+def main():
+    program = 'python -m tools.dep_analysis'
+    parser = argparse.ArgumentParser(
+        description='Analyse transitive dependencies between UEFI modules',
+        prog=program)
+    parser.add_argument(
+        'log_path',
+        type=str,
+        help='path to JSON log (for example, ida_log_all.json) or to SQLite '
+        'database')
+    parser.add_argument('--firmware',
+                        type=str,
+                        help='firmware name or SHA256 (for SQLite database)')
+    parser.add_argument('--requires',
+                        type=str,
+                        metavar='MODULE',
+                        help='modules that must be dispatched before MODULE')
+    parser.add_argument('--dependents',
+                        type=str,
+                        metavar='MODULE',
+                        help='modules that depend on MODULE')
+    parser.add_argument('--affected_by',
+                        type=str,
+                        metavar='GUID',
+                        help='modules affected if protocol disappears')
+    parser.add_argument('--cycles',
+                        action='store_true',
+                        help='groups of modules that depend on each other')
+    parser.add_argument('--dispatch_order',
+                        action='store_true',
+                        help='plausible dispatch order of all modules')
+
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.log_path):
+        print('[error] check file name')
+        return
+    graph = DepGraph(load_res_json(args.log_path, args.firmware))
+    for module in (args.requires, args.dependents):
+        if module is not None and module not in graph.ids:
+            print('[error] unknown module {}'.format(module))
+            return
+    if args.requires:
+        print_list('{} requires'.format(args.requires),
+                   graph.requires(args.requires))
+    if args.dependents:
+        print_list('{} dependents'.format(args.dependents),
+                   graph.dependents(args.dependents))
+    if args.affected_by:
+        print_list('Affected by {}'.format(args.affected_by),
+                   graph.affected_by(args.affected_by))
+    if args.cycles:
+        for cycle in graph.cycles():
+            print(' <-> '.join(cycle))
+    if args.dispatch_order:
+        for index, group in enumerate(graph.dispatch_order()):
+            print('{:4d} {}'.format(index, ', '.join(group)))
+
+
+if __name__ == '__main__':
+    main()
@@ -21,60 +21,211 @@
 # SOFTWARE.
 
 import argparse
+import hashlib
+import mmap
 import os
 import shutil
+import struct
 import sys
-from glob import glob
 
 import click
 import colorama
 import uefi_firmware
+from uefi_firmware.uefi import FirmwareVolume
+
+from . import metrics, profiler
 from .guid_db import UEFI_GUIDS
+from .scheduler import get_executor
+from .section_cache import CACHE_DIR, CACHE_SIZE, SectionCache
 
 dir_name = 'all'
 pe_dir = 'modules'
 
+# offset of the `_FVH` signature in the firmware volume header
+FVH_OFFSET = 40
+FVH_ALIGN = 8
+
+# Intel flash descriptor
+FLASH_SIGNATURE = b'\x5a\xa5\xf0\x0f'
+FLASH_SIGNATURE_OFFSET = 0x10
+FLMAP0_OFFSET = 0x14
+FLREG_BIOS = 1
+
+
+def get_pe_name(dirname, ui_files):
+    '''
+    get module name from UI section or from the GUID database
+    '''
+    if len(ui_files) == 1:
+        with open(ui_files[0], 'rb') as ui:
+            return ui.read().replace(b'\x00', b'').decode('utf-8')
+    # No UI section, try to get a friendly name from the GUID database.
+    pe_guid = get_file_guid(dirname)
+    pe_name = UEFI_GUIDS.get(pe_guid)
+    if not pe_name:
+        # Unknown GUID.
+        pe_name = pe_guid
+    return pe_name
+
+
+def get_file_guid(dirname):
+    '''
+    get GUID of the firmware file that contains the directory
+    '''
+    for name in reversed(dirname.split(os.path.sep)):
+        if name.startswith('file-'):
+            return name.replace('file-', '').upper()
+    return os.path.basename(dirname).upper()
+
+
+def get_short_hash(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()[:8]
+
+
+def collect_images(directory_name):
+    '''
+    get (path, name) pairs for all PE-images in the dump directory
+    '''
+    images = []
+    stack = [directory_name]
+    while stack:
+        dirname = stack.pop()
+        subdirs, pe_files, ui_files = [], [], []
+        for entry in os.scandir(dirname):
+            if entry.is_dir():
+                subdirs.append(entry.path)
+            elif entry.name[-3:] == '.pe':
+                pe_files.append(entry.path)
+            elif entry.name[-3:] == '.ui':
+                ui_files.append(entry.path)
+        stack.extend(sorted(subdirs, reverse=True))
+        for pe_path in sorted(pe_files):
+            images.append((pe_path, get_pe_name(dirname, ui_files)))
+    return images
+
+
+def link_image(src, dst):
+    '''
+    hardlink image to the modules directory (copy if hardlinks are
+    not supported)
+    '''
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
 
 def get_files(directory_name, pe_dir):
     if not os.path.isdir(pe_dir):
         os.mkdir(pe_dir)
+    images = collect_images(directory_name)
+    used_names = set()
     bar_template = click.style('%(label)s  %(bar)s | %(info)s', fg='cyan')
-    files = os.listdir(directory_name)
     label = 'Obtaining UEFI images'
-    with click.progressbar(files,
-                           length=len(files),
+    with click.progressbar(images,
+                           length=len(images),
                            bar_template=bar_template,
                            label=label) as bar:
-        for obj in bar:
-            src = os.path.join(directory_name, obj)
-            template = os.path.join(directory_name, '*.ui')
-            if os.path.isfile(src):
-                if obj[-3:] == '.pe':
-                    if len(glob(template)) == 1:
-                        ui_path = glob(template)[0]
-                        with open(ui_path, 'rb') as ui:
-                            pe_name = ui.read().replace(b'\x00', b'')
-                            dst = os.path.join(pe_dir, pe_name.decode('utf-8'))
-                    else:
-                        # No UI section, try to get a friendly name from the GUID database.
-                        pe_guid = directory_name.split(os.path.sep)[-2]
-                        pe_guid = pe_guid.replace("file-", "").upper()
-                        pe_name = UEFI_GUIDS.get(pe_guid)
-                        if not pe_name:
-                            # Unknown GUID.
-                            pe_name = pe_guid
-                        dst = os.path.join(pe_dir, pe_name)
-                    shutil.copy(src, dst)
-            if os.path.isdir(src):
-                get_files(src, pe_dir)
+        for src, pe_name in bar:
+            # modules with the same names are distinguished by GUID and hash
+            if pe_name in used_names:
+                pe_name = '{}_{}'.format(pe_name,
+                                         get_file_guid(os.path.dirname(src)))
+            if pe_name in used_names:
+                pe_name = '{}_{}'.format(pe_name, get_short_hash(src))
+            used_names.add(pe_name)
+            link_image(src, os.path.join(pe_dir, pe_name))
     return True
 
 
+def get_bios_region(data):
+    '''
+    get (base, end) of the BIOS region from Intel flash descriptor
+    (None if there is no descriptor)
+    '''
+    if data[FLASH_SIGNATURE_OFFSET:FLASH_SIGNATURE_OFFSET +
+            len(FLASH_SIGNATURE)] != FLASH_SIGNATURE:
+        return None
+    flmap0, = struct.unpack_from('<I', data, FLMAP0_OFFSET)
+    frba = ((flmap0 >> 16) & 0xff) << 4
+    if frba + 4 * (FLREG_BIOS + 1) > len(data):
+        return None
+    flreg, = struct.unpack_from('<I', data, frba + 4 * FLREG_BIOS)
+    base = (flreg & 0x7fff) << 12
+    end = (((flreg >> 16) & 0x7fff) + 1) << 12
+    # unused region has base greater than limit
+    if base >= end or end > len(data):
+        return None
+    return base, end
+
+
+def search_volumes(data, start, end):
+    '''
+    get offsets of `_FVH` signatures between start and end
+    '''
+    fvh = data.find(b'_FVH', start + FVH_OFFSET, end)
+    while fvh >= 0:
+        if not (fvh - start) % FVH_ALIGN:
+            yield fvh
+        fvh = data.find(b'_FVH', fvh + 1, end)
+
+
+def get_volumes(data, start=0, end=None):
+    '''
+    get (offset, size) pairs of top-level firmware volumes
+    '''
+    if end is None:
+        end = len(data)
+    volumes = []
+    volume_end = start
+    for fvh in search_volumes(data, start, end):
+        offset = fvh - FVH_OFFSET
+        # nested volumes are processed with their parent volume
+        if offset < volume_end:
+            continue
+        volume = FirmwareVolume(data[offset:offset + FirmwareVolume._HEADER_SIZE])
+        if not volume.valid_header or offset + volume.size > end:
+            continue
+        volumes.append((offset, volume.size))
+        volume_end = offset + volume.size
+    return volumes
+
+
+def dump_volume(args):
+    '''
+    parse firmware volume and dump it to `volume-<index>` directory
+    '''
+    (fw_name, offset, size, index, dir_name, cache_dir, cache_size,
+     profile_dir) = args
+    if profile_dir is not None:
+        return profiler.profile_call(profile_dir, 'volume-{}'.format(index),
+                                     dump_volume, args[:-1] + (None, ))
+    with open(fw_name, 'rb') as fw:
+        fw.seek(offset)
+        data = fw.read(size)
+    volume = FirmwareVolume(data, str(index))
+    cache = get_section_cache(cache_dir, cache_size)
+    if cache is None:
+        status = volume.process()
+    else:
+        with cache:
+            status = volume.process()
+    if status:
+        volume.dump(dir_name)
+    hits, misses = (0, 0) if cache is None else (cache.hits, cache.misses)
+    return index, status, hits, misses
+
+
 class Dumper():
-    def __init__(self, fw_name, dir_name, pe_dir):
+    def __init__(self, fw_name, dir_name, pe_dir, cache=None, jobs=None):
         self.fw_name = fw_name
         self.dir_name = dir_name
         self.pe_dir = pe_dir
+        self.cache = cache
+        self.jobs = jobs or os.cpu_count() or 1
         if not os.path.isdir(self.dir_name):
             os.mkdir(self.dir_name)
         if not os.path.isdir(self.pe_dir):
@@ -84,29 +235,93 @@ class Dumper():
         if not os.path.isfile(self.fw_name):
             print('[-] Check {0} file'.format(self.fw_name))
             return False
-        with open(self.fw_name, 'rb') as fw:
-            file_content = fw.read()
+        if not os.path.getsize(self.fw_name):
+            print('[-] This type of binary is not supported')
+            return False
+        with open(self.fw_name, 'rb') as fw, mmap.mmap(
+                fw.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            # skip ME, GbE and other regions of the SPI image
+            region = get_bios_region(data)
+            if region is None:
+                region = (0, len(data))
+            else:
+                print('[+] BIOS region: {0:#x}-{1:#x}'.format(*region))
+            volumes = get_volumes(data, *region)
+            if volumes:
+                return self.dump_volumes(volumes)
+            file_content = data[region[0]:region[1]]
         parser = uefi_firmware.AutoParser(file_content)
         if parser.type() == 'unknown':
             print('[-] This type of binary is not supported')
             return False
-        firmware = parser.parse()
+        if self.cache is None:
+            firmware = parser.parse()
+        else:
+            with self.cache:
+                firmware = parser.parse()
+            print(self.cache.get_stats())
         firmware.dump(self.dir_name)
         return True
 
+    def dump_volumes(self, volumes):
+        '''
+        parse independent firmware volumes in worker processes
+        (False if no volume is parsed)
+        '''
+        cache_dir, cache_size = None, None
+        if self.cache is not None:
+            cache_dir, cache_size = self.cache.cache_dir, self.cache.max_size
+        tasks = [(self.fw_name, offset, size, index, self.dir_name, cache_dir,
+                  cache_size, profiler.get_profile_dir())
+                 for index, (offset, size) in enumerate(volumes)]
+        jobs = min(self.jobs, len(tasks))
+        if jobs > 1:
+            with get_executor(dump_volume, jobs) as executor:
+                results = list(executor.map(dump_volume, tasks))
+        else:
+            results = [dump_volume(task) for task in tasks]
+        for index, status, hits, misses in results:
+            if not status:
+                print('[-] Could not parse volume-{0} ({1:#x})'.format(
+                    index, volumes[index][0]))
+            if self.cache is not None:
+                self.cache.hits += hits
+                self.cache.misses += misses
+        if self.cache is not None:
+            print(self.cache.get_stats())
+        return any([status for _, status, _, _ in results])
+
     def get_pe_files(self):
         get_files(self.dir_name, self.pe_dir)
 
 
-def get_efi_images(fw_name):
+def get_section_cache(cache_dir=CACHE_DIR, cache_size=CACHE_SIZE):
+    '''
+    get decompressed sections cache (None if cache_dir is not set)
+    '''
+    if not cache_dir:
+        return None
+    try:
+        return SectionCache(cache_dir, cache_size)
+    except OSError as e:
+        print('[-] Section cache is disabled: {}'.format(e))
+        return None
+
+
+def get_efi_images(fw_name, cache_dir=CACHE_DIR, jobs=None):
     '''
     for correct color display in uefi_firmware module
     '''
     colorama.init()
-    dumper = Dumper(fw_name, dir_name, pe_dir)
-    if not dumper.dump_all():
-        exit()
-    dumper.get_pe_files()
+    dumper = Dumper(fw_name, dir_name, pe_dir, get_section_cache(cache_dir),
+                    jobs)
+    with metrics.PHASE_SECONDS.time(phase='extract'), profiler.phase('extract'):
+        if not dumper.dump_all():
+            exit()
+        dumper.get_pe_files()
+    if dumper.cache is not None:
+        metrics.count_lookups('sections', dumper.cache.hits,
+                              dumper.cache.hits + dumper.cache.misses)
     return True
 
 
@@ -133,13 +348,54 @@ def main():
         help=
         'name of the directory containing all firmware PE-images (default: `modules`)',
         default=pe_dir)
+    parser.add_argument(
+        '--cache_dir',
+        type=str,
+        help=
+        'directory of the decompressed sections cache (default: `{}`)'.format(
+            CACHE_DIR),
+        default=CACHE_DIR)
+    parser.add_argument(
+        '--cache_size',
+        type=int,
+        help='maximum size of the decompressed sections cache in MB (default: {})'.
+        format(CACHE_SIZE >> 20),
+        default=CACHE_SIZE >> 20)
+    parser.add_argument('--no_cache',
+                        action='store_true',
+                        help='do not use the decompressed sections cache')
+    parser.add_argument(
+        '--jobs',
+        type=int,
+        help=
+        'number of processes for firmware volumes parsing (default: CPU count)',
+        default=None)
+    parser.add_argument(
+        '--profile',
+        type=str,
+        metavar='DIR',
+        help=
+        'save cProfile stats and collapsed stacks of extraction and of each volume to DIR'
+    )
 
     args = parser.parse_args()
 
-    dumper = Dumper(args.firmware_path, args.all_dir, args.pe_dir)
-    if not dumper.dump_all():
-        exit()
-    dumper.get_pe_files()
+    if args.profile:
+        profiler.enable(args.profile)
+
+    cache = None
+    if not args.no_cache:
+        cache = get_section_cache(args.cache_dir, args.cache_size << 20)
+    dumper = Dumper(args.firmware_path, args.all_dir, args.pe_dir, cache,
+                    args.jobs)
+    try:
+        with profiler.phase('extract'):
+            if not dumper.dump_all():
+                exit()
+            dumper.get_pe_files()
+    finally:
+        if args.profile:
+            profiler.print_breakdown(args.profile)
 
 
 if __name__ == '__main__':
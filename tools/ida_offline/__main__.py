@@ -0,0 +1,144 @@
+# MIT License
+#
+# Copyright (c) 2018-2019 yeggor
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import argparse
+import json
+import os
+import time
+
+from . import enable, open_database
+
+PHASES = ('load', 'boot_services', 'protocols', 'prot_names', 'data_guids')
+
+
+def get_module_paths(paths):
+    module_paths = []
+    for path in paths:
+        if os.path.isdir(path):
+            module_paths += [
+                os.path.join(path, name) for name in sorted(os.listdir(path))
+            ]
+        else:
+            module_paths.append(path)
+    return module_paths
+
+
+def get_module_json(analyser, module_name):
+    '''
+    get module results in md_to_json format
+    '''
+    from uefi_analyser.utils import get_guid_str
+    module_json = {
+        'module_name': module_name,
+        'boot_services': [],
+        'protocols': []
+    }
+    for service in analyser.gBServices:
+        for address in analyser.gBServices[service]:
+            module_json['boot_services'].append({
+                'address': '{addr:#x}'.format(addr=address),
+                'bs_name': 'EFI_BOOT_SERVICES->{}'.format(service)
+            })
+    for element in analyser.Protocols['all']:
+        module_json['protocols'].append({
+            'address': '{addr:#x}'.format(addr=element['address']),
+            'service': element['service'],
+            'protocol_name': element['protocol_name'],
+            'protocol_place': element['protocol_place'],
+            'guid': get_guid_str(element['guid'])
+        })
+    return module_json
+
+
+def analyse_module(module_path, times):
+    '''
+    analyse module as log_all.py does and add time of each phase to `times`
+    '''
+    from uefi_analyser.analyser import Analyser
+    start = time.perf_counter()
+    open_database(module_path)
+    analyser = Analyser()
+    times['load'] += time.perf_counter() - start
+    if not analyser.valid:
+        return None
+    for phase, method in [('boot_services', analyser.get_boot_services),
+                          ('protocols', analyser.get_protocols),
+                          ('prot_names', analyser.get_prot_names),
+                          ('data_guids', analyser.get_data_guids)]:
+        start = time.perf_counter()
+        method()
+        times[phase] += time.perf_counter() - start
+    return get_module_json(analyser, os.path.basename(module_path))
+
+
+def main():
+    program = 'python -m tools.ida_offline'
+    parser = argparse.ArgumentParser(
+        prog=program,
+        description='run UEFI analyser of IDA plugin without IDA '
+        '(modules are loaded and disassembled by the stand-in API)')
+    parser.add_argument('modules',
+                        type=str,
+                        nargs='+',
+                        help='modules or directories with modules '
+                        '(see tools/get_efi_images.py)')
+    parser.add_argument('--repeat',
+                        type=int,
+                        default=1,
+                        help='number of runs (the fastest one is reported)')
+    parser.add_argument('--json',
+                        type=str,
+                        metavar='PATH',
+                        help='save results in md_to_json format')
+    args = parser.parse_args()
+
+    enable()
+    from uefi_analyser.utils import get_dep_json
+    module_paths = get_module_paths(args.modules)
+    best = None
+    for _ in range(args.repeat):
+        times = dict((phase, 0) for phase in PHASES + ('dep_json', ))
+        res_json = []
+        for module_path in module_paths:
+            module_json = analyse_module(module_path, times)
+            if module_json is not None:
+                res_json.append(module_json)
+        start = time.perf_counter()
+        dep_json = get_dep_json(res_json)
+        times['dep_json'] = time.perf_counter() - start
+        if best is None or sum(times.values()) < sum(best.values()):
+            best = times
+    print('[*] {} of {} modules analysed, {} protocols, {} installed'.format(
+        len(res_json), len(module_paths),
+        sum(len(module_json['protocols']) for module_json in res_json),
+        len(dep_json)))
+    for phase, seconds in best.items():
+        print('{:<16} {:>9.3f}s'.format(phase, seconds))
+    print('{:<16} {:>9.3f}s'.format('total', sum(best.values())))
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump(res_json, out, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+# MIT License
+#
+# Copyright (c) 2018-2019 yeggor
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''
+stand-in of idaapi functions used by UEFI analyser (see tools/ida_offline)
+'''
+
+import os
+
+from tools.ida_offline.database import BADADDR, get_database
+
+ITP_SEMI = 65
+
+
+class DecompilationFailure(Exception):
+    pass
+
+
+class treeloc_t():
+    def __init__(self):
+        self.ea = BADADDR
+        self.itp = 0
+
+
+def get_imagebase():
+    return get_database().imagebase
+
+
+def get_input_file_path():
+    return get_database().module_path
+
+
+def get_root_filename():
+    return os.path.basename(get_database().module_path)
+
+
+def ask_str(defval, hist, prompt):
+    return defval
+
+
+def askstr(hist, defval, prompt):
+    return defval
+
+
+def decompile(ea):
+    raise DecompilationFailure('decompiler is not available')
@@ -0,0 +1,59 @@
+# MIT License
+#
+# Copyright (c) 2018-2019 yeggor
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''
+stand-in of idautils functions used by UEFI analyser (see tools/ida_offline)
+'''
+
+from tools.ida_offline.database import get_database
+
+
+def Functions(start=None, end=None):
+    for func in get_database().funcs:
+        if start is not None and func < start:
+            continue
+        if end is not None and func >= end:
+            break
+        yield func
+
+
+def Segments():
+    for segment in get_database().segments:
+        yield segment.start
+
+
+def Heads(start=None, end=None):
+    database = get_database()
+    for head in database.heads:
+        if start is not None and head < start:
+            continue
+        if end is not None and head >= end:
+            break
+        yield head
+
+
+def CodeRefsTo(ea, flow):
+    return iter(get_database().get_code_refs_to(ea, flow))
+
+
+def DataRefsFrom(ea):
+    return iter(get_database().get_data_refs_from(ea))
@@ -0,0 +1,163 @@
+# MIT License
+#
+# Copyright (c) 2018-2019 yeggor
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+'''
+stand-in of IDC functions used by UEFI analyser (see tools/ida_offline)
+'''
+
+from tools.ida_offline.database import BADADDR, get_database
+from tools.ida_offline.x86 import (o_displ, o_far, o_imm, o_mem, o_near,
+                                   o_phrase, o_reg, o_void)
+
+FUNCATTR_START = 0
+FUNCATTR_END = 4
+DELIT_SIMPLE = 0
+DELIT_EXPAND = 1
+DELIT_DELNAMES = 2
+
+
+def auto_wait():
+    return True
+
+
+def qexit(code):
+    raise SystemExit(code)
+
+
+def print_insn_mnem(ea):
+    insn = get_database().get_insn(ea)
+    if insn is None:
+        return ''
+    return insn.mnem
+
+
+def print_operand(ea, n):
+    return get_database().print_operand(ea, n)
+
+
+def get_operand_type(ea, n):
+    insn = get_database().get_insn(ea)
+    if insn is None:
+        return -1
+    op = insn.get_op(n)
+    if op is None:
+        return o_void
+    return op.type
+
+
+def get_operand_value(ea, n):
+    insn = get_database().get_insn(ea)
+    if insn is None or insn.get_op(n) is None:
+        return -1
+    return insn.get_op(n).value
+
+
+def next_head(ea, maxea=BADADDR):
+    return get_database().next_head(ea, maxea)
+
+
+def prev_head(ea, minea=0):
+    return get_database().prev_head(ea, minea)
+
+
+def get_segm_start(ea):
+    segment = get_database().get_segment(ea)
+    if segment is None:
+        return BADADDR
+    return segment.start
+
+
+def get_segm_end(ea):
+    segment = get_database().get_segment(ea)
+    if segment is None:
+        return BADADDR
+    return segment.end
+
+
+def get_segm_name(ea):
+    segment = get_database().get_segment(ea)
+    if segment is None:
+        return ''
+    return segment.name
+
+
+def get_func_attr(ea, attr):
+    database = get_database()
+    start = database.get_func_start(ea)
+    if start == BADADDR or attr == FUNCATTR_START:
+        return start
+    if attr == FUNCATTR_END:
+        heads = [head for head, owner in database.owners.items()
+                 if owner == start]
+        last = max(heads)
+        return last + database.get_insn(last).size
+    return BADADDR
+
+
+def get_wide_byte(ea):
+    return get_database().get_bytes(ea, 1)[0]
+
+
+def get_wide_word(ea):
+    return int.from_bytes(get_database().get_bytes(ea, 2), 'little')
+
+
+def get_wide_dword(ea):
+    return int.from_bytes(get_database().get_bytes(ea, 4), 'little')
+
+
+def get_qword(ea):
+    return int.from_bytes(get_database().get_bytes(ea, 8), 'little')
+
+
+def get_name(ea, gtn_flags=0):
+    return get_database().get_name(ea)
+
+
+def set_name(ea, name, flags=0):
+    return get_database().set_name(ea, name)
+
+
+def SetType(ea, newtype):
+    get_database().types[ea] = newtype
+    return True
+
+
+def get_type(ea):
+    return get_database().types.get(ea)
+
+
+def import_type(idx, type_name):
+    return get_database().get_struc_id(type_name)
+
+
+def get_struc_id(name):
+    return get_database().get_struc_id(name)
+
+
+def set_cmt(ea, comment, rptble):
+    get_database().comments[ea] = comment
+    return True
+
+
+def op_stroff(ea, n, strid, delta):
+    return get_database().get_insn(ea) is not None
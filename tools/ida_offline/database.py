@@ -0,0 +1,369 @@
+# MIT License
+#
+# Copyright (c) 2018-2019 yeggor
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import bisect
+import struct
+
+from .x86 import Decoder, o_imm, o_mem, o_near
+
+BADADDR = 0xffffffffffffffff
+IMAGE_FILE_MACHINE_IA64 = 0x8664
+IMAGE_NT_OPTIONAL_HDR64_MAGIC = 0x20b
+IMAGE_SCN_MEM_EXECUTE = 0x20000000
+IMAGE_DIRECTORY_ENTRY_EXCEPTION = 3
+UNW_FLAG_CHAININFO = 4
+PE_OFFSET = 0x3c
+# bytes of uninitialized data are read as in IDA
+UNINITIALIZED = 0xff
+# instructions after which the execution does not continue
+STOP_MNEMS = ('retn', 'retf', 'iret', 'int3', 'hlt', 'ud2', 'jmp')
+JUMP_MNEMS = ('loop', 'loope', 'loopne', 'jrcxz')
+DUMMY_PREFIXES = {
+    1: 'byte_',
+    2: 'word_',
+    4: 'dword_',
+    8: 'qword_',
+    16: 'xmmword_'
+}
+
+CURRENT = None
+
+
+class Segment():
+    def __init__(self, name, start, end, data, executable):
+        self.name = name
+        self.start = start
+        self.end = end
+        self.data = data
+        self.executable = executable
+
+
+class Database():
+    '''
+    database of PE module loaded like IDA does (each section is a segment
+    at the image base), functions are found by recursive descent from the
+    entry point, the exception directory (x64) and call targets
+    '''
+    def __init__(self, module_path):
+        self.module_path = module_path
+        with open(module_path, 'rb') as module:
+            self.image = module.read()
+        self.segments = []
+        self.imagebase = 0
+        self.entry = None
+        self.mode = 64
+        self.runtime_functions = []
+        self.load()
+        self.decoder = Decoder(self.mode)
+        self.starts = [segment.start for segment in self.segments]
+        # instruction address -> instruction
+        self.insns = {}
+        # instruction address -> function start
+        self.owners = {}
+        self.heads = []
+        self.funcs = []
+        self.crefs_to = {}
+        self.drefs_from = {}
+        self.names = {}
+        self.types = {}
+        self.comments = {}
+        self.structs = {}
+        self.analyse()
+
+    def load(self):
+        image = self.image
+        if image[:2] != b'MZ' or len(image) < PE_OFFSET + 4:
+            return
+        pe_pointer, = struct.unpack_from('<I', image, PE_OFFSET)
+        if image[pe_pointer:pe_pointer + 4] != b'PE\x00\x00':
+            return
+        machine, sections_num = struct.unpack_from('<HH', image,
+                                                   pe_pointer + 4)
+        opt_size, = struct.unpack_from('<H', image, pe_pointer + 20)
+        opt_pointer = pe_pointer + 24
+        magic, = struct.unpack_from('<H', image, opt_pointer)
+        entry, = struct.unpack_from('<I', image, opt_pointer + 16)
+        alignment, = struct.unpack_from('<I', image, opt_pointer + 32)
+        if magic == IMAGE_NT_OPTIONAL_HDR64_MAGIC:
+            self.imagebase, = struct.unpack_from('<Q', image, opt_pointer + 24)
+            directories = opt_pointer + 112
+        else:
+            self.imagebase, = struct.unpack_from('<I', image, opt_pointer + 28)
+            directories = opt_pointer + 96
+        self.mode = 64 if machine == IMAGE_FILE_MACHINE_IA64 else 32
+        alignment = max(alignment, 1)
+        for index in range(sections_num):
+            offset = opt_pointer + opt_size + index * 40
+            if len(image) < offset + 40:
+                break
+            (name, virtual_size, virtual_address, raw_size, raw_offset,
+             characteristics) = struct.unpack_from('<8sIIII12xI', image,
+                                                   offset)
+            size = virtual_size or raw_size
+            size = (size + alignment - 1) // alignment * alignment
+            raw = image[raw_offset:raw_offset + min(raw_size, size)]
+            data = raw + bytes([UNINITIALIZED]) * (size - len(raw))
+            start = self.imagebase + virtual_address
+            self.segments.append(
+                Segment(name.rstrip(b'\x00').decode('utf-8', 'replace'),
+                        start, start + size, data,
+                        bool(characteristics & IMAGE_SCN_MEM_EXECUTE)))
+        self.segments.sort(key=lambda segment: segment.start)
+        self.entry = self.imagebase + entry
+        if self.mode == 64:
+            rva, size = struct.unpack_from(
+                '<II', image, directories + IMAGE_DIRECTORY_ENTRY_EXCEPTION * 8)
+            self.runtime_functions = self.get_runtime_functions(rva, size)
+
+    def get_runtime_functions(self, rva, size):
+        '''
+        get (begin, end, function begin) of exception directory entries,
+        chained entries are chunks of their parent functions
+        '''
+        entries = []
+        for offset in range(0, size - size % 12, 12):
+            data = self.get_bytes(self.imagebase + rva + offset, 12)
+            begin, end, unwind = struct.unpack('<III', data)
+            if not begin or begin >= end:
+                continue
+            entries.append((begin, end, unwind))
+        parents = {}
+        for begin, end, unwind in entries:
+            parent = begin
+            for _ in range(len(entries)):
+                info = self.get_bytes(self.imagebase + unwind, 4)
+                if not info[0] >> 3 & UNW_FLAG_CHAININFO:
+                    break
+                codes = (info[2] + 1) & ~1
+                chained = self.get_bytes(self.imagebase + unwind + 4 + codes * 2,
+                                         12)
+                parent, _, unwind = struct.unpack('<III', chained)
+            parents[begin] = parent
+        return [(self.imagebase + begin, self.imagebase + end,
+                 self.imagebase + parents[begin])
+                for begin, end, _ in entries]
+
+    def get_segment(self, ea):
+        index = bisect.bisect_right(self.starts, ea) - 1
+        if index < 0:
+            return None
+        segment = self.segments[index]
+        if ea >= segment.end:
+            return None
+        return segment
+
+    def is_code(self, ea):
+        segment = self.get_segment(ea)
+        return segment is not None and segment.executable
+
+    def get_bytes(self, ea, size):
+        '''
+        get bytes, bytes outside of segments are read as uninitialized
+        '''
+        data = bytearray()
+        while len(data) < size:
+            segment = self.get_segment(ea + len(data))
+            if segment is None:
+                data.append(UNINITIALIZED)
+                continue
+            offset = ea + len(data) - segment.start
+            data += segment.data[offset:offset + size - len(data)]
+        return bytes(data)
+
+    def analyse(self):
+        '''
+        find functions, instructions and cross references
+        '''
+        chunks = {}
+        for begin, end, parent in self.runtime_functions:
+            chunks.setdefault(parent, []).append((begin, end))
+        funcs = set(chunks)
+        if self.entry is not None and self.is_code(self.entry):
+            funcs.add(self.entry)
+        pending = sorted(funcs)
+        while pending:
+            targets = set()
+            for start in pending:
+                targets.update(self.explore(start, chunks.get(start), funcs))
+            pending = sorted(target for target in targets
+                             if not target in funcs and self.is_code(target)
+                             and not target in self.insns)
+            funcs.update(pending)
+        self.funcs = sorted(start for start in funcs if start in self.insns)
+        self.heads = sorted(self.insns)
+        self.make_names()
+
+    def explore(self, start, chunks, funcs):
+        '''
+        decode function by recursive descent (within its exception directory
+        chunks if they are known), targets of calls and tail jumps are
+        returned
+        '''
+        targets = []
+        work = [start]
+        while work:
+            ea = work.pop()
+            while not ea in self.insns:
+                if chunks is not None and not any(
+                        begin <= ea < end for begin, end in chunks):
+                    targets.append(ea)
+                    break
+                if ea != start and ea in funcs:
+                    break
+                segment = self.get_segment(ea)
+                if segment is None or not segment.executable:
+                    break
+                insn = self.decoder.decode(segment.data, ea - segment.start,
+                                           ea)
+                if insn is None:
+                    break
+                self.insns[ea] = insn
+                self.owners[ea] = start
+                for op in insn.ops:
+                    # immediates of x86 code are offsets if they point
+                    # into the module
+                    if (op.type == o_mem or
+                        (self.mode == 32 and op.type == o_imm
+                         and insn.mnem in ('push', 'mov'))) and (
+                             self.get_segment(op.value) is not None):
+                        self.drefs_from.setdefault(ea, []).append(op.value)
+                op = insn.get_op(0)
+                if op is not None and op.type == o_near:
+                    self.crefs_to.setdefault(op.value, []).append(ea)
+                    if insn.mnem == 'call':
+                        targets.append(op.value)
+                    elif insn.mnem == 'jmp':
+                        if op.value in funcs:
+                            targets.append(op.value)
+                        else:
+                            work.append(op.value)
+                    elif insn.mnem[0] == 'j' or insn.mnem in JUMP_MNEMS:
+                        work.append(op.value)
+                if insn.mnem in STOP_MNEMS:
+                    break
+                ea += insn.size
+        return targets
+
+    def make_names(self):
+        '''
+        make dummy names of functions, labels and referenced data
+        '''
+        for target in self.crefs_to:
+            if target in self.insns:
+                self.names[target] = 'loc_{:X}'.format(target)
+        for start in self.funcs:
+            self.names[start] = 'sub_{:X}'.format(start)
+        if self.entry in self.insns:
+            self.names[self.entry] = 'start'
+        sizes = {}
+        for ea, targets in self.drefs_from.items():
+            insn = self.insns[ea]
+            for target in targets:
+                if target in self.insns:
+                    continue
+                size = 0
+                for op in insn.ops:
+                    if op.type == o_mem and op.value == target:
+                        size = op.size
+                # typed data names take precedence over unknown bytes
+                sizes[target] = max(sizes.get(target, 0), size)
+        for target, size in sizes.items():
+            self.names[target] = '{}{:X}'.format(
+                DUMMY_PREFIXES.get(size, 'unk_'), target)
+
+    def get_insn(self, ea):
+        return self.insns.get(ea)
+
+    def get_func_start(self, ea):
+        if ea in self.owners:
+            return self.owners[ea]
+        index = bisect.bisect_right(self.heads, ea) - 1
+        if index < 0:
+            return BADADDR
+        head = self.heads[index]
+        if ea < head + self.insns[head].size:
+            return self.owners[head]
+        return BADADDR
+
+    def next_head(self, ea, maxea=BADADDR):
+        index = bisect.bisect_right(self.heads, ea)
+        if index >= len(self.heads) or self.heads[index] >= maxea:
+            return BADADDR
+        return self.heads[index]
+
+    def prev_head(self, ea, minea=0):
+        index = bisect.bisect_left(self.heads, ea) - 1
+        if index < 0 or self.heads[index] < minea:
+            return BADADDR
+        return self.heads[index]
+
+    def print_operand(self, ea, n):
+        insn = self.insns.get(ea)
+        if insn is None or insn.get_op(n) is None:
+            return ''
+        op = insn.get_op(n)
+        if op.type in (o_mem, o_near) and op.value in self.names:
+            name = self.names[op.value]
+            if op.type == o_near or not op.size:
+                return name
+            return ('cs:' if self.mode == 64 else 'ds:') + name
+        return op.text
+
+    def get_code_refs_to(self, ea, flow):
+        refs = list(self.crefs_to.get(ea, []))
+        if flow:
+            prev = self.prev_head(ea)
+            if (prev != BADADDR and prev + self.insns[prev].size == ea
+                    and not self.insns[prev].mnem in STOP_MNEMS):
+                refs.insert(0, prev)
+        return refs
+
+    def get_data_refs_from(self, ea):
+        return list(self.drefs_from.get(ea, []))
+
+    def get_name(self, ea):
+        return self.names.get(ea, '')
+
+    def set_name(self, ea, name):
+        if self.get_segment(ea) is None:
+            return False
+        self.names[ea] = name
+        return True
+
+    def get_struc_id(self, name):
+        return self.structs.setdefault(name, 0xff000000 + len(self.structs))
+
+
+def open_database(module_path):
+    '''
+    load module as the current database of the stand-in API
+    '''
+    global CURRENT
+    CURRENT = Database(module_path)
+    return CURRENT
+
+
+def get_database():
+    if CURRENT is None:
+        raise RuntimeError('no database is opened')
+    return CURRENT
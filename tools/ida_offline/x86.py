@@ -0,0 +1,648 @@
+# MIT License
+#
+# Copyright (c) 2018-2019 yeggor
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+'''
+operand types (values of idc.o_* constants)
+'''
+o_void = 0
+o_reg = 1
+o_mem = 2
+o_phrase = 3
+o_displ = 4
+o_imm = 5
+o_far = 6
+o_near = 7
+
+# longest valid instruction
+MAX_INSN_SIZE = 15
+
+REGS = {
+    8: [
+        'rax', 'rcx', 'rdx', 'rbx', 'rsp', 'rbp', 'rsi', 'rdi', 'r8', 'r9',
+        'r10', 'r11', 'r12', 'r13', 'r14', 'r15'
+    ],
+    4: [
+        'eax', 'ecx', 'edx', 'ebx', 'esp', 'ebp', 'esi', 'edi', 'r8d', 'r9d',
+        'r10d', 'r11d', 'r12d', 'r13d', 'r14d', 'r15d'
+    ],
+    2: [
+        'ax', 'cx', 'dx', 'bx', 'sp', 'bp', 'si', 'di', 'r8w', 'r9w', 'r10w',
+        'r11w', 'r12w', 'r13w', 'r14w', 'r15w'
+    ],
+    1: [
+        'al', 'cl', 'dl', 'bl', 'spl', 'bpl', 'sil', 'dil', 'r8b', 'r9b',
+        'r10b', 'r11b', 'r12b', 'r13b', 'r14b', 'r15b'
+    ]
+}
+LEGACY_BYTE_REGS = ['al', 'cl', 'dl', 'bl', 'ah', 'ch', 'dh', 'bh']
+MEM_16 = ['bx+si', 'bx+di', 'bp+si', 'bp+di', 'si', 'di', 'bp', 'bx']
+PTR_NAMES = {
+    1: 'byte ptr ',
+    2: 'word ptr ',
+    4: 'dword ptr ',
+    8: 'qword ptr ',
+    16: 'xmmword ptr '
+}
+'''
+register numbers of IDA x86 processor module
+'''
+R_al = 16
+R_ah = 20
+R_spl = 24
+R_rip = 28
+
+ARITH = ['add', 'or', 'adc', 'sbb', 'and', 'sub', 'xor', 'cmp']
+SHIFTS = ['rol', 'ror', 'rcl', 'rcr', 'shl', 'shr', 'sal', 'sar']
+CONDITIONS = [
+    'o', 'no', 'b', 'nb', 'z', 'nz', 'be', 'a', 's', 'ns', 'p', 'np', 'l',
+    'ge', 'le', 'g'
+]
+GROUPS = {
+    'grp1': ARITH,
+    'grp2': SHIFTS,
+    'grp3': ['test', 'test', 'not', 'neg', 'mul', 'imul', 'div', 'idiv'],
+    'grp4': ['inc', 'dec', None, None, None, None, None, None],
+    'grp5': ['inc', 'dec', 'call', 'callfi', 'jmp', 'jmpfi', 'push', None],
+    'grp8': [None, None, None, None, 'bt', 'bts', 'btr', 'btc'],
+    'grp11': ['mov', None, None, None, None, None, None, None],
+    'grp1a': ['pop', None, None, None, None, None, None, None]
+}
+'''
+one-byte opcodes: opcode -> (mnemonic or group, operands), operands are
+E/G (ModRM r/m and reg), Z (register in opcode), I/J (immediate and
+relative target), O (memory offset), M (memory only) with size b (byte),
+w (word), v (operand size), z (immediate of operand size, at most 32-bit),
+q (qword in 64-bit mode), s (sign-extended byte)
+'''
+OPCODES = {}
+for index, name in enumerate(ARITH):
+    for low, operands in enumerate(
+        ['Eb,Gb', 'Ev,Gv', 'Gb,Eb', 'Gv,Ev', 'AL,Ib', 'rAX,Iz']):
+        OPCODES[index * 8 + low] = (name, operands)
+for opcode, name in [(0x06, 'push'), (0x07, 'pop'), (0x0e, 'push'),
+                     (0x16, 'push'), (0x17, 'pop'), (0x1e, 'push'),
+                     (0x1f, 'pop'), (0x27, 'daa'), (0x2f, 'das'),
+                     (0x37, 'aaa'), (0x3f, 'aas')]:
+    OPCODES[opcode] = (name, 'i64')
+for low in range(8):
+    OPCODES[0x40 + low] = ('inc', 'Zv')
+    OPCODES[0x48 + low] = ('dec', 'Zv')
+    OPCODES[0x50 + low] = ('push', 'Zq')
+    OPCODES[0x58 + low] = ('pop', 'Zq')
+    OPCODES[0xb0 + low] = ('mov', 'Zb,Ib')
+    OPCODES[0xb8 + low] = ('mov', 'Zv,Iv')
+for low, condition in enumerate(CONDITIONS):
+    OPCODES[0x70 + low] = ('j' + condition, 'Jb')
+OPCODES.update({
+    0x60: ('pusha', 'i64'),
+    0x61: ('popa', 'i64'),
+    0x62: ('bound', 'Gv,M'),
+    0x63: ('movsxd', 'Gv,Ed'),
+    0x68: ('push', 'Iz'),
+    0x69: ('imul', 'Gv,Ev,Iz'),
+    0x6a: ('push', 'Is'),
+    0x6b: ('imul', 'Gv,Ev,Is'),
+    0x6c: ('insb', ''),
+    0x6d: ('ins', ''),
+    0x6e: ('outsb', ''),
+    0x6f: ('outs', ''),
+    0x80: ('grp1', 'Eb,Ib'),
+    0x81: ('grp1', 'Ev,Iz'),
+    0x82: ('grp1', 'Eb,Ib'),
+    0x83: ('grp1', 'Ev,Is'),
+    0x84: ('test', 'Eb,Gb'),
+    0x85: ('test', 'Ev,Gv'),
+    0x86: ('xchg', 'Eb,Gb'),
+    0x87: ('xchg', 'Ev,Gv'),
+    0x88: ('mov', 'Eb,Gb'),
+    0x89: ('mov', 'Ev,Gv'),
+    0x8a: ('mov', 'Gb,Eb'),
+    0x8b: ('mov', 'Gv,Ev'),
+    0x8c: ('mov', 'Ew'),
+    0x8d: ('lea', 'Gv,M'),
+    0x8e: ('mov', 'Ew'),
+    0x8f: ('grp1a', 'Eq'),
+    0x90: ('nop', ''),
+    0x98: ('cwde', ''),
+    0x99: ('cdq', ''),
+    0x9a: ('callfi', 'Ap'),
+    0x9b: ('wait', ''),
+    0x9c: ('pushf', ''),
+    0x9d: ('popf', ''),
+    0x9e: ('sahf', ''),
+    0x9f: ('lahf', ''),
+    0xa0: ('mov', 'AL,Ob'),
+    0xa1: ('mov', 'rAX,Ov'),
+    0xa2: ('mov', 'Ob,AL'),
+    0xa3: ('mov', 'Ov,rAX'),
+    0xa4: ('movsb', ''),
+    0xa5: ('movs', ''),
+    0xa6: ('cmpsb', ''),
+    0xa7: ('cmps', ''),
+    0xa8: ('test', 'AL,Ib'),
+    0xa9: ('test', 'rAX,Iz'),
+    0xaa: ('stosb', ''),
+    0xab: ('stos', ''),
+    0xac: ('lodsb', ''),
+    0xad: ('lods', ''),
+    0xae: ('scasb', ''),
+    0xaf: ('scas', ''),
+    0xc0: ('grp2', 'Eb,Ib'),
+    0xc1: ('grp2', 'Ev,Ib'),
+    0xc2: ('retn', 'Iw'),
+    0xc3: ('retn', ''),
+    0xc4: ('les', 'Gv,M'),
+    0xc5: ('lds', 'Gv,M'),
+    0xc6: ('grp11', 'Eb,Ib'),
+    0xc7: ('grp11', 'Ev,Iz'),
+    0xc8: ('enter', 'Iw,Ib'),
+    0xc9: ('leave', ''),
+    0xca: ('retf', 'Iw'),
+    0xcb: ('retf', ''),
+    0xcc: ('int3', ''),
+    0xcd: ('int', 'Ib'),
+    0xce: ('into', 'i64'),
+    0xcf: ('iret', ''),
+    0xd0: ('grp2', 'Eb,1'),
+    0xd1: ('grp2', 'Ev,1'),
+    0xd2: ('grp2', 'Eb,CL'),
+    0xd3: ('grp2', 'Ev,CL'),
+    0xd4: ('aam', 'i64,Ib'),
+    0xd5: ('aad', 'i64,Ib'),
+    0xd6: ('salc', 'i64'),
+    0xd7: ('xlat', ''),
+    0xe0: ('loopne', 'Jb'),
+    0xe1: ('loope', 'Jb'),
+    0xe2: ('loop', 'Jb'),
+    0xe3: ('jrcxz', 'Jb'),
+    0xe4: ('in', 'AL,Ib'),
+    0xe5: ('in', 'rAX,Ib'),
+    0xe6: ('out', 'Ib,AL'),
+    0xe7: ('out', 'Ib,rAX'),
+    0xe8: ('call', 'Jz'),
+    0xe9: ('jmp', 'Jz'),
+    0xea: ('jmpfi', 'Ap'),
+    0xeb: ('jmp', 'Jb'),
+    0xec: ('in', ''),
+    0xed: ('in', ''),
+    0xee: ('out', ''),
+    0xef: ('out', ''),
+    0xf1: ('int1', ''),
+    0xf4: ('hlt', ''),
+    0xf5: ('cmc', ''),
+    0xf6: ('grp3', 'Eb'),
+    0xf7: ('grp3', 'Ev'),
+    0xf8: ('clc', ''),
+    0xf9: ('stc', ''),
+    0xfa: ('cli', ''),
+    0xfb: ('sti', ''),
+    0xfc: ('cld', ''),
+    0xfd: ('std', ''),
+    0xfe: ('grp4', 'Eb'),
+    0xff: ('grp5', 'Ev')
+})
+for low in range(1, 8):
+    OPCODES[0x90 + low] = ('xchg', 'Zv,rAX')
+for opcode in range(0xd8, 0xe0):
+    OPCODES[opcode] = ('fpu', 'E')
+'''
+two-byte opcodes (0F xx) with operands, the rest have ModRM operand
+and are named by opcode
+'''
+OPCODES_0F = {
+    0x05: ('syscall', ''),
+    0x06: ('clts', ''),
+    0x07: ('sysret', ''),
+    0x08: ('invd', ''),
+    0x09: ('wbinvd', ''),
+    0x0b: ('ud2', ''),
+    0x0e: ('femms', ''),
+    0x1f: ('nop', 'E'),
+    0x30: ('wrmsr', ''),
+    0x31: ('rdtsc', ''),
+    0x32: ('rdmsr', ''),
+    0x33: ('rdpmc', ''),
+    0x34: ('sysenter', ''),
+    0x35: ('sysexit', ''),
+    0x37: ('getsec', ''),
+    0x77: ('emms', ''),
+    0xa0: ('push', ''),
+    0xa1: ('pop', ''),
+    0xa2: ('cpuid', ''),
+    0xa3: ('bt', 'Ev,Gv'),
+    0xa4: ('shld', 'Ev,Gv,Ib'),
+    0xa5: ('shld', 'Ev,Gv,CL'),
+    0xa8: ('push', ''),
+    0xa9: ('pop', ''),
+    0xaa: ('rsm', ''),
+    0xab: ('bts', 'Ev,Gv'),
+    0xac: ('shrd', 'Ev,Gv,Ib'),
+    0xad: ('shrd', 'Ev,Gv,CL'),
+    0xaf: ('imul', 'Gv,Ev'),
+    0xb0: ('cmpxchg', 'Eb,Gb'),
+    0xb1: ('cmpxchg', 'Ev,Gv'),
+    0xb3: ('btr', 'Ev,Gv'),
+    0xb6: ('movzx', 'Gv,Eb'),
+    0xb7: ('movzx', 'Gv,Ew'),
+    0xba: ('grp8', 'Ev,Ib'),
+    0xbb: ('btc', 'Ev,Gv'),
+    0xbc: ('bsf', 'Gv,Ev'),
+    0xbd: ('bsr', 'Gv,Ev'),
+    0xbe: ('movsx', 'Gv,Eb'),
+    0xbf: ('movsx', 'Gv,Ew'),
+    0xc0: ('xadd', 'Eb,Gb'),
+    0xc1: ('xadd', 'Ev,Gv')
+}
+for low, condition in enumerate(CONDITIONS):
+    OPCODES_0F[0x40 + low] = ('cmov' + condition, 'Gv,Ev')
+    OPCODES_0F[0x80 + low] = ('j' + condition, 'Jz')
+    OPCODES_0F[0x90 + low] = ('set' + condition, 'Eb')
+for low in range(8):
+    OPCODES_0F[0xc8 + low] = ('bswap', 'Zv')
+# two-byte opcodes with ModRM and imm8
+IMM8_0F = (0x0f, 0x70, 0x71, 0x72, 0x73, 0xc2, 0xc4, 0xc5, 0xc6)
+INVALID_0F = (0x04, 0x0a, 0x0c, 0x24, 0x25, 0x26, 0x27, 0x36, 0x39, 0x3b,
+              0x3c, 0x3d, 0x3e, 0x3f, 0xa6, 0xa7)
+
+
+class Operand():
+    '''
+    decoded operand, `value` is the same as returned by
+    idc.get_operand_value
+    '''
+    __slots__ = ['type', 'value', 'size', 'text']
+
+    def __init__(self, op_type, value, size=0, text=''):
+        self.type = op_type
+        self.value = value
+        self.size = size
+        self.text = text
+
+
+class Insn():
+    __slots__ = ['ea', 'size', 'mnem', 'ops']
+
+    def __init__(self, ea, size, mnem, ops):
+        self.ea = ea
+        self.size = size
+        self.mnem = mnem
+        self.ops = ops
+
+    def get_op(self, n):
+        if n < len(self.ops):
+            return self.ops[n]
+        return None
+
+
+def format_num(value):
+    '''
+    format number as IDA does (10h, 0A8h)
+    '''
+    if value < 10:
+        return str(value)
+    text = '{:X}h'.format(value)
+    if text[0] > '9':
+        text = '0' + text
+    return text
+
+
+def format_disp(disp):
+    if disp < 0:
+        return '-' + format_num(-disp)
+    return '+' + format_num(disp)
+
+
+def get_reg(number, size, rex):
+    '''
+    get register number of IDA and register name
+    '''
+    if size == 1:
+        if number < 4:
+            return R_al + number, REGS[1][number]
+        if number >= 8:
+            return number, REGS[1][number]
+        if rex:
+            return R_spl + number - 4, REGS[1][number]
+        return R_ah + number - 4, LEGACY_BYTE_REGS[number]
+    return number, REGS[size][number]
+
+
+class Decoder():
+    '''
+    decoder of x86 (mode=32) or x64 (mode=64) code
+    '''
+    def __init__(self, mode=64):
+        self.mode = mode
+        self.mask = (1 << mode) - 1
+
+    def decode(self, data, offset, ea):
+        '''
+        decode instruction at offset of data (loaded at ea),
+        None is returned for invalid or truncated instruction
+        '''
+        try:
+            return self._decode(data, offset, ea)
+        except IndexError:
+            return None
+
+    def _decode(self, data, offset, ea):
+        start = offset
+        opsize, adsize = 4, self.mode // 8
+        if self.mode == 32:
+            adsize = 4
+        rep, rex = None, 0
+        while True:
+            byte = data[offset]
+            if byte == 0x66:
+                opsize = 2
+            elif byte == 0x67:
+                adsize = 4 if self.mode == 64 else 2
+            elif byte in (0xf2, 0xf3):
+                rep = byte
+            elif not byte in (0xf0, 0x26, 0x2e, 0x36, 0x3e, 0x64, 0x65):
+                break
+            offset += 1
+            if offset - start >= MAX_INSN_SIZE:
+                return None
+        if self.mode == 64 and 0x40 <= byte <= 0x4f:
+            rex = byte
+            offset += 1
+            byte = data[offset]
+            if rex & 8:
+                opsize = 8
+        offset += 1
+        vex = None
+        if byte == 0x0f:
+            opcode = data[offset]
+            offset += 1
+            if opcode in (0x38, 0x3a):
+                table = opcode
+                opcode = data[offset]
+                offset += 1
+                mnem, operands = '', 'E'
+                if table == 0x3a:
+                    operands = 'E,Ib'
+            else:
+                if opcode in INVALID_0F:
+                    return None
+                table = 0x0f
+                mnem, operands = OPCODES_0F.get(opcode, ('', 'E'))
+                if not mnem and opcode in IMM8_0F:
+                    operands = 'E,Ib'
+            if not mnem:
+                mnem = 'op_{:02x}{:02x}'.format(table, opcode)
+                if rep is not None:
+                    mnem += '_{:02x}'.format(rep)
+        elif byte in (0xc4, 0xc5) and (self.mode == 64
+                                       or data[offset] >= 0xc0):
+            # VEX prefix, only lengths are decoded
+            if byte == 0xc4:
+                rex = 0x40 | (~data[offset] >> 5 & 7) | (data[offset + 1]
+                                                          >> 4 & 8)
+                table = {1: 0x0f, 2: 0x38, 3: 0x3a}.get(data[offset] & 0x1f)
+                if table is None:
+                    return None
+                offset += 2
+            else:
+                rex = 0x40 | (~data[offset] >> 5 & 4)
+                table = 0x0f
+                offset += 1
+            opcode = data[offset]
+            offset += 1
+            vex = table
+            mnem = 'vex_{:02x}{:02x}'.format(table, opcode)
+            operands = 'E'
+            if table == 0x3a or (table == 0x0f and opcode in IMM8_0F):
+                operands = 'E,Ib'
+            if table == 0x0f and opcode == 0x77:
+                operands = ''
+        else:
+            opcode = byte
+            if not opcode in OPCODES:
+                return None
+            mnem, operands = OPCODES[opcode]
+            if self.mode == 64 and operands.startswith('i64'):
+                return None
+            operands = operands.replace('i64', '').lstrip(',')
+            if self.mode == 64 and opcode in (0x62, 0x82, 0x9a, 0xea):
+                return None
+            if self.mode == 64 and opcode == 0x90 and rex & 1:
+                mnem, operands = 'xchg', 'Zv,rAX'
+            if opcode == 0x90 and rep == 0xf3:
+                mnem = 'pause'
+            if opcode in (0x98, 0x99) and opsize != 4:
+                mnem = {
+                    (0x98, 2): 'cbw',
+                    (0x98, 8): 'cdqe',
+                    (0x99, 2): 'cwd',
+                    (0x99, 8): 'cqo'
+                }[(opcode, opsize)]
+            if rep is not None and mnem in ('movs', 'movsb', 'stos', 'stosb',
+                                            'lods', 'lodsb', 'ins', 'insb',
+                                            'outs', 'outsb'):
+                mnem = 'rep ' + mnem
+            if rep is not None and mnem in ('cmps', 'cmpsb', 'scas',
+                                            'scasb'):
+                mnem = ('repe ' if rep == 0xf3 else 'repne ') + mnem
+        tokens = [token for token in operands.split(',') if token]
+        modrm = None
+        if any(token[0] in 'EGM' for token in tokens):
+            modrm, offset = self.decode_modrm(data, offset, adsize, rex)
+        if mnem in GROUPS:
+            mnem = GROUPS[mnem][modrm[0]]
+            if mnem is None:
+                return None
+            if opcode in (0xf6, 0xf7) and modrm[0] < 2:
+                tokens.append('Ib' if opcode == 0xf6 else 'Iz')
+        ops = []
+        imm_offset = offset
+        for token in tokens:
+            size = self.get_size(token, opsize, mnem)
+            if token[0] in 'IJ':
+                imm_size = size
+                if token[1] == 's':
+                    imm_size = 1
+                if token == 'Jz':
+                    imm_size = 2 if opsize == 2 and self.mode == 32 else 4
+                if token == 'Iz' or (token == 'Iv' and opsize != 8):
+                    imm_size = min(opsize, 4)
+                value = int.from_bytes(data[imm_offset:imm_offset + imm_size],
+                                       'little',
+                                       signed=token[1] in 'sz' or
+                                       token[0] == 'J')
+                if token[0] == 'I':
+                    # sign-extended to operand size
+                    value &= (1 << size * 8) - 1
+                imm_offset += imm_size
+                ops.append((token, value, size))
+            elif token == 'Ap':
+                imm_offset += 2 + (2 if opsize == 2 else 4)
+            elif token[0] == 'O':
+                value = int.from_bytes(data[imm_offset:imm_offset + adsize],
+                                       'little')
+                imm_offset += adsize
+                ops.append((token, value, size))
+            else:
+                ops.append((token, None, size))
+        size = imm_offset - start
+        if size > MAX_INSN_SIZE or imm_offset > len(data):
+            return None
+        if vex is not None:
+            ops = []
+        # register of Z operands is taken from opcode
+        opcode_reg = (opcode & 7) | (rex & 1) << 3
+        next_ea = ea + size
+        return Insn(ea, size, mnem, [
+            self.get_operand(op, modrm, rex, next_ea, opcode_reg)
+            for op in ops
+        ])
+
+    def get_size(self, token, opsize, mnem):
+        if token == 'M':
+            # lea operand is an address, not memory access
+            return 0
+        kind = token[1:] or 'v'
+        if kind == 'b':
+            return 1
+        if kind == 'w':
+            return 2
+        if kind == 'd':
+            return 4
+        if kind == 'q' or (self.mode == 64 and mnem in ('push', 'pop', 'call',
+                                                      'jmp')):
+            return 8 if self.mode == 64 and opsize != 2 else opsize
+        return opsize
+
+    def decode_modrm(self, data, offset, adsize, rex):
+        '''
+        get (reg field, r/m register or memory description) and offset
+        after ModRM, SIB and displacement
+        '''
+        modrm = data[offset]
+        offset += 1
+        mod, reg, rm = modrm >> 6, (modrm >> 3) & 7, modrm & 7
+        reg |= (rex & 4) << 1
+        if mod == 3:
+            return (reg, ('reg', rm | (rex & 1) << 3)), offset
+        base, index, scale, disp_size = None, None, 1, 0
+        if adsize == 2:
+            if mod == 0 and rm == 6:
+                disp_size = 2
+            else:
+                base = MEM_16[rm]
+                disp_size = mod
+            disp = int.from_bytes(data[offset:offset + disp_size],
+                                  'little',
+                                  signed=True)
+            return (reg, ('mem16', base, disp)), offset + disp_size
+        if rm == 4:
+            sib = data[offset]
+            offset += 1
+            scale = 1 << (sib >> 6)
+            number = (sib >> 3) & 7 | (rex & 2) << 2
+            if number != 4:
+                index = number
+            if sib & 7 == 5 and mod == 0:
+                disp_size = 4
+            else:
+                base = sib & 7 | (rex & 1) << 3
+        elif rm == 5 and mod == 0:
+            disp_size = 4
+            if self.mode == 64:
+                base = R_rip
+        else:
+            base = rm | (rex & 1) << 3
+        if mod == 1:
+            disp_size = 1
+        if mod == 2:
+            disp_size = 4
+        disp = int.from_bytes(data[offset:offset + disp_size],
+                              'little',
+                              signed=True)
+        return (reg, ('mem', base, index, scale, disp,
+                      adsize)), offset + disp_size
+
+    def get_operand(self, op, modrm, rex, next_ea, opcode_reg):
+        token, value, size = op
+        kind = token[0]
+        if token in ('AL', 'rAX', 'CL'):
+            size = 1 if token != 'rAX' else size
+            number, name = get_reg(0 if token != 'CL' else 1, size, rex)
+            return Operand(o_reg, number, size, name)
+        if token == '1':
+            return Operand(o_imm, 1, 1, '1')
+        if kind == 'Z':
+            number, name = get_reg(opcode_reg, size, rex)
+            return Operand(o_reg, number, size, name)
+        if kind == 'G':
+            number, name = get_reg(modrm[0], size, rex)
+            return Operand(o_reg, number, size, name)
+        if kind in 'EM':
+            return self.get_rm_operand(modrm[1], size, rex, next_ea)
+        if kind == 'I':
+            return Operand(o_imm, value, size, format_num(value))
+        if kind == 'J':
+            value = (next_ea + value) & self.mask
+            return Operand(o_near, value, size, format_num(value))
+        if kind == 'O':
+            return Operand(o_mem, value, size,
+                           PTR_NAMES.get(size, '') + format_num(value))
+        return Operand(o_void, 0)
+
+    def get_rm_operand(self, rm, size, rex, next_ea):
+        if rm[0] == 'reg':
+            number, name = get_reg(rm[1], size, rex)
+            return Operand(o_reg, number, size, name)
+        ptr = PTR_NAMES.get(size, '')
+        if rm[0] == 'mem16':
+            _, base, disp = rm
+            if base is None:
+                return Operand(o_mem, disp & 0xffff, size,
+                               '{}ds:{}'.format(ptr, format_num(disp & 0xffff)))
+            if not disp:
+                return Operand(o_phrase, 0, size, '{}[{}]'.format(ptr, base))
+            return Operand(o_displ, disp & self.mask, size,
+                           '{}[{}{}]'.format(ptr, base, format_disp(disp)))
+        _, base, index, scale, disp, adsize = rm
+        if base == R_rip:
+            value = (next_ea + disp) & self.mask
+            return Operand(o_mem, value, size,
+                           '{}[rip{}]'.format(ptr, format_disp(disp)))
+        regs = REGS[adsize]
+        parts = []
+        if base is not None:
+            parts.append(regs[base])
+        if index is not None:
+            parts.append(regs[index] +
+                         ('*{}'.format(scale) if scale > 1 else ''))
+        if base is None:
+            value = disp & self.mask
+            text = '{}ds:{}'.format(ptr, format_num(value))
+            if len(parts):
+                text += '[{}]'.format('+'.join(parts))
+            return Operand(o_mem, value, size, text)
+        text = '+'.join(parts)
+        if not disp:
+            return Operand(o_phrase, base, size, '{}[{}]'.format(ptr, text))
+        return Operand(o_displ, disp & self.mask, size,
+                       '{}[{}{}]'.format(ptr, text, format_disp(disp)))
@@ -23,79 +23,160 @@
 import argparse
 import json
 import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 
+MODULE_PREFIX = b'## Module: '
+PROTOCOL_FIELDS = ('service', 'protocol_name', 'protocol_place', 'guid')
 
-def get_module_json(module_chunk):
-    module_json = {}
-    mn_end_index = module_chunk.find('\n')
-    module_name = module_chunk[:mn_end_index]
-    module_json['module_name'] = module_name
-    module_chunk = module_chunk[mn_end_index + 2:]
-    bs_chunk_end_index = module_chunk.find('### Protocols:')
-    bs_chunk = module_chunk[:bs_chunk_end_index]
-    prot_chunk = module_chunk[len(bs_chunk):]
-    bs_lines = bs_chunk.split('\n')
-    prot_lines = prot_chunk.split('\n')
-    bs_lines = bs_lines[1:len(bs_lines) - 1]
-    prot_lines = prot_lines[1:len(prot_lines) - 1]
-    module_json['boot_services'] = []
-    for bs_line in bs_lines:
-        # get boot service address
-        address = bs_line[3:bs_line.find('] ')]
-        # get boot service name
-        bs_name = bs_line[bs_line.find('EFI'):]
-        if address[:2] != '0x':
-            continue
-        module_json['boot_services'].append({
-            'address': address,
-            'bs_name': bs_name
-        })
-
-    module_json['protocols'] = []
-    for i in range(0, len(prot_lines) - 1, 5):
-        # get protocol address
-        address = prot_lines[i][3:prot_lines[i].find(']')]
-        # get service name
-        # yapf: disable
-        service_index = prot_lines[i + 1].find('[service]') + len('[service]') + 1
-        service = prot_lines[i + 1][service_index:]
-        # get protocol name
-        protocol_name_index = prot_lines[i + 2].find('[protocol_name]') + len(
-            '[protocol_name]') + 1
-        protocol_name = prot_lines[i + 2][protocol_name_index:]
-        # get protocol place
-        protocol_place_index = prot_lines[i + 3].find(
-            '[protocol_place]') + len('[protocol_place]') + 1
-        protocol_place = prot_lines[i + 3][protocol_place_index:]
-        # get protocol guid
-        guid_index = prot_lines[i + 4].find('[guid]') + len('[guid]') + 1
-        guid = prot_lines[i + 4][guid_index:]
-        # add element
-        module_json['protocols'].append({
-            'address': address,
-            'service': service,
-            'protocol_name': protocol_name,
-            'protocol_place': protocol_place,
-            'guid': guid
-        })
-    return module_json
-
-
-def md_to_json(md_file, json_file):
-    with open(md_file, 'r') as f:
-        data = f.read()
-    res_json = []
-    modules = data.split('## Module: ')[1:]
-    for module_chunk in modules:
-        module_json = get_module_json(module_chunk)
-        res_json.append(module_json)
-    with open(json_file, 'w') as f:
-        json.dump(res_json, f, indent=4)
-
-
-def get_json(md_file):
-    json_file = md_file.replace('.md', '.json')
-    md_to_json(md_file, json_file)
+
+def iter_modules(md_file, start=0, end=None):
+    '''
+    parse MarkDown log line by line and yield modules in JSON format,
+    start and end are byte offsets of module boundaries
+    '''
+    module_json = None
+    state = None
+    with open(md_file, 'rb') as f:
+        f.seek(start)
+        offset = start
+        for raw_line in f:
+            if end is not None and offset >= end:
+                break
+            offset += len(raw_line)
+            line = raw_line.rstrip(b'\r\n').decode('utf-8', 'replace')
+            if line.startswith('## Module: '):
+                if module_json is not None:
+                    yield module_json
+                module_json = {
+                    'module_name': line[len('## Module: '):],
+                    'boot_services': [],
+                    'protocols': []
+                }
+                state = None
+                continue
+            if module_json is None:
+                continue
+            if line.startswith('### Boot services:'):
+                state = 'boot_services'
+                continue
+            if line.startswith('### Protocols:'):
+                state = 'protocols'
+                continue
+            if line.startswith('###'):
+                state = None
+                continue
+            if state == 'boot_services' and line.startswith('* [0x'):
+                # * [address] EFI_BOOT_SERVICES->service
+                module_json['boot_services'].append({
+                    'address': line[3:line.find('] ')],
+                    'bs_name': line[line.find('EFI'):]
+                })
+            if state == 'protocols':
+                if line.startswith('* ['):
+                    # * [address]
+                    record = {'address': line[3:line.find(']')]}
+                    for field in PROTOCOL_FIELDS:
+                        record[field] = ''
+                    module_json['protocols'].append(record)
+                    continue
+                # \t - [field] value
+                field_start = line.find('- [')
+                field_end = line.find('] ', field_start)
+                if (field_start < 0 or field_end < 0
+                        or not module_json['protocols']):
+                    continue
+                field = line[field_start + 3:field_end]
+                if field in PROTOCOL_FIELDS:
+                    module_json['protocols'][-1][field] = line[field_end + 2:]
+    if module_json is not None:
+        yield module_json
+
+
+def dump_modules(modules, out, jsonl=False):
+    '''
+    write modules to JSON Lines file or as JSON array items
+    '''
+    count = 0
+    for module_json in modules:
+        if jsonl:
+            out.write(json.dumps(module_json) + '\n')
+        else:
+            if count:
+                out.write(',\n')
+            out.write('\n'.join([
+                '    ' + line
+                for line in json.dumps(module_json, indent=4).split('\n')
+            ]))
+        count += 1
+    return count
+
+
+def get_chunks(md_file, jobs):
+    '''
+    split MarkDown log into byte ranges at module boundaries
+    '''
+    size = os.path.getsize(md_file)
+    bounds = [0]
+    with open(md_file, 'rb') as f:
+        for i in range(1, jobs):
+            offset = max(size * i // jobs, bounds[-1])
+            f.seek(offset)
+            if offset:
+                # skip the rest of the current line
+                offset += len(f.readline())
+            for line in iter(f.readline, b''):
+                if line.startswith(MODULE_PREFIX):
+                    break
+                offset += len(line)
+            if offset > bounds[-1]:
+                bounds.append(offset)
+    bounds.append(size)
+    return [(bounds[i], bounds[i + 1]) for i in range(len(bounds) - 1)]
+
+
+def convert_chunk(args):
+    '''
+    convert part of MarkDown log to temporary file
+    '''
+    md_file, start, end, part_file, jsonl = args
+    with open(part_file, 'w') as out:
+        return dump_modules(iter_modules(md_file, start, end), out, jsonl)
+
+
+def md_to_json(md_file, json_file, jsonl=False, jobs=1):
+    chunks = get_chunks(md_file, jobs) if jobs > 1 else []
+    with open(json_file, 'w') as out:
+        if not jsonl:
+            out.write('[\n')
+        if len(chunks) > 1:
+            # the parts are removed if any chunk conversion fails
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                tasks = [(md_file, start, end,
+                          os.path.join(tmp_dir, '{}.part'.format(i)), jsonl)
+                         for i, (start, end) in enumerate(chunks)]
+                count = 0
+                with ProcessPoolExecutor(max_workers=jobs) as executor:
+                    for task, part_count in zip(
+                            tasks, executor.map(convert_chunk, tasks)):
+                        if not part_count:
+                            continue
+                        if count and not jsonl:
+                            out.write(',\n')
+                        with open(task[3], 'r') as part:
+                            shutil.copyfileobj(part, out)
+                        count += part_count
+        else:
+            count = dump_modules(iter_modules(md_file), out, jsonl)
+        if not jsonl:
+            out.write('\n]' if count else ']')
+    return count
+
+
+def get_json(md_file, jsonl=False, jobs=1):
+    json_file = md_file.replace('.md', '.jsonl' if jsonl else '.json')
+    md_to_json(md_file, json_file, jsonl, jobs)
 
 
 def main():
@@ -106,12 +187,20 @@ def main():
         'md_log_file',
         type=str,
         help='path to your MarkDown log file (for example, ida_log_all.md)')
+    parser.add_argument('--jsonl',
+                        action='store_true',
+                        help='write one module per line (JSON Lines)')
+    parser.add_argument(
+        '--jobs',
+        type=int,
+        default=1,
+        help='number of worker processes for large logs (default: 1)')
 
     args = parser.parse_args()
 
     if os.path.isfile(args.md_log_file):
         try:
-            get_json(args.md_log_file)
+            get_json(args.md_log_file, args.jsonl, args.jobs)
         except Exception as e:
             print('[error] {}'.format(repr(e)))
     else:
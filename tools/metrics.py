@@ -0,0 +1,282 @@
+# MIT License
+#
+# Copyright (c) 2018-2019 yeggor
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# textfile is rewritten with this period (seconds)
+METRICS_INTERVAL = 15
+
+SECONDS_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+BYTES_BUCKETS = tuple(1 << shift for shift in range(26, 34))
+
+PROMETHEUS_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+OPENMETRICS_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+
+def format_value(value):
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def format_bound(bound):
+    # canonical float form is required by OpenMetrics
+    return '+Inf' if bound == float('inf') else repr(float(bound))
+
+
+def format_labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + list(extra or [])
+    if not len(pairs):
+        return ''
+    return '{' + ','.join([
+        '{}="{}"'.format(
+            name,
+            str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+                '\n', '\\n')) for name, value in pairs
+    ]) + '}'
+
+
+class Registry():
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def render(self, openmetrics=False):
+        '''
+        get metrics in Prometheus text format (or in OpenMetrics format)
+        '''
+        lines = []
+        for metric in self.metrics:
+            lines += metric.render(openmetrics)
+        if openmetrics:
+            lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class Metric():
+    type = None
+    suffix = ''
+
+    def __init__(self, name, doc, labels=(), registry=REGISTRY):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.register(self)
+
+    def get_key(self, labels):
+        return tuple([str(labels.get(name, '')) for name in self.labels])
+
+    def get_samples(self, key, value):
+        return [(self.name + self.suffix, key, [], value)]
+
+    def render(self, openmetrics=False):
+        # OpenMetrics counters are named without `_total` suffix
+        family = self.name if openmetrics else self.name + self.suffix
+        lines = [
+            '# HELP {} {}'.format(family, self.doc),
+            '# TYPE {} {}'.format(family, self.type)
+        ]
+        with self.lock:
+            items = sorted(self.values.items())
+        for key, value in items:
+            for name, label_values, extra, sample in self.get_samples(
+                    key, value):
+                lines.append('{}{} {}'.format(
+                    name, format_labels(self.labels, label_values, extra),
+                    format_value(sample)))
+        return lines
+
+
+class Counter(Metric):
+    type = 'counter'
+    suffix = '_total'
+
+    def inc(self, value=1, **labels):
+        key = self.get_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.get_key(labels)] = value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, doc, labels=(), buckets=SECONDS_BUCKETS,
+                 registry=REGISTRY):
+        self.buckets = tuple(sorted(buckets)) + (float('inf'), )
+        super().__init__(name, doc, labels, registry)
+
+    def observe(self, value, **labels):
+        key = self.get_key(labels)
+        with self.lock:
+            counts, total = self.values.get(key,
+                                            ([0] * len(self.buckets), 0))
+            counts = [
+                count + (value <= bound)
+                for count, bound in zip(counts, self.buckets)
+            ]
+            self.values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    def get_samples(self, key, value):
+        counts, total = value
+        samples = [(self.name + '_bucket', key, [('le', format_bound(bound))],
+                    count) for bound, count in zip(self.buckets, counts)]
+        samples.append((self.name + '_sum', key, [], total))
+        samples.append((self.name + '_count', key, [], counts[-1]))
+        return samples
+
+
+START_TIME = Gauge('uefi_retool_start_time_seconds',
+                   'unix time when the run was started')
+MODULES = Counter('uefi_retool_modules',
+                  'analysed modules by result (ok or error)', ['status'])
+MODULE_SECONDS = Histogram('uefi_retool_module_seconds',
+                           'analysis time of one module')
+WORKER_PEAK_RSS = Histogram('uefi_retool_worker_peak_rss_bytes',
+                            'peak memory of r2/IDA worker process tree',
+                            buckets=BYTES_BUCKETS)
+QUEUE_DEPTH = Gauge('uefi_retool_queue_depth',
+                    'modules waiting for a worker')
+RUNNING_JOBS = Gauge('uefi_retool_running_jobs', 'modules being analysed')
+PHASE_SECONDS = Histogram('uefi_retool_phase_seconds',
+                          'duration of firmware processing phases', ['phase'])
+CACHE_LOOKUPS = Counter('uefi_retool_cache_lookups',
+                        'cache lookups by cache and result (hit or miss)',
+                        ['cache', 'result'])
+START_TIME.set(time.time())
+
+
+def count_lookups(cache, hits, lookups):
+    CACHE_LOOKUPS.inc(hits, cache=cache, result='hit')
+    CACHE_LOOKUPS.inc(lookups - hits, cache=cache, result='miss')
+
+
+def write_textfile(path, registry=REGISTRY):
+    '''
+    rewrite metrics file atomically (for node_exporter textfile collector)
+    '''
+    path = os.path.abspath(path)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                    suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as metrics_file:
+            metrics_file.write(registry.render())
+        os.replace(tmp_path, path)
+    except OSError:
+        os.remove(tmp_path)
+        raise
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ['/', '/metrics']:
+            self.send_error(404)
+            return
+        openmetrics = 'application/openmetrics-text' in self.headers.get(
+            'Accept', '')
+        body = REGISTRY.render(openmetrics).encode()
+        self.send_response(200)
+        self.send_header('Content-Type',
+                         OPENMETRICS_TYPE if openmetrics else PROMETHEUS_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        # scrapes are not printed to the console
+        pass
+
+
+class Exporter():
+    '''
+    export metrics to periodically rewritten textfile and/or
+    scrape endpoint on localhost
+    '''
+
+    def __init__(self, metrics_file=None, metrics_port=None,
+                 interval=METRICS_INTERVAL):
+        self.metrics_file = metrics_file
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.threads = []
+        self.server = None
+        if metrics_port is not None:
+            self.server = ThreadingHTTPServer(('localhost', metrics_port),
+                                              MetricsHandler)
+            self.start(self.server.serve_forever)
+        if metrics_file is not None:
+            self.start(self.write_periodically)
+
+    def start(self, target):
+        thread = threading.Thread(target=target, daemon=True)
+        thread.start()
+        self.threads.append(thread)
+
+    def write(self):
+        if self.metrics_file is None:
+            return
+        try:
+            write_textfile(self.metrics_file)
+        except OSError as e:
+            print('[ERROR] metrics were not written: {}'.format(e))
+
+    def write_periodically(self):
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+    def close(self):
+        '''
+        write final metrics and stop scrape endpoint
+        '''
+        self.stopped.set()
+        self.write()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
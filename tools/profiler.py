@@ -0,0 +1,279 @@
+# MIT License
+#
+# Copyright (c) 2018-2019 yeggor
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import argparse
+import cProfile
+import glob
+import json
+import os
+import pstats
+import re
+import time
+from contextlib import contextmanager
+
+# profiles of IDA scripts are saved to this directory (see ida_plugin utils)
+PROFILE_ENV = 'UEFI_RETOOL_PROFILE_DIR'
+
+# time in these functions is spent waiting for r2 or IDA
+EXTERNAL_FILES = re.compile(r'[\\/]r2pipe[\\/]')
+EXTERNAL_BUILTINS = re.compile(
+    r'^<built-in method (posix|nt)\.(system|waitpid)>$'
+    r'|^<built-in method _ida_')
+
+# paths with less time are not written to collapsed stacks
+MIN_STACK_TIME = 1e-4
+MAX_STACK_DEPTH = 64
+
+PROFILE_DIR = None
+
+
+def enable(profile_dir):
+    '''
+    enable profiling of phases and workers of the run
+    '''
+    global PROFILE_DIR
+    PROFILE_DIR = os.path.abspath(profile_dir)
+    for subdir in ['workers', 'ida']:
+        os.makedirs(os.path.join(PROFILE_DIR, subdir), exist_ok=True)
+
+
+def get_profile_dir():
+    return PROFILE_DIR
+
+
+def get_phase_index(profile_dir):
+    '''
+    get index of the current phase, phases of daemon jobs are numbered
+    '''
+    return len(glob.glob(os.path.join(profile_dir, '[0-9][0-9]_*.prof')))
+
+
+def get_func_name(func):
+    filename, line, name = func
+    if filename == '~':
+        return name
+    return '{}:{}:{}'.format(os.path.basename(filename), line, name)
+
+
+def is_external(func):
+    filename, _, name = func
+    if filename == '~':
+        return bool(EXTERNAL_BUILTINS.match(name))
+    return bool(EXTERNAL_FILES.search(filename))
+
+
+def get_external_time(stats):
+    '''
+    get time spent in r2pipe and in subprocesses (r2 or IDA), calls inside
+    these functions are not counted twice
+    '''
+    total = 0
+    for func, (_, _, _, _, callers) in stats.items():
+        if not is_external(func):
+            continue
+        for caller, caller_stats in callers.items():
+            if not is_external(caller):
+                total += caller_stats[3]
+    return total
+
+
+def get_collapsed_stacks(stats):
+    '''
+    get {stack: microseconds} in collapsed format for flame graphs,
+    cProfile keeps only caller-callee pairs, so the time of function is
+    split between its callers in proportion to the time of each call edge
+    '''
+    callees = {}
+    for func, (_, _, _, _, callers) in stats.items():
+        for caller, caller_stats in callers.items():
+            callees.setdefault(caller, []).append((func, caller_stats[3]))
+    stacks = {}
+
+    def walk(func, stack, share):
+        _, _, tt, ct, _ = stats[func]
+        self_time = tt * share
+        if self_time >= MIN_STACK_TIME:
+            key = ';'.join(stack)
+            stacks[key] = stacks.get(key, 0) + int(self_time * 1e6)
+        if len(stack) >= MAX_STACK_DEPTH:
+            return
+        for callee, edge_time in callees.get(func, []):
+            callee_ct = stats[callee][3]
+            path_time = edge_time * share
+            if (path_time < MIN_STACK_TIME or not callee_ct
+                    or get_func_name(callee) in stack):
+                continue
+            walk(callee, stack + [get_func_name(callee)],
+                 min(1.0, path_time / callee_ct))
+
+    for func, (_, _, _, _, callers) in stats.items():
+        if not len(callers):
+            walk(func, [get_func_name(func)], 1.0)
+    return stacks
+
+
+def save_stats(stats, path, record):
+    '''
+    save pstats, collapsed stacks and time breakdown with the same name
+    '''
+    stats.dump_stats(path + '.prof')
+    with open(path + '.folded', 'w') as folded:
+        for stack, value in sorted(get_collapsed_stacks(stats.stats).items()):
+            folded.write('{} {}\n'.format(stack, value))
+    record['external'] = get_external_time(stats.stats)
+    with open(path + '.json', 'w') as record_file:
+        json.dump(record, record_file, indent=2)
+    return record
+
+
+def get_file_name(name):
+    return re.sub(r'[^0-9A-Za-z._-]', '_', name)
+
+
+def profile_call(profile_dir, name, func, *args):
+    '''
+    call worker function under cProfile, the profile is saved to the
+    `workers` directory with the index of the phase (profiles of daemon
+    jobs are kept), subprocesses started by the worker (IDA) get
+    the profile directory in environment
+    '''
+    os.environ[PROFILE_ENV] = os.path.join(profile_dir, 'ida')
+    profile = cProfile.Profile()
+    wall, cpu = time.time(), time.process_time()
+    try:
+        return profile.runcall(func, *args)
+    finally:
+        record = {
+            'name': name,
+            'wall': time.time() - wall,
+            'cpu': time.process_time() - cpu
+        }
+        file_name = '{:02d}_{}'.format(get_phase_index(profile_dir),
+                                       get_file_name(name))
+        save_stats(pstats.Stats(profile),
+                   os.path.join(profile_dir, 'workers', file_name), record)
+
+
+@contextmanager
+def phase(name):
+    '''
+    profile phase of the run in the main process (nothing is done
+    if profiling is not enabled)
+    '''
+    if PROFILE_DIR is None:
+        yield
+        return
+    index = get_phase_index(PROFILE_DIR)
+    profile = cProfile.Profile()
+    wall, cpu = time.time(), time.process_time()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        record = {
+            'name': name,
+            'wall': time.time() - wall,
+            'cpu': time.process_time() - cpu
+        }
+        save_stats(
+            pstats.Stats(profile),
+            os.path.join(PROFILE_DIR, '{:02d}_{}'.format(index, name)), record)
+
+
+def load_records(dirname, pattern='*.json'):
+    records = []
+    for path in sorted(glob.glob(os.path.join(dirname, pattern))):
+        with open(path, 'r') as record_file:
+            records.append(json.load(record_file))
+    return records
+
+
+def get_breakdown(profile_dir):
+    '''
+    get time breakdown of phases and workers, collapsed stacks and time
+    records are made for profiles saved by IDA scripts
+    '''
+    for path in glob.glob(os.path.join(profile_dir, 'ida', '*.prof')):
+        prefix = path[:-len('.prof')]
+        if not os.path.isfile(prefix + '.json'):
+            stats = pstats.Stats(path)
+            save_stats(stats, prefix, {
+                'name': os.path.basename(prefix),
+                'wall': stats.total_tt,
+                'cpu': None
+            })
+    breakdown = {
+        'phases': load_records(profile_dir, '[0-9][0-9]_*.json'),
+        'workers': load_records(os.path.join(profile_dir, 'workers')),
+        'ida_scripts': load_records(os.path.join(profile_dir, 'ida'))
+    }
+    with open(os.path.join(profile_dir, 'breakdown.json'), 'w') as out:
+        json.dump(breakdown, out, indent=2)
+    return breakdown
+
+
+def get_time_line(record):
+    cpu = '-' if record['cpu'] is None else '{:.2f}'.format(record['cpu'])
+    return '{:<40} {:>9.2f} {:>9} {:>9.2f}'.format(record['name'][:40],
+                                                  record['wall'], cpu,
+                                                  record['external'])
+
+
+def print_breakdown(profile_dir, top=10):
+    '''
+    print wall time of phases and of the slowest jobs with the time
+    of Python code (cpu) and of r2/IDA (external)
+    '''
+    breakdown = get_breakdown(profile_dir)
+    print('{:<40} {:>9} {:>9} {:>9}'.format('', 'wall, s', 'cpu, s',
+                                             'r2/IDA, s'))
+    for record in breakdown['phases']:
+        print(get_time_line(record))
+    workers = sorted(breakdown['workers'],
+                     key=lambda record: record['wall'],
+                     reverse=True)
+    if len(workers):
+        print('[*] {} slowest jobs:'.format(min(top, len(workers))))
+        for record in workers[:top]:
+            print(get_time_line(record))
+    print('[*] Profiles are saved to {}'.format(profile_dir))
+
+
+def main():
+    program = 'python -m tools.profiler'
+    parser = argparse.ArgumentParser(
+        prog=program,
+        description='print time breakdown of profiled run '
+        '(see --profile option of the analysis scripts)')
+    parser.add_argument('profile_dir', type=str, help='profile directory')
+    parser.add_argument('--top',
+                        type=int,
+                        default=10,
+                        help='number of the slowest jobs (default: 10)')
+    args = parser.parse_args()
+    print_breakdown(args.profile_dir, args.top)
+
+
+if __name__ == '__main__':
+    main()
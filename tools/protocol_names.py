@@ -0,0 +1,215 @@
+# MIT License
+#
+# Copyright (c) 2018-2019 yeggor
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import argparse
+import json
+import os
+import tempfile
+import time
+
+from r2_uefi_re.guids import (ami_guids, asrock_guids, dell_guids, edk2_guids,
+                              edk_guids, lenovo_guids)
+
+from .result_db import ResultDB
+
+# the first place containing the GUID gives the protocol name
+GUID_PLACES = (
+    ('ami_guids', ami_guids.ami_guids),
+    ('asrock_guids', asrock_guids.asrock_guids),
+    ('dell_guids', dell_guids.dell_guids),
+    ('edk_guids', edk_guids.edk_guids),
+    ('edk2_guids', edk2_guids.edk2_guids),
+    ('lenovo_guids', lenovo_guids.lenovo_guids),
+)
+PROPRIETARY_NAME = 'ProprietaryProtocol'
+PROPRIETARY_PLACE = 'unknown'
+
+NAME_PREFIX = '\t - [protocol_name] '
+PLACE_PREFIX = '\t - [protocol_place] '
+GUID_PREFIX = '\t - [guid] '
+
+
+def get_guid_key(guid):
+    '''
+    get lookup key from GUID string or GUID structure
+    '''
+    if isinstance(guid, str):
+        return guid.replace('-', '').upper()
+    key = '{:08X}{:04X}{:04X}'.format(guid[0], guid[1], guid[2])
+    return key + ''.join(['{:02X}'.format(b) for b in guid[3:11]])
+
+
+def get_guid_index():
+    '''
+    get {GUID key: (protocol_name, protocol_place)} index of known GUIDs
+    '''
+    index = {}
+    for place, guids in GUID_PLACES:
+        for name, guid in guids.items():
+            index.setdefault(get_guid_key(guid), (name, place))
+    return index
+
+
+def get_name(guid, index):
+    return index.get(get_guid_key(guid), (PROPRIETARY_NAME, PROPRIETARY_PLACE))
+
+
+def name_protocols(protocols, index):
+    '''
+    set protocol_name and protocol_place from current GUID index,
+    number of changed records is returned
+    '''
+    changed = 0
+    for protocol in protocols:
+        name, place = get_name(protocol['guid'], index)
+        if (protocol.get('protocol_name') != name
+                or protocol.get('protocol_place') != place):
+            protocol['protocol_name'] = name
+            protocol['protocol_place'] = place
+            changed += 1
+    return changed
+
+
+def replace_file(path, lines):
+    '''
+    write lines to temporary file and replace the original file
+    '''
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+    with os.fdopen(fd, 'w') as f:
+        f.writelines(lines)
+    os.replace(tmp_path, path)
+
+
+def render_json(json_file, index):
+    changed = 0
+    if json_file.endswith('.jsonl'):
+        lines = []
+        with open(json_file, 'r') as f:
+            for line in f:
+                module_json = json.loads(line)
+                changed += name_protocols(module_json['protocols'], index)
+                lines.append(json.dumps(module_json) + '\n')
+        replace_file(json_file, lines)
+        return changed
+    with open(json_file, 'r') as f:
+        res_json = json.load(f)
+    for module_json in res_json:
+        changed += name_protocols(module_json['protocols'], index)
+    replace_file(json_file, [json.dumps(res_json, indent=4)])
+    return changed
+
+
+def render_md_lines(lines, index, stats):
+    '''
+    rename protocols in log_all records and drop known GUIDs from
+    log_pp_guids table
+    '''
+    record = []
+    for line in lines:
+        if line.startswith('| ') and not line.startswith('| Guid |'):
+            guid = line[2:].split(' |', 1)[0]
+            if guid != '---' and get_guid_key(guid) in index:
+                stats['changed'] += 1
+                continue
+            yield line
+            continue
+        if line.startswith(NAME_PREFIX) or line.startswith(PLACE_PREFIX):
+            record.append(line)
+            continue
+        if line.startswith(GUID_PREFIX) and record:
+            name, place = get_name(line[len(GUID_PREFIX):].strip(), index)
+            new_record = []
+            for old_line in record:
+                if old_line.startswith(NAME_PREFIX):
+                    new_record.append(NAME_PREFIX + name + '\n')
+                else:
+                    new_record.append(PLACE_PREFIX + place + '\n')
+            if new_record != record:
+                stats['changed'] += 1
+            record = []
+            yield from new_record
+            yield line
+            continue
+        yield from record
+        record = []
+        yield line
+    yield from record
+
+
+def render_md(md_file, index):
+    stats = {'changed': 0}
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(md_file)))
+    with open(md_file, 'r') as md, os.fdopen(fd, 'w') as f:
+        f.writelines(render_md_lines(md, index, stats))
+    os.replace(tmp_path, md_file)
+    return stats['changed']
+
+
+def render_db(db_path, index):
+    db = ResultDB(db_path)
+    changed = db.update_protocol_names(lambda guid: get_name(guid, index))
+    db.close()
+    return changed
+
+
+def render(result_file, index=None):
+    '''
+    apply current GUID index to existing analysis results
+    (md/json/jsonl logs or SQLite database), number of changed
+    protocol records is returned
+    '''
+    if index is None:
+        index = get_guid_index()
+    ext = os.path.splitext(result_file)[1]
+    if ext in ('.json', '.jsonl'):
+        return render_json(result_file, index)
+    if ext == '.md':
+        return render_md(result_file, index)
+    if ext in ('.db', '.sqlite'):
+        return render_db(result_file, index)
+    raise ValueError('unsupported result file: {}'.format(result_file))
+
+
+def main():
+    program = 'python -m tools.protocol_names'
+    parser = argparse.ArgumentParser(
+        description='Rename protocols in analysis results with current GUIDs',
+        prog=program)
+    parser.add_argument('result_files',
+                        type=str,
+                        nargs='+',
+                        help='md/json/jsonl logs or SQLite databases')
+    args = parser.parse_args()
+
+    start = time.time()
+    index = get_guid_index()
+    for result_file in args.result_files:
+        changed = render(result_file, index)
+        print('[*] {}: {} protocol records changed'.format(
+            result_file, changed))
+    print('[*] Done in {:.2f}s'.format(time.time() - start))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,310 @@
+# MIT License
+#
+# Copyright (c) 2018-2019 yeggor
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+
+from .utils import (CLIENT_PROTOCOL_SERVICES, INSTALL_PROTOCOL_SERVICES,
+                    get_dep_index, get_res_json)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS firmwares (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    sha256 TEXT UNIQUE
+);
+CREATE TABLE IF NOT EXISTS modules (
+    id INTEGER PRIMARY KEY,
+    firmware_id INTEGER NOT NULL REFERENCES firmwares(id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    sha256 TEXT
+);
+CREATE TABLE IF NOT EXISTS boot_services (
+    module_id INTEGER NOT NULL REFERENCES modules(id) ON DELETE CASCADE,
+    address TEXT NOT NULL,
+    service TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS protocols (
+    module_id INTEGER NOT NULL REFERENCES modules(id) ON DELETE CASCADE,
+    address TEXT NOT NULL,
+    service TEXT NOT NULL,
+    guid TEXT NOT NULL,
+    protocol_name TEXT,
+    protocol_place TEXT
+);
+CREATE TABLE IF NOT EXISTS dependencies (
+    guid TEXT NOT NULL,
+    installer_id INTEGER NOT NULL REFERENCES modules(id) ON DELETE CASCADE,
+    consumer_id INTEGER NOT NULL REFERENCES modules(id) ON DELETE CASCADE
+);
+CREATE INDEX IF NOT EXISTS modules_firmware ON modules(firmware_id);
+CREATE INDEX IF NOT EXISTS modules_name ON modules(name);
+CREATE INDEX IF NOT EXISTS modules_sha256 ON modules(sha256);
+CREATE INDEX IF NOT EXISTS boot_services_module ON boot_services(module_id);
+CREATE INDEX IF NOT EXISTS protocols_module ON protocols(module_id);
+CREATE INDEX IF NOT EXISTS protocols_guid ON protocols(guid);
+CREATE INDEX IF NOT EXISTS dependencies_guid ON dependencies(guid);
+CREATE INDEX IF NOT EXISTS dependencies_installer ON dependencies(installer_id);
+CREATE INDEX IF NOT EXISTS dependencies_consumer ON dependencies(consumer_id);
+'''
+
+
+def get_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+class ResultDB():
+    '''
+    SQLite storage for analysis results of firmware corpus
+    '''
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute('PRAGMA foreign_keys = ON')
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+    def add_firmware(self, fw_path):
+        '''
+        add firmware record, the results of the previous analysis
+        of the same firmware are replaced
+        '''
+        sha256 = get_sha256(fw_path)
+        self.conn.execute('DELETE FROM firmwares WHERE sha256 = ?', (sha256, ))
+        cursor = self.conn.execute(
+            'INSERT INTO firmwares (name, sha256) VALUES (?, ?)',
+            (os.path.basename(fw_path), sha256))
+        return cursor.lastrowid
+
+    def add_module(self, firmware_id, module_json, sha256=None):
+        '''
+        add module record in md_to_json format
+        '''
+        cursor = self.conn.execute(
+            'INSERT INTO modules (firmware_id, name, sha256) VALUES (?, ?, ?)',
+            (firmware_id, module_json['module_name'], sha256))
+        module_id = cursor.lastrowid
+        self.conn.executemany(
+            'INSERT INTO boot_services VALUES (?, ?, ?)',
+            [(module_id, bs['address'], bs['bs_name'])
+             for bs in module_json['boot_services']])
+        self.conn.executemany(
+            'INSERT INTO protocols VALUES (?, ?, ?, ?, ?, ?)',
+            [(module_id, prot['address'], prot['service'], prot['guid'],
+              prot['protocol_name'], prot['protocol_place'])
+             for prot in module_json['protocols']])
+        return module_id
+
+    def update_protocol_names(self, get_name):
+        '''
+        rename protocols with get_name(guid) -> (protocol_name, protocol_place),
+        number of changed records is returned
+        '''
+        guids = [
+            row[0] for row in self.conn.execute(
+                'SELECT DISTINCT guid FROM protocols')
+        ]
+        changed = 0
+        for guid in guids:
+            name, place = get_name(guid)
+            cursor = self.conn.execute(
+                'UPDATE protocols SET protocol_name = ?, protocol_place = ? '
+                'WHERE guid = ? AND (protocol_name IS NOT ? OR '
+                'protocol_place IS NOT ?)', (name, place, guid, name, place))
+            changed += cursor.rowcount
+        self.conn.commit()
+        return changed
+
+    def add_dependencies(self, firmware_id):
+        '''
+        get install -> consume dependencies between firmware modules
+        '''
+        module_ids = {}
+        for module_id, name in self.conn.execute(
+                'SELECT id, name FROM modules WHERE firmware_id = ?',
+            (firmware_id, )):
+            module_ids[name] = module_id
+        dep_index = get_dep_index(self.get_res_json(firmware_id))
+        edges = []
+        for record in dep_index['installed']:
+            for consumer in dep_index['consumers'].get(record['guid'], []):
+                edges.append((record['guid'], module_ids[record['module_name']],
+                              module_ids[consumer]))
+        self.conn.executemany('INSERT INTO dependencies VALUES (?, ?, ?)',
+                              edges)
+        self.conn.commit()
+
+    def import_json(self, json_file, fw_path, pe_dir=None):
+        '''
+        import log in JSON format (see md_to_json.py),
+        if pe_dir is set, module hashes are calculated
+        '''
+        with open(json_file, 'r') as f:
+            res_json = json.load(f)
+        firmware_id = self.add_firmware(fw_path)
+        for module_json in res_json:
+            sha256 = None
+            if pe_dir is not None:
+                module_path = os.path.join(pe_dir, module_json['module_name'])
+                if os.path.isfile(module_path):
+                    sha256 = get_sha256(module_path)
+            self.add_module(firmware_id, module_json, sha256)
+        self.add_dependencies(firmware_id)
+        return firmware_id
+
+    def get_firmware_id(self, firmware):
+        '''
+        find firmware by name or by SHA256
+        '''
+        row = self.conn.execute(
+            'SELECT id FROM firmwares WHERE sha256 = ? OR name = ? '
+            'ORDER BY id DESC', (firmware.lower(), firmware)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def get_res_json(self, firmware_id=None):
+        '''
+        get analysis results in md_to_json format
+        '''
+        return get_res_json(self.conn, firmware_id)
+
+    def installers(self, guid):
+        '''
+        get firmwares and modules that install GUID
+        '''
+        return self.conn.execute(
+            'SELECT DISTINCT f.name, m.name, m.sha256, p.service '
+            'FROM protocols p JOIN modules m ON p.module_id = m.id '
+            'JOIN firmwares f ON m.firmware_id = f.id '
+            'WHERE p.guid = ? AND p.service IN ({})'.format(','.join(
+                ['?'] * len(INSTALL_PROTOCOL_SERVICES))),
+            (guid.upper(), ) + INSTALL_PROTOCOL_SERVICES).fetchall()
+
+    def consumers(self, guid):
+        '''
+        get firmwares and modules that consume GUID
+        '''
+        return self.conn.execute(
+            'SELECT DISTINCT f.name, m.name, m.sha256, p.service '
+            'FROM protocols p JOIN modules m ON p.module_id = m.id '
+            'JOIN firmwares f ON m.firmware_id = f.id '
+            'WHERE p.guid = ? AND p.service IN ({})'.format(','.join(
+                ['?'] * len(CLIENT_PROTOCOL_SERVICES))),
+            (guid.upper(), ) + CLIENT_PROTOCOL_SERVICES).fetchall()
+
+    def proprietary_consumers(self):
+        '''
+        get modules that consume proprietary protocols
+        '''
+        return self.conn.execute(
+            'SELECT DISTINCT f.name, m.name, m.sha256, p.guid '
+            'FROM protocols p JOIN modules m ON p.module_id = m.id '
+            'JOIN firmwares f ON m.firmware_id = f.id '
+            'WHERE p.protocol_name = ? AND p.service IN ({}) '
+            'ORDER BY f.name, m.name'.format(','.join(
+                ['?'] * len(CLIENT_PROTOCOL_SERVICES))),
+            ('ProprietaryProtocol', ) + CLIENT_PROTOCOL_SERVICES).fetchall()
+
+    def module_firmwares(self, module):
+        '''
+        get firmwares that contain module (by name or by SHA256)
+        '''
+        return self.conn.execute(
+            'SELECT DISTINCT f.name, f.sha256, m.name, m.sha256 '
+            'FROM modules m JOIN firmwares f ON m.firmware_id = f.id '
+            'WHERE m.name = ? OR m.sha256 = ?',
+            (module, module.lower())).fetchall()
+
+
+def print_rows(header, rows):
+    print(' | '.join(header))
+    for row in rows:
+        print(' | '.join([str(value) for value in row]))
+    print('[*] {} records'.format(len(rows)))
+
+
+def main():
+    program = 'python -m tools.result_db'
+    parser = argparse.ArgumentParser(
+        description='Store and query analysis results in SQLite database',
+        prog=program)
+    parser.add_argument('db_path', type=str, help='path to SQLite database')
+    parser.add_argument('--import_json',
+                        type=str,
+                        metavar='JSON_LOG',
+                        help='import log in JSON format (for example, '
+                        'ida_log_all.json), requires --firmware')
+    parser.add_argument('--firmware',
+                        type=str,
+                        help='path to analysed firmware (for --import_json)')
+    parser.add_argument('--installs',
+                        type=str,
+                        metavar='GUID',
+                        help='which firmwares and modules install GUID')
+    parser.add_argument('--consumes',
+                        type=str,
+                        metavar='GUID',
+                        help='which firmwares and modules consume GUID')
+    parser.add_argument('--pp_consumers',
+                        action='store_true',
+                        help='which modules consume proprietary protocols')
+    parser.add_argument('--module',
+                        type=str,
+                        help='which firmwares contain module (name or SHA256)')
+
+    args = parser.parse_args()
+
+    db = ResultDB(args.db_path)
+    if args.import_json:
+        if not args.firmware or not os.path.isfile(args.firmware):
+            print('[error] check firmware path')
+        else:
+            db.import_json(args.import_json, args.firmware)
+            print('[*] {} imported'.format(args.import_json))
+    if args.installs:
+        print_rows(['Firmware', 'Module', 'SHA256', 'Service'],
+                   db.installers(args.installs))
+    if args.consumes:
+        print_rows(['Firmware', 'Module', 'SHA256', 'Service'],
+                   db.consumers(args.consumes))
+    if args.pp_consumers:
+        print_rows(['Firmware', 'Module', 'SHA256', 'Guid'],
+                   db.proprietary_consumers())
+    if args.module:
+        print_rows(['Firmware', 'Firmware SHA256', 'Module', 'SHA256'],
+                   db.module_firmwares(args.module))
+    db.close()
+
+
+if __name__ == '__main__':
+    main()
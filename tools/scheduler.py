@@ -0,0 +1,435 @@
+# MIT License
+#
+# Copyright (c) 2018-2019 yeggor
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from . import metrics, profiler
+from .result_db import get_sha256
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+RUNTIME_FUNCTION_SIZE = 12
+# seconds per byte of module before any history is collected
+DEFAULT_SIZE_RATE = 1e-5
+
+# peak memory of r2/IDA worker before any history is collected
+DEFAULT_PEAK_RSS = 256 << 20
+# memory that is left to the rest of the system
+MEMORY_RESERVE = 512 << 20
+SAMPLE_INTERVAL = 0.2
+PROC_DIR = '/proc'
+
+# modules preloaded by forkserver (None until the first pool is created)
+PRELOAD = None
+# the warning about disabled admission control is printed once
+MEMORY_WARNED = False
+
+
+def get_available_memory():
+    '''
+    get available system memory in bytes (None if it is unknown)
+    '''
+    if psutil is not None:
+        return psutil.virtual_memory().available
+    try:
+        with open(os.path.join(PROC_DIR, 'meminfo'), 'r') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) << 10
+    except OSError:
+        pass
+    return None
+
+
+def get_proc_children():
+    children = {}
+    for entry in os.scandir(PROC_DIR):
+        if not entry.name.isdigit():
+            continue
+        try:
+            with open(os.path.join(entry.path, 'stat'), 'r') as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # the process name may contain spaces and brackets
+        ppid = int(stat.rsplit(')', 1)[1].split()[1])
+        children.setdefault(ppid, []).append(int(entry.name))
+    return children
+
+
+def get_proc_rss(pid):
+    try:
+        with open(os.path.join(PROC_DIR, str(pid), 'statm'), 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def get_tree_rss(pid):
+    '''
+    get RSS of the process and all its descendants in bytes
+    (None if it is unknown)
+    '''
+    if psutil is not None:
+        try:
+            process = psutil.Process(pid)
+            processes = [process] + process.children(recursive=True)
+        except psutil.Error:
+            return None
+        rss = 0
+        for process in processes:
+            try:
+                rss += process.memory_info().rss
+            except psutil.Error:
+                continue
+        return rss
+    if not os.path.isdir(PROC_DIR):
+        return None
+    children = get_proc_children()
+    rss = 0
+    stack = [pid]
+    while stack:
+        pid = stack.pop()
+        rss += get_proc_rss(pid)
+        stack.extend(children.get(pid, []))
+    return rss
+
+
+class PeakMonitor():
+    '''
+    sample RSS of the process tree in background thread
+    '''
+    def __init__(self, pid, interval=SAMPLE_INTERVAL):
+        self.pid = pid
+        self.interval = interval
+        self.peak = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _sample(self):
+        rss = get_tree_rss(self.pid)
+        if rss is not None and (self.peak is None or rss > self.peak):
+            self.peak = rss
+
+    def _run(self):
+        self._sample()
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+
+
+def warn_memory_unknown(jobs):
+    '''
+    warn that jobs are not admitted by free memory
+    '''
+    global MEMORY_WARNED
+    if MEMORY_WARNED:
+        return
+    MEMORY_WARNED = True
+    print('[-] Available memory is unknown (install psutil), '
+          '{} jobs are run at once without memory admission'.format(jobs))
+
+
+class MemoryController():
+    '''
+    admit new jobs only when there is enough free memory for their
+    predicted peak RSS, at most `jobs` jobs are running at once
+    '''
+    def __init__(self, jobs, reserve=MEMORY_RESERVE):
+        self.jobs = jobs
+        self.reserve = reserve
+        self.enabled = get_available_memory() is not None
+        self.pool_pid = os.getpid()
+        if not self.enabled and jobs > 1:
+            warn_memory_unknown(jobs)
+
+    def get_headroom(self, running_peaks):
+        '''
+        get memory that is left for new jobs, the growth of running jobs
+        up to their predicted peaks is taken into account
+        '''
+        available = get_available_memory()
+        workers_rss = get_tree_rss(self.pool_pid) or 0
+        growth = max(0, sum(running_peaks) - workers_rss)
+        return available - growth - self.reserve
+
+    def select(self, queue, running_peaks):
+        '''
+        get index of the next job from the queue (None if no job is admitted),
+        the longest job that fits in the free memory is selected
+        '''
+        if not queue or len(running_peaks) >= self.jobs:
+            return None
+        if not self.enabled or not running_peaks:
+            return 0
+        headroom = self.get_headroom(running_peaks)
+        for index, record in enumerate(queue):
+            if record['peak_rss'] <= headroom:
+                return index
+        return None
+
+
+def get_funcs_num(record):
+    '''
+    get number of functions from exception directory (x64 modules only)
+    '''
+    for section in record.get('sections', []):
+        if section['name'] == '.pdata':
+            return section['virtual_size'] // RUNTIME_FUNCTION_SIZE
+    return 0
+
+
+class CostHistory():
+    '''
+    analysis time of modules, keyed by module hash and name
+    '''
+    def __init__(self, history_file):
+        self.history_file = history_file
+        self.hashes = {}
+        self.names = {}
+        self.size_rate = DEFAULT_SIZE_RATE
+        self.funcs_rate = None
+        if os.path.isfile(history_file):
+            try:
+                with open(history_file, 'r') as f:
+                    history = json.load(f)
+                self.hashes = history['hashes']
+                self.names = history['names']
+            except (OSError, ValueError, KeyError):
+                pass
+        self._update_rates()
+
+    def _update_rates(self):
+        total_time, total_size = 0, 0
+        funcs_time, total_funcs = 0, 0
+        for entry in self.hashes.values():
+            total_time += entry['time']
+            total_size += entry['size']
+            if entry['funcs']:
+                funcs_time += entry['time']
+                total_funcs += entry['funcs']
+        if total_size:
+            self.size_rate = total_time / total_size
+        if total_funcs:
+            self.funcs_rate = funcs_time / total_funcs
+
+    def predict_peak(self, record):
+        '''
+        get predicted peak RSS of the analysis of module
+        '''
+        entry = self.hashes.get(record['sha256'])
+        if entry is not None and entry.get('peak_rss'):
+            return entry['peak_rss']
+        peaks = sorted(entry['peak_rss'] for entry in self.hashes.values()
+                       if entry.get('peak_rss'))
+        if peaks:
+            # median of the known peaks
+            return peaks[len(peaks) // 2]
+        return DEFAULT_PEAK_RSS
+
+    def predict(self, record):
+        '''
+        get predicted analysis time of module
+        '''
+        entry = self.hashes.get(record['sha256'])
+        if entry is not None:
+            return entry['time']
+        if record['module'] in self.names:
+            return self.names[record['module']]
+        funcs = get_funcs_num(record)
+        if funcs and self.funcs_rate:
+            return funcs * self.funcs_rate
+        return record['size'] * self.size_rate
+
+    def sort(self, records):
+        '''
+        sort modules by predicted analysis time, the longest first
+        '''
+        for record in records:
+            if 'sha256' not in record:
+                record['sha256'] = get_sha256(record['path'])
+            record['cost'] = self.predict(record)
+            record['peak_rss'] = self.predict_peak(record)
+        return sorted(records, key=lambda record: record['cost'], reverse=True)
+
+    def update(self, record, elapsed, peak_rss=None):
+        self.hashes[record['sha256']] = {
+            'module': record['module'],
+            'time': elapsed,
+            'size': record['size'],
+            'funcs': get_funcs_num(record),
+            'peak_rss': peak_rss
+        }
+        self.names[record['module']] = elapsed
+
+    def save(self):
+        with open(self.history_file, 'w') as f:
+            json.dump({'hashes': self.hashes, 'names': self.names}, f)
+
+
+def run_timed(worker, record, profile_dir=None):
+    '''
+    run worker in pool process, the peak RSS of the process and its
+    children (r2 or IDA) is measured (the worker is profiled if
+    `profile_dir` is set)
+    '''
+    with PeakMonitor(os.getpid()) as monitor:
+        start = time.perf_counter()
+        if profile_dir is None:
+            result = worker(record)
+        else:
+            result = profiler.profile_call(profile_dir, record['module'],
+                                           worker, record)
+        elapsed = time.perf_counter() - start
+    return result, elapsed, monitor.peak
+
+
+def get_worker_module(worker):
+    '''
+    get name of module with worker function (functools.partial is unwrapped)
+    '''
+    module = getattr(worker, 'func', worker).__module__
+    if module != '__main__':
+        return module
+    # '__main__' is not preloaded by forkserver, so the script is preloaded
+    # as a module, and workers only run its body with imports already done
+    main = sys.modules['__main__']
+    spec = getattr(main, '__spec__', None)
+    if spec is not None:
+        return spec.name
+    return os.path.splitext(os.path.basename(main.__file__))[0]
+
+
+def has_forkserver():
+    return 'forkserver' in multiprocessing.get_all_start_methods()
+
+
+def preload(workers):
+    '''
+    set modules of all worker functions of the run to be preloaded by
+    forkserver, it is called before the first pool is created, because
+    the server is started once and keeps its first preload list
+    '''
+    global PRELOAD
+    if PRELOAD is not None:
+        return
+    PRELOAD = []
+    for worker in workers:
+        module = get_worker_module(worker)
+        if not module in PRELOAD:
+            PRELOAD.append(module)
+    if has_forkserver():
+        multiprocessing.get_context('forkserver').set_forkserver_preload(
+            PRELOAD)
+
+
+def get_executor(worker, jobs):
+    '''
+    get process pool with workers forked from a server with the worker
+    modules preloaded (see preload), so module data is imported once and
+    shared by all workers instead of being imported by each of them
+    (a default pool is returned on platforms without forkserver)
+    '''
+    if not has_forkserver():
+        return ProcessPoolExecutor(max_workers=jobs)
+    preload([worker])
+    return ProcessPoolExecutor(
+        max_workers=jobs, mp_context=multiprocessing.get_context('forkserver'))
+
+
+def run_jobs(records,
+             worker,
+             jobs,
+             history,
+             reserve=MEMORY_RESERVE,
+             executor=None):
+    '''
+    run worker for each module, the longest predicted jobs are started first
+    and idle workers take the next job from the common queue while there
+    is enough free memory, (module, result) pairs are yielded in completion
+    order (a pool is created for the run if `executor` is not passed)
+    '''
+    queue = deque(history.sort(records))
+    jobs = max(1, min(jobs or os.cpu_count() or 1, len(queue)))
+    controller = MemoryController(jobs, reserve)
+    running = {}
+    own_executor = executor is None
+    if own_executor:
+        executor = get_executor(worker, jobs)
+    try:
+        while queue or running:
+            while True:
+                running_peaks = [
+                    record['peak_rss'] for record in running.values()
+                ]
+                index = controller.select(queue, running_peaks)
+                if index is None:
+                    break
+                record = queue[index]
+                del queue[index]
+                future = executor.submit(run_timed, worker, record,
+                                         profiler.get_profile_dir())
+                running[future] = record
+            metrics.QUEUE_DEPTH.set(len(queue))
+            metrics.RUNNING_JOBS.set(len(running))
+            # free memory is checked again after timeout
+            done, _ = wait(running,
+                           timeout=SAMPLE_INTERVAL if queue else None,
+                           return_when=FIRST_COMPLETED)
+            for future in done:
+                record = running.pop(future)
+                result, elapsed, peak_rss = future.result()
+                history.update(record, elapsed, peak_rss)
+                metrics.RUNNING_JOBS.set(len(running))
+                metrics.MODULE_SECONDS.observe(elapsed)
+                if peak_rss:
+                    metrics.WORKER_PEAK_RSS.observe(peak_rss)
+                yield record['module'], result
+    finally:
+        if own_executor:
+            executor.shutdown()
+        else:
+            # the shared pool is kept, jobs of interrupted run are dropped
+            for future in running:
+                future.cancel()
+        metrics.QUEUE_DEPTH.set(0)
+        metrics.RUNNING_JOBS.set(0)
+        history.save()
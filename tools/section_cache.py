@@ -0,0 +1,154 @@
+# MIT License
+#
+# Copyright (c) 2018-2019 yeggor
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import hashlib
+import os
+import tempfile
+
+from uefi_firmware import efi_compressor, uefi
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'uefi_retool',
+                         'sections')
+CACHE_SIZE = 1 << 30
+DECOMPRESSORS = ('LzmaDecompress', 'TianoDecompress', 'EfiDecompress')
+
+# first byte of the cache entry
+ENTRY_FAILED = b'\x00'
+ENTRY_DATA = b'\x01'
+
+
+class CachedCompressor():
+    '''
+    efi_compressor stand-in that takes decompressed sections from the cache
+    '''
+    def __init__(self, cache):
+        for name in DECOMPRESSORS:
+            setattr(self, name, self._get_decompressor(cache, name))
+
+    @staticmethod
+    def _get_decompressor(cache, name):
+        def decompress(data, size):
+            return cache.decompress(name, data, size)
+
+        return decompress
+
+    def __getattr__(self, name):
+        return getattr(efi_compressor, name)
+
+
+class SectionCache():
+    '''
+    size-bounded on-disk cache of decompressed sections,
+    keyed by the hash of the compressed payload
+    '''
+    def __init__(self, cache_dir=CACHE_DIR, max_size=CACHE_SIZE):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        # volume workers create the cache at once
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.size = sum(entry.stat().st_size
+                        for entry in os.scandir(self.cache_dir)
+                        if entry.is_file())
+
+    def __enter__(self):
+        self._compressor = uefi.efi_compressor
+        uefi.efi_compressor = CachedCompressor(self)
+        return self
+
+    def __exit__(self, *args):
+        uefi.efi_compressor = self._compressor
+
+    @staticmethod
+    def get_key(algorithm, data):
+        sha256 = hashlib.sha256(algorithm.encode())
+        sha256.update(data)
+        return sha256.hexdigest()
+
+    def get_entry(self, key):
+        path = os.path.join(self.cache_dir, key)
+        try:
+            with open(path, 'rb') as f:
+                entry = f.read()
+        except OSError:
+            return None
+        # keep recently used entries from eviction
+        os.utime(path)
+        return entry
+
+    def put_entry(self, key, entry):
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(entry)
+        os.replace(tmp_path, os.path.join(self.cache_dir, key))
+        self.size += len(entry)
+        if self.size > self.max_size:
+            self.evict()
+
+    def evict(self):
+        '''
+        remove least recently used entries until the cache fits max_size
+        '''
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_file() and not entry.name.endswith('.tmp'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        entries.sort()
+        self.size = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if self.size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.size -= size
+
+    def decompress(self, algorithm, data, size):
+        key = self.get_key(algorithm, data)
+        entry = self.get_entry(key)
+        if entry is not None:
+            self.hits += 1
+            if entry[:1] == ENTRY_FAILED:
+                raise Exception('Failed to decompress')
+            return entry[1:]
+        self.misses += 1
+        try:
+            result = getattr(efi_compressor, algorithm)(data, size)
+        except Exception:
+            self.put_entry(key, ENTRY_FAILED)
+            raise
+        self.put_entry(key, ENTRY_DATA + result)
+        return result
+
+    def get_hit_rate(self):
+        total = self.hits + self.misses
+        if not total:
+            return 0.0
+        return self.hits / total
+
+    def get_stats(self):
+        return '[+] Section cache: {hits} hits, {misses} misses ({rate:.1%})'.format(
+            hits=self.hits, misses=self.misses, rate=self.get_hit_rate())
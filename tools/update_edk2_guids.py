@@ -21,110 +21,210 @@
 # SOFTWARE.
 
 import argparse
-import glob
+import hashlib
+import json
 import os
 import re
 import shutil
-
-import click
+from concurrent.futures import ProcessPoolExecutor
 
 DATA_PATH = os.path.join('..', 'conf')
 IDA_GUIDS = os.path.join('..', 'ida_plugin', 'uefi_analyser', 'guids')
 R2_GUIDS = os.path.join('..', 'r2_uefi_re', 'guids')
 
-
-def get_py(string):
-    new_string = 'edk2_guids = {\n'
-
-    replace_table = {
-        '{': '[',
-        '}': ']',
-        '#': '\t#',
-        '=': ':',
-        ']\n': '],\n',
-    }
-
-    re_table = {
-        r'\ng': "\n\t'g",
-        r' +:': ':',
-        r':': '\' :',
-        r'\]\]': ']',
-        r'\] +\]': ']',
-        r', +\[': ',',
-        r',\[': ',',
-    }
-
-    for key in replace_table:
-        string = string.replace(key, replace_table[key])
-    new_string += string + '}'
-    for regexp in re_table:
-        new_string = re.sub(regexp, re_table[regexp], new_string)
-    return new_string
-
-
-def get_guids_list(edk2_path, data_path):
-    if not os.path.isdir(edk2_path):
-        print('[-] Error, check edk2 path')
-        return False
-    tmpl = os.path.join(edk2_path, '*', '*.dec')
-    dec_files = glob.glob(tmpl)
-    if not len(dec_files):
+CACHE_NAME = 'edk2_guids.cache.json'
+CONF_NAME = 'edk2_guids.conf'
+JSON_NAME = 'edk2_guids.json'
+PY_NAME = 'edk2_guids.py'
+
+GENERATED_MSG = '# This file was automatically generated with update_edk2_guids.py script\n'
+
+# gName = { 0x..., 0x..., 0x..., { 0x.., 0x.., 0x.., 0x.., 0x.., 0x.., 0x.., 0x.. } }
+GUID_RE = re.compile(r'^\s*(g\w+)\s*=\s*\{\s*(\w+)\s*,\s*(\w+)\s*,\s*(\w+)\s*,'
+                     r'\s*\{([^}]*)\}\s*\}', re.MULTILINE)
+
+
+def get_dec_files(roots):
+    '''
+    recursively collect *.dec files from edk2, edk2-platforms or vendor trees
+    '''
+    dec_files = []
+    for root in roots:
+        for dirpath, dirnames, filenames in os.walk(root):
+            # skip .git, .svn and other service directories
+            dirnames[:] = sorted(
+                [name for name in dirnames if not name.startswith('.')])
+            for filename in sorted(filenames):
+                if filename.lower().endswith('.dec'):
+                    dec_files.append(os.path.join(dirpath, filename))
+    return dec_files
+
+
+def parse_dec(dec_file):
+    '''
+    get (sha1, guids) pair for *.dec file
+    '''
+    with open(dec_file, 'rb') as dec:
+        content = dec.read()
+    guids = []
+    for match in GUID_RE.finditer(content.decode('utf-8', 'ignore')):
+        try:
+            values = [int(value, 0) for value in match.group(2, 3, 4)]
+            values += [
+                int(value, 0) for value in match.group(5).split(',')
+                if value.strip()
+            ]
+        except ValueError:
+            continue
+        if len(values) != 11:
+            continue
+        guids.append([match.group(1), values])
+    return hashlib.sha1(content).hexdigest(), guids
+
+
+def load_cache(cache_path):
+    if not os.path.isfile(cache_path):
+        return {}
+    try:
+        with open(cache_path, 'r') as f:
+            return json.load(f)
+    except ValueError:
+        return {}
+
+
+def harvest(roots, cache_path, jobs=None):
+    '''
+    parse *.dec files in parallel, files that have not changed since
+    the previous run are taken from the cache
+    '''
+    cache = load_cache(cache_path)
+    new_cache = {}
+    changed = []
+    for dec_file in get_dec_files(roots):
+        key = os.path.abspath(dec_file)
+        stat = os.stat(dec_file)
+        entry = cache.get(key)
+        if (entry and entry['mtime'] == stat.st_mtime
+                and entry['size'] == stat.st_size):
+            new_cache[key] = entry
+            continue
+        new_cache[key] = {'mtime': stat.st_mtime, 'size': stat.st_size}
+        changed.append(key)
+    if changed:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            for key, (sha1, guids) in zip(changed,
+                                          executor.map(parse_dec, changed)):
+                entry = cache.get(key)
+                if entry and entry['sha1'] == sha1:
+                    # only mtime was changed
+                    guids = entry['guids']
+                new_cache[key]['sha1'] = sha1
+                new_cache[key]['guids'] = guids
+    with open(cache_path, 'w') as f:
+        json.dump(new_cache, f)
+    return new_cache, len(changed)
+
+
+def get_conf(dec_guids):
+    '''
+    get GUIDs list in *.dec format
+    '''
+    conf_content = ''
+    for dec_file in dec_guids:
+        conf_content += '# Guids from {dec_file} file \n'.format(
+            dec_file=dec_file)
+        for name, values in dec_guids[dec_file]:
+            values = ['{:#x}'.format(value) for value in values]
+            conf_content += '{name} = {{ {head}, {{ {tail} }} }}\n'.format(
+                name=name,
+                head=', '.join(values[:3]),
+                tail=', '.join(values[3:]))
+    return conf_content
+
+
+def get_py(dec_guids):
+    '''
+    get python module with edk2 guids
+    '''
+    py_content = 'edk2_guids = {\n'
+    for dec_file in dec_guids:
+        py_content += '\t# Guids from {dec_file} file \n'.format(
+            dec_file=dec_file)
+        for name, values in dec_guids[dec_file]:
+            py_content += '\t{name!r} : [ {values} ],\n'.format(
+                name=name,
+                values=', '.join(['{:#x}'.format(value) for value in values]))
+    py_content += '}\n'
+    return py_content
+
+
+def get_guids_list(edk2_path, data_path, jobs=None):
+    roots = [edk2_path] if isinstance(edk2_path, str) else edk2_path
+    for root in roots:
+        if not os.path.isdir(root):
+            print('[-] Error, check edk2 path ({})'.format(root))
+            return False
+    if not os.path.isdir(data_path):
+        os.mkdir(data_path)
+    cache, changed = harvest(roots, os.path.join(data_path, CACHE_NAME), jobs)
+    if not len(cache):
         print('[-] Error, *.dec files list is empty')
         return False
-    if not os.path.isdir(DATA_PATH):
-        os.mkdir(DATA_PATH)
-    regexp = re.compile(r'g.+=.+{.+}')
-    conf_content = ''
-    for dec_file in dec_files:
-        with open(dec_file, 'r') as dec:
-            guids_list = re.findall(regexp, dec.read())
-            conf_content += '# Guids from {dec_file} file \n'.format(
-                dec_file=dec_file)
-            for guid in guids_list:
-                conf_content += guid + '\n'
-    with open(os.path.join(DATA_PATH, 'edk2_guids.conf'), 'w') as conf:
-        conf.write(
-            '# This file was automatically generated with update_edk2_guids.py script\n'
-        )
-        conf.write(conf_content)
-    py_content = get_py(conf_content)
-    with open(os.path.join(DATA_PATH, 'edk2_guids.py'), 'w') as conf:
-        conf.write(
-            '# This file was automatically generated with update_edk2_guids.py script\n'
-        )
-        conf.write(py_content)
+    print('[*] {0} *.dec files found, {1} parsed, {2} taken from cache'.format(
+        len(cache), changed,
+        len(cache) - changed))
+    dec_guids = {}
+    for dec_file in sorted(cache):
+        dec_guids[os.path.relpath(dec_file)] = cache[dec_file]['guids']
+    with open(os.path.join(data_path, JSON_NAME), 'w') as f:
+        json.dump(dec_guids, f, indent=4)
+    with open(os.path.join(data_path, CONF_NAME), 'w') as f:
+        f.write(GENERATED_MSG)
+        f.write(get_conf(dec_guids))
+    with open(os.path.join(data_path, PY_NAME), 'w') as f:
+        f.write(GENERATED_MSG)
+        f.write(get_py(dec_guids))
     return True
 
 
 def update(edk2_path, data_path, guids_path):
     if get_guids_list(edk2_path, data_path):
-        shutil.copy(os.path.join(data_path, 'edk2_guids.py'),
-                    os.path.join(guids_path, 'edk2_guids.py'))
-        print('[*] Files {0}, {1} was successfully updated'.format(
-            os.path.join(data_path, 'edk2_guids.conf'),
-            os.path.join(data_path, 'edk2_guids.py')))
+        shutil.copy(os.path.join(data_path, PY_NAME),
+                    os.path.join(guids_path, PY_NAME))
+        print('[*] Files {0}, {1}, {2} was successfully updated'.format(
+            os.path.join(data_path, JSON_NAME),
+            os.path.join(data_path, CONF_NAME),
+            os.path.join(data_path, PY_NAME)))
         return True
     return False
 
 
 def main():
     program = 'python ' + os.path.basename(__file__)
-    parser = argparse.ArgumentParser(description='Get all UEFI PE-images',
+    parser = argparse.ArgumentParser(description='Update edk2 GUIDs list',
                                      prog=program)
-    parser.add_argument('edk2_path',
-                        type=str,
-                        help='the path to EDK2 directory')
+    parser.add_argument(
+        'edk2_path',
+        type=str,
+        nargs='+',
+        help='the path to EDK2 directory (edk2-platforms and vendor trees '
+        'can be added as additional paths)')
+    parser.add_argument('--jobs',
+                        type=int,
+                        default=None,
+                        help='number of worker processes (default: CPU count)')
 
     args = parser.parse_args()
 
-    if get_guids_list(args.edk2_path, DATA_PATH):
-        shutil.copyfile(os.path.join(DATA_PATH, 'edk2_guids.py'),
-                        os.path.join(IDA_GUIDS, 'edk2_guids.py'))
-        shutil.copyfile(os.path.join(DATA_PATH, 'edk2_guids.py'),
-                        os.path.join(R2_GUIDS, 'edk2_guids.py'))
-        print('[*] Files {0}, {1} was successfully updated'.format(
-            os.path.join(DATA_PATH, 'edk2_guids.conf'),
-            os.path.join(DATA_PATH, 'edk2_guids.py')))
+    if get_guids_list(args.edk2_path, DATA_PATH, args.jobs):
+        shutil.copyfile(os.path.join(DATA_PATH, PY_NAME),
+                        os.path.join(IDA_GUIDS, PY_NAME))
+        shutil.copyfile(os.path.join(DATA_PATH, PY_NAME),
+                        os.path.join(R2_GUIDS, PY_NAME))
+        print('[*] Files {0}, {1}, {2} was successfully updated'.format(
+            os.path.join(DATA_PATH, JSON_NAME),
+            os.path.join(DATA_PATH, CONF_NAME),
+            os.path.join(DATA_PATH, PY_NAME)))
 
 
 if __name__ == '__main__':
@@ -20,9 +20,47 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import json
+import os
+import struct
+import sys
+
+# analysis results processing without IDA API is shared with the plugin
+PLUGIN_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'ida_plugin')
+if not PLUGIN_DIR in sys.path:
+    sys.path.insert(0, PLUGIN_DIR)
+
+# pylint: disable=wrong-import-position
+from uefi_analyser.results import (CLIENT_PROTOCOL_SERVICES,
+                                   INSTALL_PROTOCOL_SERVICES, get_dep_index,
+                                   get_res_json)
+
 IMAGE_FILE_MACHINE_IA64 = 0x8664
 IMAGE_FILE_MACHINE_I386 = 0x014c
 PE_OFFSET = 0x3c
+IMAGE_DOS_SIGNATURE = b'MZ'
+IMAGE_NT_SIGNATURE = b'PE\x00\x00'
+EFI_TE_IMAGE_HEADER_SIGNATURE = b'VZ'
+IMAGE_NT_OPTIONAL_HDR32_MAGIC = 0x10b
+IMAGE_NT_OPTIONAL_HDR64_MAGIC = 0x20b
+IMAGE_SUBSYSTEM_EFI_APPLICATION = 0xa
+IMAGE_SUBSYSTEM_EFI_BOOT_SERVICE_DRIVER = 0xb
+IMAGE_SUBSYSTEM_EFI_RUNTIME_DRIVER = 0xc
+IMAGE_SUBSYSTEM_EFI_ROM = 0xd
+EFI_SUBSYSTEMS = (IMAGE_SUBSYSTEM_EFI_APPLICATION,
+                  IMAGE_SUBSYSTEM_EFI_BOOT_SERVICE_DRIVER,
+                  IMAGE_SUBSYSTEM_EFI_RUNTIME_DRIVER, IMAGE_SUBSYSTEM_EFI_ROM)
+# headers, optional header and section table fit here
+HEADER_SIZE = 0x1000
+IDA_FILES = ('.idb', '.i64', '.id0', '.id1', '.id2', '.nam', '.til')
+'''
+architectures supported by analysis backends
+'''
+BACKEND_MACHINES = {
+    'r2': (IMAGE_FILE_MACHINE_IA64, ),
+    'ida': (IMAGE_FILE_MACHINE_I386, IMAGE_FILE_MACHINE_IA64)
+}
 
 
 def get_num_le(bytearr):
@@ -32,11 +70,110 @@ def get_num_le(bytearr):
     return num_le
 
 
-def get_machine_type(module_path):
+def read_header(module_path, size=HEADER_SIZE):
     with open(module_path, 'rb') as module:
-        data = module.read()
-    PE_POINTER = get_num_le(data[PE_OFFSET:PE_OFFSET + 1:])
-    FH_POINTER = PE_POINTER + 4
-    machine_type = data[FH_POINTER:FH_POINTER + 2:]
-    type_value = get_num_le(machine_type)
-    return type_value
+        return module.read(size)
+
+
+def get_sections(header, offset, number):
+    sections = []
+    for i in range(number):
+        start = offset + i * 40
+        if len(header) < start + 40:
+            break
+        name, virtual_size, virtual_address, raw_size, raw_offset = \
+            struct.unpack_from('<8sIIII', header, start)
+        sections.append({
+            'name': name.rstrip(b'\x00').decode('utf-8', 'replace'),
+            'virtual_address': virtual_address,
+            'virtual_size': virtual_size,
+            'raw_offset': raw_offset,
+            'raw_size': raw_size
+        })
+    return sections
+
+
+def get_header_info(header):
+    '''
+    parse DOS/PE/optional headers or TE header,
+    None is returned for unknown format
+    '''
+    if header[:2] == EFI_TE_IMAGE_HEADER_SIGNATURE and len(header) >= 40:
+        machine, sections_num, subsystem, stripped_size, entry_point = \
+            struct.unpack_from('<HBBHI', header, 2)
+        return {
+            'format': 'TE',
+            'machine': machine,
+            'subsystem': subsystem,
+            'entry_point': entry_point,
+            'stripped_size': stripped_size,
+            'sections': get_sections(header, 40, sections_num)
+        }
+    if header[:2] != IMAGE_DOS_SIGNATURE or len(header) < PE_OFFSET + 4:
+        return None
+    pe_pointer = struct.unpack_from('<I', header, PE_OFFSET)[0]
+    opt_pointer = pe_pointer + 24
+    if (len(header) < opt_pointer + 72
+            or header[pe_pointer:pe_pointer + 4] != IMAGE_NT_SIGNATURE):
+        return None
+    machine, sections_num = struct.unpack_from('<HH', header, pe_pointer + 4)
+    opt_size = struct.unpack_from('<H', header, pe_pointer + 20)[0]
+    magic, = struct.unpack_from('<H', header, opt_pointer)
+    entry_point, = struct.unpack_from('<I', header, opt_pointer + 16)
+    image_size, = struct.unpack_from('<I', header, opt_pointer + 56)
+    subsystem, = struct.unpack_from('<H', header, opt_pointer + 68)
+    return {
+        'format': 'PE32+' if magic == IMAGE_NT_OPTIONAL_HDR64_MAGIC else 'PE32',
+        'machine': machine,
+        'subsystem': subsystem,
+        'entry_point': entry_point,
+        'image_size': image_size,
+        'sections': get_sections(header, opt_pointer + opt_size, sections_num)
+    }
+
+
+def get_machine_type(module_path):
+    info = get_header_info(read_header(module_path))
+    if info is None:
+        return 0
+    return info['machine']
+
+
+def get_inventory(pe_dir):
+    '''
+    get information about modules from their headers
+    '''
+    inventory = []
+    for entry in sorted(os.scandir(pe_dir), key=lambda entry: entry.name):
+        if not entry.is_file() or entry.name[-4:] in IDA_FILES:
+            continue
+        record = {
+            'module': entry.name,
+            'path': entry.path,
+            'size': entry.stat().st_size
+        }
+        info = get_header_info(read_header(entry.path))
+        if info is not None:
+            record.update(info)
+        inventory.append(record)
+    return inventory
+
+
+def save_inventory(inventory, inventory_file):
+    with open(inventory_file, 'w') as f:
+        json.dump(inventory, f, indent=4)
+
+
+def triage(inventory, backend):
+    '''
+    split inventory into modules supported and not supported by backend
+    '''
+    supported, dropped = [], []
+    for record in inventory:
+        if (record.get('format') in ('PE32', 'PE32+')
+                and record['machine'] in BACKEND_MACHINES[backend]
+                and record['subsystem'] in EFI_SUBSYSTEMS):
+            supported.append(record)
+        else:
+            dropped.append(record)
+    return supported, dropped